@@ -0,0 +1 @@
+# SAFI LAB - Benchmarks: synthetic data, fake COM layer and the runner (python -m benchmarks.run)
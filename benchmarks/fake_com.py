@@ -0,0 +1,166 @@
+# SAFI LAB - In-memory stand-in for the Excel COM objects (benchmarks on any OS)
+import sys
+import types
+from contextlib import contextmanager
+
+from openpyxl import load_workbook
+
+XL_UP = -4162
+MAX_ROWS = 1048576
+
+
+class FakeExcel:
+    """
+    Enough of Excel.Application for our COM code paths: Workbooks.Open,
+    Worksheets(name), Cells(r, c).Value / .End(xlUp), Range(a, b).Value,
+    Rows.Count, Rows(r).Delete(), Save/Close/Quit. The workbook is loaded and
+    saved with openpyxl; `calls` counts COM round trips.
+    """
+
+    calls = 0
+
+    def __init__(self):
+        self.Visible = True
+        self.DisplayAlerts = True
+        self.Workbooks = _Workbooks(self)
+
+    @classmethod
+    def count(cls):
+        cls.calls += 1
+
+    def Quit(self):
+        FakeExcel.count()
+
+
+class _Workbooks:
+    def __init__(self, app):
+        self._app = app
+
+    def Open(self, path):
+        FakeExcel.count()
+        return _Workbook(path)
+
+
+class _Workbook:
+    def __init__(self, path):
+        self.path = path
+        self._wb = load_workbook(path, keep_vba=path.lower().endswith(".xlsm"))
+
+    def Worksheets(self, name):
+        FakeExcel.count()
+        return _Sheet(self._wb[name])
+
+    def Save(self):
+        FakeExcel.count()
+        self._wb.save(self.path)
+
+    def Close(self, save_changes=False):
+        FakeExcel.count()
+        self._wb.close()
+
+
+class _Rows:
+    Count = MAX_ROWS
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def __call__(self, row):
+        return _Row(self._ws, row)
+
+
+class _Row:
+    def __init__(self, ws, row):
+        self._ws = ws
+        self._row = row
+
+    def Delete(self):
+        FakeExcel.count()
+        self._ws.delete_rows(self._row)
+
+
+class _Sheet:
+    def __init__(self, ws):
+        self._ws = ws
+        self.Rows = _Rows(ws)
+
+    def Cells(self, row, col):
+        return _Cell(self._ws, row, col)
+
+    def Range(self, first, last):
+        return _Range(self._ws, first, last)
+
+
+class _Range:
+    def __init__(self, ws, first, last):
+        self._ws = ws
+        self._first = first
+        self._last = last
+
+    @property
+    def Value(self):
+        FakeExcel.count()
+        first, last = self._first, self._last
+        values = tuple(tuple(r) for r in self._ws.iter_rows(
+            min_row=first.Row, max_row=last.Row, min_col=first.Column, max_col=last.Column, values_only=True))
+        # Like COM, a single cell comes back as a bare value
+        if len(values) == 1 and len(values[0]) == 1:
+            return values[0][0]
+        return values
+
+    @Value.setter
+    def Value(self, rows):
+        FakeExcel.count()
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                self._ws.cell(self._first.Row + r, self._first.Column + c).value = value
+
+
+class _Cell:
+    def __init__(self, ws, row, col):
+        self._ws = ws
+        self.Row = row
+        self.Column = col
+
+    @property
+    def Value(self):
+        FakeExcel.count()
+        if self.Row > self._ws.max_row: return None
+        return self._ws.cell(self.Row, self.Column).value
+
+    @Value.setter
+    def Value(self, value):
+        FakeExcel.count()
+        self._ws.cell(self.Row, self.Column).value = value
+
+    def End(self, direction):
+        if direction != XL_UP:
+            raise NotImplementedError("Only End(xlUp) is used by the app")
+        FakeExcel.count()
+        row = min(self.Row, self._ws.max_row)
+        while row > 1 and self._ws.cell(row, self.Column).value is None:
+            row -= 1
+        return _Cell(self._ws, row, self.Column)
+
+
+@contextmanager
+def installed():
+    """Makes `import pythoncom` / `win32com.client.Dispatch` resolve to the fake while active."""
+    names = ("pythoncom", "win32com", "win32com.client")
+    saved = {name: sys.modules.get(name) for name in names}
+
+    pythoncom = types.ModuleType("pythoncom")
+    pythoncom.CoInitialize = lambda: None
+    pythoncom.CoUninitialize = lambda: None
+    client = types.ModuleType("win32com.client")
+    client.Dispatch = lambda prog_id: FakeExcel()
+    win32com = types.ModuleType("win32com")
+    win32com.client = client
+
+    sys.modules.update({"pythoncom": pythoncom, "win32com": win32com, "win32com.client": client})
+    try:
+        yield FakeExcel
+    finally:
+        for name, module in saved.items():
+            if module is None: sys.modules.pop(name, None)
+            else: sys.modules[name] = module
@@ -0,0 +1,343 @@
+# SAFI LAB - Benchmark runner
+# Usage: python -m benchmarks.run [--sizes 1000 10000 100000] [--format xlsx|xlsm] [--out benchmarks/results.json]
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks import fake_com
+from benchmarks.synthetic import ensure_dataset, synthetic_records
+from cloudflare_uploader import upload_files
+from deploy_mock_server import MockDeployServer
+from file_hash_cache import FileHashCache
+from netlify_uploader import build_zip, deploy_site, deploy_site_digest
+from patient_import import import_patients
+from patient_store import (ExcelPatientStore, SQLitePatientStore, apply_workbook_updates,
+                           apply_workbook_updates_com)
+from patients import (COL_AGE, COL_GENDER, COL_ID, COL_LAST_MOD, COL_NAME, RECORD_COLUMNS, PatientCache,
+                      normalize_id)
+from qr_cache import QRCache, qr_png_bytes
+from report_batch import build_report_files, report_url
+from report_renderer import render_report
+from search_index import SearchIndex
+from sheet_reader import iter_sheet, iter_sheet_openpyxl
+from workbook_snapshots import SnapshotStore
+
+DOMAIN_HOST = "example.invalid"
+SEARCH_QUERIES = ["ahm", "محمد", "ابراهيم", "2010", "noor", "fatma hassan"]
+
+
+def measure(fn, repeat=3, setup=None):
+    """Runs fn `repeat` times; returns min/median/max in ms plus whatever dict fn returned last."""
+    times = []
+    extra = None
+    for _ in range(repeat):
+        if setup: setup()
+        started = time.perf_counter()
+        extra = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    result = {"min_ms": round(min(times), 3), "median_ms": round(statistics.median(times), 3),
+              "max_ms": round(max(times), 3), "runs": repeat}
+    if isinstance(extra, dict): result.update(extra)
+    return result
+
+
+def per_call(fn, items):
+    """Calls fn for each item; returns the mean ms per call."""
+    started = time.perf_counter()
+    for item in items:
+        fn(item)
+    return {"calls": len(items), "per_call_ms": round((time.perf_counter() - started) * 1000 / max(1, len(items)), 3)}
+
+
+class Suite:
+    def __init__(self, dataset, size, repeat, scratch):
+        self.dataset = dataset
+        self.size = size
+        self.repeat = repeat
+        self.heavy_repeat = 1 if size > 10000 else repeat
+        self.scratch = scratch
+        self.results = {}
+        self.records = list(synthetic_records(size))
+        rng = random.Random(1)
+        self.sample_ids = [r["id"] for r in rng.sample(self.records, min(200, size))]
+
+    def run(self, name, fn):
+        print(f"  {name}...", flush=True)
+        try:
+            self.results[name] = fn()
+        except Exception as e:
+            print(f"  {name} failed: {e}")
+            self.results[name] = {"error": f"{type(e).__name__}: {e}"}
+
+    def copy_workbook(self, name):
+        path = os.path.join(self.scratch, name + os.path.splitext(self.dataset["workbook"])[1])
+        shutil.copy2(self.dataset["workbook"], path)
+        return path
+
+    # --- Stores ---
+    def bench_stores(self):
+        workbook = self.dataset["workbook"]
+
+        def seed():
+            db = os.path.join(self.scratch, "seed.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db + suffix): os.remove(db + suffix)
+            store = SQLitePatientStore(db, seed_workbook=workbook)
+            count = len(store.all())
+            store.close()
+            return {"patients": count}
+
+        self.run("sqlite_seed_from_workbook", lambda: measure(seed, self.heavy_repeat))
+        # Streaming reader vs openpyxl read_only, for every record column and for the list columns only
+        for label, columns in (("record", RECORD_COLUMNS), ("list", (COL_ID, COL_NAME, COL_AGE, COL_GENDER, COL_LAST_MOD))):
+            self.run(f"sheet_read_fast[{label}]", lambda: measure(
+                lambda: {"rows": sum(1 for _ in iter_sheet(workbook, "Patients", columns, 2))}, self.heavy_repeat))
+            self.run(f"sheet_read_openpyxl[{label}]", lambda: measure(
+                lambda: {"rows": sum(1 for _ in iter_sheet_openpyxl(workbook, "Patients", columns, 2))},
+                self.heavy_repeat))
+        self.run("patient_cache_load", lambda: measure(
+            lambda: {"patients": len(PatientCache(workbook, "Patients").all())}, self.heavy_repeat))
+
+        store = SQLitePatientStore(os.path.join(self.scratch, "seed.db"))
+        self.run("sqlite_get", lambda: measure(lambda: per_call(store.get, self.sample_ids), self.repeat))
+        self.run("sqlite_query_page", lambda: measure(lambda: {"total": store.query(0, 200, "name")[1]}, self.repeat))
+        self.run("sqlite_query_like", lambda: measure(lambda: {"total": store.query(0, 200, "", "ahm")[1]}, self.repeat))
+        store.close()
+
+        # Bulk import of a referral list the size of the dataset: half existing ids (edited), half new
+        listing = os.path.join(self.scratch, "import.csv")
+        with open(listing, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Patient ID", "Name", "Age", "Sex", "Clinic", "Mobile"])
+            for i, r in enumerate(self.records):
+                pid = r["id"] if i % 2 else f"IMP{i}"
+                writer.writerow([pid, r["name"] + " (ref)", r["age"], r["gender"], "Referral", r["phone"]])
+
+        def import_listing():
+            db = os.path.join(self.scratch, "import.db")
+            shutil.copy2(os.path.join(self.scratch, "seed.db"), db)
+            store = SQLitePatientStore(db)
+            summary, _ = import_patients(store, listing)
+            store.close()
+            return {k: summary[k] for k in ("inserted", "updated", "skipped", "error_count")}
+
+        self.run("import_patients_csv", lambda: measure(import_listing, self.heavy_repeat))
+
+        # Snapshots: first (full) snapshot, then one after a single-row save, then a restore
+        snapshots = SnapshotStore(os.path.join(self.scratch, "snapshots"))
+        copy = self.copy_workbook("snapshot")
+        self.run("snapshot_full", lambda: measure(
+            lambda: {"new_bytes": snapshots.snapshot(copy)["new_bytes"]}, 1))
+
+        edits = iter(range(1, 1000000))
+
+        def edit_row():
+            # A scratch copy, so losing its drawings is fine
+            apply_workbook_updates(copy, "Patients", {"x": {"pid": self.sample_ids[0], "delete": False,
+                                                            "cells": {COL_NAME: f"Snapshot Edit {next(edits)}"}}},
+                                   allow_drawing_loss=True)
+
+        def incremental():
+            manifest = snapshots.snapshot(copy)
+            return {"new_bytes": manifest["new_bytes"] if manifest else 0,
+                    "workbook_bytes": os.path.getsize(copy)}
+
+        self.run("snapshot_incremental", lambda: measure(incremental, self.heavy_repeat, setup=edit_row))
+        latest = snapshots.latest()
+        self.run("snapshot_restore", lambda: measure(
+            lambda: {"bytes": os.path.getsize(snapshots.restore(latest["id"], os.path.join(self.scratch, "restored.xlsx")))},
+            self.repeat))
+
+    # --- Search index ---
+    def bench_search(self):
+        index = SearchIndex()
+        self.run("search_index_build", lambda: measure(lambda: {"docs": index.rebuild(self.records) or len(index)},
+                                                       self.heavy_repeat))
+        for query in SEARCH_QUERIES:
+            self.run(f"search[{query}]", lambda: measure(lambda: {"total": index.search(query, 0, 200)[1]}, self.repeat))
+
+    # --- SafiLabAPI (needs the app's imports) ---
+    def bench_api(self):
+        try:
+            import main
+        except ImportError as e:
+            self.results["api"] = {"skipped": f"main.py could not be imported: {e}"}
+            return
+        main.EXCEL_FILE = self.copy_workbook("api")
+        main.DB_FILE = os.path.join(self.scratch, "api.db")
+        main.OUTPUT_ROOT = self.dataset["tree"]
+        main.DOMAIN_HOST = DOMAIN_HOST
+        main.WORKBOOK_FLUSH_DELAY = 3600  # flushed explicitly below
+        main.BACKUP_DIR = os.path.join(self.scratch, "api_backups")
+
+        holder = {}
+
+        def startup():
+            api = main.SafiLabAPI()
+            while not api._search.ready:
+                time.sleep(0.005)
+            holder["api"] = api
+
+        self.run("api_startup_until_searchable", lambda: measure(startup, 1))
+        api = holder.get("api")
+        if api is None: return
+        try:
+            self.run("api_get_patients", lambda: measure(lambda: {"bytes": len(api.get_patients())}, self.repeat))
+            self.run("api_query_patients_page", lambda: measure(
+                lambda: {"bytes": len(api.query_patients(0, 200, "name", ""))}, self.repeat))
+            self.run("api_get_patient_details", lambda: measure(
+                lambda: per_call(api.get_patient_details, self.sample_ids), self.repeat))
+            for query in SEARCH_QUERIES:
+                self.run(f"api_search[{query}]", lambda: measure(
+                    lambda: {"total": json.loads(api.query_patients(0, 200, "", query))["total"]}, self.repeat))
+
+            updates = [json.dumps(dict(r, name=r["name"] + " x")) for r in self.records[:50]]
+            inserts = [json.dumps(dict(r, id=str(9000000 + i))) for i, r in enumerate(self.records[:50])]
+            self.run("api_save_patient_update", lambda: measure(lambda: per_call(api.save_patient, updates), 1))
+            self.run("api_save_patient_insert", lambda: measure(lambda: per_call(api.save_patient, inserts), 1))
+            self.run("api_flush_workbook_100_rows", lambda: measure(
+                lambda: json.loads(api.flush_workbook()), 1))
+        finally:
+            api._shutdown()
+
+    # --- Excel COM paths, with a fake COM layer ---
+    def bench_com(self):
+        with fake_com.installed() as excel:
+            workbook = self.copy_workbook("com")
+            store = ExcelPatientStore(workbook)
+            pid = self.records[0]["id"]
+
+            def com(fn):
+                excel.calls = 0
+                fn()
+                return {"com_calls": excel.calls}
+
+            self.run("com_upsert_existing", lambda: measure(
+                lambda: com(lambda: store.upsert({"id": pid, "name": "Renamed"})), self.heavy_repeat))
+            self.run("com_set_field", lambda: measure(
+                lambda: com(lambda: store.set_field(pid, "emailed", "Yes")), self.heavy_repeat))
+
+            entries = {normalize_id(r["id"]): {"pid": r["id"], "delete": False, "cells": {COL_NAME: r["name"] + " y"}}
+                       for r in self.records[:100]}
+            self.run("com_apply_100_updates", lambda: measure(
+                lambda: com(lambda: apply_workbook_updates_com(workbook, "Patients", entries)), self.heavy_repeat))
+
+    # --- Reports ---
+    def bench_reports(self):
+        sample = self.records[:min(1000, self.size)]
+        self.run("render_report", lambda: measure(lambda: per_call(render_report, sample), self.repeat))
+
+        urls = [report_url(DOMAIN_HOST, f"{r['name']}_{r['id']}", r["id"]) for r in sample[:100]]
+        self.run("qr_generate", lambda: measure(lambda: per_call(qr_png_bytes, urls), 1))
+        cache = QRCache()
+        for url in urls: cache.get(url)
+        self.run("qr_cache_hit", lambda: measure(lambda: per_call(cache.get, urls), self.repeat))
+
+        output_root = os.path.join(self.scratch, "reports")
+        build = lambda record: build_report_files(record, output_root, DOMAIN_HOST)
+        self.run("build_report_files_cold", lambda: measure(
+            lambda: per_call(build, sample[:100]), 1, setup=lambda: shutil.rmtree(output_root, ignore_errors=True)))
+        self.run("build_report_files_unchanged", lambda: measure(lambda: per_call(build, sample[:100]), self.repeat))
+
+    # --- Deploy packagers against the local stand-in ---
+    def bench_deploy(self):
+        tree = self.dataset["tree"]
+        mock = MockDeployServer().start()
+        try:
+            def traffic(fn):
+                mock.reset_counters()
+                ok, message = fn()
+                if not ok: raise RuntimeError(message)
+                return {"requests": mock.requests, "bytes_sent": mock.bytes_received}
+
+            def zip_to_temp(workers):
+                with tempfile.TemporaryFile() as f:
+                    return {"files": build_zip(tree, f, workers), "zip_bytes": f.tell()}
+
+            self.run("netlify_zip_serial", lambda: measure(lambda: zip_to_temp(0), self.repeat))
+            self.run("netlify_zip_4_workers", lambda: measure(lambda: zip_to_temp(4), self.repeat))
+            self.run("netlify_deploy_zip", lambda: measure(
+                lambda: traffic(lambda: deploy_site(tree, "site", "token", api_base=mock.url)), 1))
+
+            hashes = FileHashCache(os.path.join(self.scratch, "hashes.json"))
+            digest = lambda: traffic(lambda: deploy_site_digest(tree, "site", "token", api_base=mock.url,
+                                                                hash_cache=hashes))
+            self.run("netlify_digest_first", lambda: measure(digest, 1))
+            self.run("netlify_digest_unchanged", lambda: measure(digest, self.repeat))
+
+            files = {os.path.relpath(os.path.join(d, f), tree).replace(os.sep, "/"): os.path.join(d, f)
+                     for d, _, names in os.walk(tree) for f in names}
+            state = os.path.join(self.scratch, "cloudflare_state.json")
+            cloudflare = lambda: traffic(lambda: upload_files(files, "proj", "acct", "token", incremental=True,
+                                                              state_file=state, api_base=mock.url, hash_cache=hashes))
+            self.run("cloudflare_first", lambda: measure(cloudflare, 1))
+            self.run("cloudflare_unchanged", lambda: measure(cloudflare, self.repeat))
+        finally:
+            mock.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SAFI LAB benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--format", choices=["xlsx", "xlsm"], default="xlsx",
+                        help="xlsm is built from the real Patients.xlsm (slower to generate)")
+    parser.add_argument("--tree-limit", type=int, default=2000,
+                        help="patients in the generated QR_Patients tree (per size)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=["stores", "search", "api", "com", "reports", "deploy"])
+    parser.add_argument("--work-dir", default=os.path.join(ROOT, "benchmarks", "data"))
+    parser.add_argument("--out", default=os.path.join(ROOT, "benchmarks", "results.json"))
+    args = parser.parse_args()
+
+    run = {"started_at": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+           "python": platform.python_version(), "platform": platform.platform(), "sizes": {}}
+    groups = args.only or ["stores", "search", "api", "com", "reports", "deploy"]
+
+    for size in args.sizes:
+        print(f"== {size} patients ==", flush=True)
+        started = time.perf_counter()
+        dataset = ensure_dataset(args.work_dir, size, args.format, args.tree_limit,
+                                 template=os.path.join(ROOT, "Patients.xlsm"), domain_host=DOMAIN_HOST)
+        prepare_s = round(time.perf_counter() - started, 2)
+        with tempfile.TemporaryDirectory() as scratch:
+            suite = Suite(dataset, size, args.repeat, scratch)
+            for group in groups:
+                getattr(suite, f"bench_{group}")()
+        run["sizes"][str(size)] = {"format": args.format, "tree_size": dataset["tree_size"],
+                                   "prepare_s": prepare_s, "results": suite.results}
+
+    # Append to the history so runs from different versions can be compared
+    history = {"runs": []}
+    if os.path.exists(args.out):
+        with open(args.out, "r", encoding="utf-8") as f:
+            history = json.load(f)
+    history["runs"].append(run)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=1, ensure_ascii=False)
+    print(f"Results written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# SAFI LAB - Synthetic Patients workbooks and QR_Patients trees for benchmarks
+import os
+import random
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook, load_workbook
+
+from qr_cache import qr_png_bytes
+from report_batch import report_url
+from report_renderer import report_folder_name, write_report
+
+# Same header as the real Patients sheet (A..S)
+HEADER = ["ID", "Name", "Age", "Gender", "Clinic", "Doctor", "Date", "Phone", "Email",
+          "Abs", "Conc", "Trans", "Report Link", "QR Code", "Send Report", None, None, None, None]
+
+FIRST_NAMES = ["Ahmed", "Mohamed", "Sara", "Fatma", "Omar", "Ali", "Layla", "Youssef", "Mona", "Khaled",
+               "أحمد", "محمد", "فاطمة", "إيمان", "مصطفى", "علي", "آمنة", "يوسف"]
+LAST_NAMES = ["Hassan", "Ibrahim", "Saleh", "Haggag", "Mahmoud", "Nasser",
+              "حسن", "إبراهيم", "صالح", "محمود", "ناصر"]
+CLINICS = ["Land clinic", "the best", "Al Noor", "Shifa Center", "مركز الأمل", "Nile Lab"]
+DOCTORS = ["mohamed", "Dr. Sami", "Dr. Noor", "Dr. Hany", "د. منى", "Dr. Adel"]
+PDF_SIZE = 65 * 1024   # typical size of a Word-exported report PDF
+
+
+def synthetic_records(count, seed=0):
+    """Yields `count` patient records (string values, like the stores return)."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for i in range(count):
+        when = start + timedelta(minutes=rng.randint(0, 60 * 24 * 700))
+        stamp = when.strftime('%Y-%m-%d %H:%M:%S')
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        yield {
+            "id": str(100000 + i),
+            "name": name,
+            "age": str(rng.randint(1, 90)),
+            "gender": rng.choice(["Male", "Female"]),
+            "clinic": rng.choice(CLINICS),
+            "doctor": rng.choice(DOCTORS),
+            "date": stamp,
+            "phone": f"20{rng.randint(1000000000, 1299999999)}",
+            "email": f"patient{i}@example.com" if rng.random() < 0.6 else "",
+            "abs": str(round(rng.uniform(0, 100), 2)),
+            "conc": str(round(rng.uniform(0, 100), 2)),
+            "trans": str(rng.randint(0, 100)),
+            "emailed": "Yes" if rng.random() < 0.3 else "",
+            "whatsapp": "Yes" if rng.random() < 0.3 else "",
+            "last_modified": stamp,
+        }
+
+
+def _sheet_row(record):
+    # Typed like Excel would store them (ints, floats, datetimes)
+    when = datetime.strptime(record["date"], '%Y-%m-%d %H:%M:%S')
+    row = [None] * len(HEADER)
+    row[0] = int(record["id"])
+    row[1] = record["name"]
+    row[2] = int(record["age"])
+    row[3] = record["gender"]
+    row[4] = record["clinic"]
+    row[5] = record["doctor"]
+    row[6] = when
+    row[7] = int(record["phone"])
+    row[8] = record["email"] or None
+    row[9] = float(record["abs"])
+    row[10] = float(record["conc"])
+    row[11] = int(record["trans"])
+    row[12] = "Open Report"
+    row[15] = record["emailed"] or None
+    row[16] = record["whatsapp"] or None
+    row[18] = when
+    return row
+
+
+def write_workbook(path, records, template=None, sheet_name="Patients"):
+    """
+    Writes records in the Patients sheet layout. A .xlsm is built from
+    `template` (a real Patients.xlsm, so the VBA project is kept); a .xlsx
+    is streamed with openpyxl's write-only mode.
+    """
+    if path.lower().endswith(".xlsm"):
+        if not template:
+            raise ValueError("A .xlsm needs a template workbook with a VBA project")
+        wb = load_workbook(template, keep_vba=True)
+        ws = wb[sheet_name]
+        if ws.max_row > 1:
+            ws.delete_rows(2, ws.max_row - 1)
+        for record in records:
+            ws.append(_sheet_row(record))
+    else:
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(sheet_name)
+        ws.append(HEADER)
+        for record in records:
+            ws.append(_sheet_row(record))
+    wb.save(path)
+    return path
+
+
+def write_report_tree(output_root, records, domain_host, with_pdf=True, seed=0):
+    """
+    Writes a QR_Patients tree for `records`: the real report HTML, a real QR
+    PNG (one QR reused for every patient, generating 100k QRs is its own
+    benchmark) and an incompressible PDF-sized placeholder.
+    """
+    rng = random.Random(seed)
+    qr_bytes = qr_png_bytes(report_url(domain_host, "Sample_1", "1"))
+    pdf_bytes = b"%PDF-1.5\n" + rng.randbytes(PDF_SIZE)
+    count = 0
+    for record in records:
+        html_path = write_report(record, output_root)
+        folder = os.path.dirname(html_path)
+        with open(os.path.join(folder, f"qr_{record['id']}.png"), "wb") as f:
+            f.write(qr_bytes)
+        if with_pdf:
+            with open(os.path.join(folder, f"patient_{record['id']}.pdf"), "wb") as f:
+                f.write(pdf_bytes)
+        count += 1
+    return count
+
+
+def ensure_dataset(work_dir, size, fmt="xlsx", tree_limit=2000, template=None, domain_host="example.invalid"):
+    """
+    Creates (or reuses) work_dir/<size>/Patients.<fmt> and a QR_Patients tree
+    for the first `tree_limit` patients. Returns the dataset paths.
+    """
+    folder = os.path.join(work_dir, str(size))
+    os.makedirs(folder, exist_ok=True)
+    workbook = os.path.join(folder, f"Patients.{fmt}")
+    tree = os.path.join(folder, "QR_Patients")
+    if not os.path.exists(workbook):
+        write_workbook(workbook, synthetic_records(size), template=template)
+    tree_size = min(size, tree_limit)
+    marker = os.path.join(folder, f".tree_{tree_size}")
+    if not os.path.exists(marker):
+        write_report_tree(tree, synthetic_records(tree_size), domain_host)
+        open(marker, "w").close()
+    return {"folder": folder, "workbook": workbook, "tree": tree, "tree_size": tree_size}
+
+
+def patient_folder(output_root, record):
+    return os.path.join(output_root, report_folder_name(record))
@@ -0,0 +1,127 @@
+# SAFI LAB - Patient change feed: row deltas pushed to the UI + workbook file watcher
+import os
+import threading
+
+from patients import normalize_id
+
+
+def diff_rows(old, new):
+    """
+    Compares two {key: row} snapshots.
+    Returns {"added": [rows], "changed": [rows], "removed": [ids]}.
+    """
+    added = [row for key, row in new.items() if key not in old]
+    changed = [row for key, row in new.items() if key in old and old[key] != row]
+    removed = [old[key]["id"] for key in old if key not in new]
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+class ChangeFeed:
+    """
+    Keeps the last published snapshot of the patient list and sends only
+    what changed to `publish(delta)`.
+
+    Our own write paths call upsert()/remove(); full reloads (workbook edited
+    outside the app, Excel import) call update() with the new list, which is
+    diffed against the snapshot. Nothing is published until reset() has set
+    the baseline.
+    """
+
+    def __init__(self, publish):
+        self.publish = publish
+        self._lock = threading.Lock()
+        self._rows = None   # key -> row
+
+    def reset(self, rows):
+        with self._lock:
+            self._rows = {normalize_id(row["id"]): row for row in rows}
+
+    def update(self, rows):
+        """Publishes the difference between the snapshot and a full new list."""
+        new = {normalize_id(row["id"]): row for row in rows}
+        with self._lock:
+            if self._rows is None:
+                self._rows = new
+                return None
+            delta = diff_rows(self._rows, new)
+            self._rows = new
+        return self._send(delta)
+
+    def upsert(self, row):
+        key = normalize_id(row["id"])
+        with self._lock:
+            if self._rows is None: return None
+            old = self._rows.get(key)
+            if old == row: return None
+            self._rows[key] = row
+        return self._send({"added": [] if old else [row], "changed": [row] if old else [], "removed": []})
+
+    def remove(self, pid):
+        with self._lock:
+            if self._rows is None: return None
+            row = self._rows.pop(normalize_id(pid), None)
+        if row is None: return None
+        return self._send({"added": [], "changed": [], "removed": [row["id"]]})
+
+    def _send(self, delta):
+        if not (delta["added"] or delta["changed"] or delta["removed"]):
+            return None
+        with self._lock:
+            delta["total"] = len(self._rows)
+        try:
+            self.publish(delta)
+        except Exception as e:
+            print(f"Change Feed Publish Error: {e}")
+        return delta
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+class WorkbookWatcher:
+    """
+    Polls a file's (mtime, size) and calls `on_change()` once a change has
+    been stable for one interval (Excel writes the file in several steps).
+
+    Call acknowledge() after writing the file ourselves so our own saves
+    are not reported as outside edits.
+    """
+
+    def __init__(self, path, on_change, interval=1.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._known = _signature(path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="workbook-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def acknowledge(self):
+        self._known = _signature(self.path)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread: self._thread.join(self.interval * 2)
+
+    def _run(self):
+        last = self._known
+        while not self._stop.wait(self.interval):
+            current = _signature(self.path)
+            stable = current == last
+            last = current
+            if current is None or current == self._known or not stable:
+                continue
+            self._known = current
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f"Workbook Watcher Error: {e}")
@@ -1,18 +1,38 @@
 import os
 import requests
 import json
-import hashlib
+
+from file_hash_cache import hash_file, shared_cache
+
+API_BASE = "https://api.cloudflare.com/client/v4"
+DEPLOY_STATE_FILE = os.path.abspath(".cloudflare_deploy_state.json")
 
 def calculate_file_hash(filepath):
     """Calculates the SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    return hash_file(filepath, "sha256")
+
+def load_deploy_state(state_file, project_name):
+    """Returns the manifest (path -> SHA256) of the last successful deployment."""
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            return json.load(f).get(project_name, {})
+    except (OSError, ValueError):
+        return {}
 
-def upload_files(file_paths, project_name, account_id, api_token):
+def save_deploy_state(state_file, project_name, manifest):
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state[project_name] = manifest
+    tmp_path = state_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_file)
+
+def upload_files(file_paths, project_name, account_id, api_token,
+                 incremental=False, state_file=DEPLOY_STATE_FILE, api_base=API_BASE, stats=None, hash_cache=None):
     """
     Uploads a list of files to Cloudflare Pages.
     
@@ -20,56 +40,81 @@ def upload_files(file_paths, project_name, account_id, api_token):
     :param project_name: Name of the Cloudflare Pages project.
     :param account_id: Cloudflare Account ID.
     :param api_token: Cloudflare API Token.
+    :param incremental: Only upload files that are new or changed since the last
+                        successful deployment; unchanged files are sent in the
+                        manifest by hash only.
+    :param state_file: Where the last successful manifest is kept (incremental mode).
+    :param api_base: API root (point it at a local stand-in server for testing).
+    :param stats: Optional dict filled with files/bytes uploaded and skipped.
+    :param hash_cache: FileHashCache to use (default: the shared on-disk cache).
     :return: (success, message)
     """
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/pages/projects/{project_name}/deployments"
+    url = f"{api_base}/accounts/{account_id}/pages/projects/{project_name}/deployments"
     
     headers = {
         "Authorization": f"Bearer {api_token}"
     }
+    if stats is None: stats = {}
+    stats.update({"files_total": 0, "files_uploaded": 0, "files_skipped": 0,
+                  "bytes_uploaded": 0, "bytes_skipped": 0, "requests": 0})
+    previous = load_deploy_state(state_file, project_name) if incremental else {}
+    hash_cache = hash_cache or shared_cache()
     
+    files_to_close = []
     try:
-        files_to_close = []
         payload_files = []
         manifest = {}
+        hashes = hash_cache.hash_many(file_paths.values(), "sha256")
+        hash_cache.save()
         
         for remote_path, local_path in file_paths.items():
-            if os.path.exists(local_path):
-                # Calculate Hash
-                file_hash = calculate_file_hash(local_path)
+            if local_path in hashes:
+                # Hash (cached unless the file changed)
+                file_hash = hashes[local_path]
                 
                 # Add to manifest
                 # Cloudflare expects path starting with /
                 manifest_path = "/" + remote_path.lstrip("/")
                 manifest[manifest_path] = file_hash
+                stats["files_total"] += 1
+                size = os.path.getsize(local_path)
+
+                # Unchanged since the last deployment: referenced by hash only
+                if previous.get(manifest_path) == file_hash:
+                    stats["files_skipped"] += 1
+                    stats["bytes_skipped"] += size
+                    continue
                 
                 # Prepare file for upload
                 f = open(local_path, 'rb')
                 files_to_close.append(f)
                 payload_files.append(('files', (local_path, f)))
+                stats["files_uploaded"] += 1
+                stats["bytes_uploaded"] += size
             else:
                 print(f"File not found: {local_path}")
 
-        if not payload_files:
+        if not manifest:
             return False, "No files found to upload."
 
-        print(f"Uploading {len(payload_files)} files to Cloudflare Pages ({project_name})...")
+        print(f"Uploading {len(payload_files)} of {len(manifest)} files to Cloudflare Pages ({project_name})...")
         
         # Add manifest to payload
-        # For Direct Upload, the manifest is a JSON string in the 'manifest' form field
-        data = {"manifest": json.dumps(manifest)}
+        # For Direct Upload, the manifest is a JSON string in the 'manifest' form field.
+        # It goes in as a file part with no file name, so the request is multipart even
+        # when every file is unchanged (requests would otherwise send it form-urlencoded)
+        payload_files.insert(0, ("manifest", (None, json.dumps(manifest))))
         
-        response = requests.post(url, headers=headers, files=payload_files, data=data)
-        
-        # Close files
-        for f in files_to_close:
-            f.close()
+        stats["requests"] += 1
+        response = requests.post(url, headers=headers, files=payload_files)
             
         if response.status_code == 200:
             data = response.json()
             if data.get('success'):
+                if incremental:
+                    save_deploy_state(state_file, project_name, manifest)
                 deployment_url = data['result']['url']
-                return True, f"Deployed successfully! URL: {deployment_url}"
+                return True, f"Deployed successfully! URL: {deployment_url} ({stats['files_uploaded']} uploaded, {stats['files_skipped']} unchanged)"
             else:
                 return False, f"Upload failed: {data['errors'][0]['message']}"
         else:
@@ -77,3 +122,7 @@ def upload_files(file_paths, project_name, account_id, api_token):
             
     except Exception as e:
         return False, f"Exception during upload: {str(e)}"
+    finally:
+        # Close files
+        for f in files_to_close:
+            f.close()
@@ -0,0 +1,141 @@
+# SAFI LAB - Local stand-in for the Netlify / Cloudflare deploy APIs (testing and timing deploys)
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+class MockDeployServer:
+    """
+    Minimal in-process deploy API.
+
+    Netlify: POST /sites/<id>/deploys (zip body or {"files": {path: sha1}}),
+    PUT /deploys/<id>/files/<path>. Cloudflare: POST .../deployments (multipart
+    only, with a 'manifest' part; anything else is rejected).
+    File hashes uploaded once are remembered, so a second digest deploy only
+    asks for what changed. `fail_rate` makes that share of file uploads answer
+    500, to exercise retries.
+    """
+
+    def __init__(self, fail_rate=0.0, latency=0.0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.known = set()        # SHA1s the "CDN" already has
+        self.deploys = {}         # deploy id -> {path: sha1}
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_received = 0
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with server._lock:
+                    server.requests += 1
+                    server.bytes_received += len(body)
+                if server.latency: time.sleep(server.latency)
+                return body
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self._body()
+                if re.fullmatch(r"/sites/[^/]+/deploys", self.path):
+                    deploy_id = uuid.uuid4().hex
+                    result = {"id": deploy_id, "url": f"{server.url}/{deploy_id}", "required": []}
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        files = json.loads(body or b"{}").get("files", {})
+                        with server._lock:
+                            server.deploys[deploy_id] = files
+                            result["required"] = sorted({sha for sha in files.values() if sha not in server.known})
+                    return self._reply(200, result)
+                if re.fullmatch(r"/accounts/[^/]+/pages/projects/[^/]+/deployments", self.path):
+                    # Like the real API: multipart/form-data with a 'manifest' part, nothing else
+                    if not self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+                        return self._reply(415, {"success": False, "errors": [
+                            {"message": f"Unsupported Content-Type: {self.headers.get('Content-Type')}"}]})
+                    if b'name="manifest"' not in body:
+                        return self._reply(400, {"success": False, "errors": [{"message": "Missing manifest"}]})
+                    return self._reply(200, {"success": True, "result": {"url": server.url}})
+                self._reply(404, {"message": "Not Found"})
+
+            def do_PUT(self):
+                body = self._body()
+                match = re.fullmatch(r"/deploys/([^/]+)/files(/.*)", self.path)
+                if not match:
+                    return self._reply(404, {"message": "Not Found"})
+                if random.random() < server.fail_rate:
+                    return self._reply(500, {"message": "Injected failure"})
+                deploy_id, path = match.group(1), unquote(match.group(2))
+                sha = hashlib.sha1(body).hexdigest()
+                with server._lock:
+                    expected = server.deploys.get(deploy_id, {}).get(path)
+                    if expected != sha:
+                        return self._reply(422, {"message": f"Digest mismatch for {path}"})
+                    server.known.add(sha)
+                self._reply(200, {"id": sha, "path": path})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    # Usage: python deploy_mock_server.py [folder]  - times zip vs digest deploys of QR_Patients
+    import netlify_uploader
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else "QR_Patients"
+    mock = MockDeployServer(fail_rate=0.05).start()
+    try:
+        runs = [("zip", lambda stats: netlify_uploader.deploy_site(folder, "site", "token", api_base=mock.url)),
+                ("digest (first)", lambda stats: netlify_uploader.deploy_site_digest(
+                    folder, "site", "token", retry_delay=0.05, api_base=mock.url, stats=stats)),
+                ("digest (again)", lambda stats: netlify_uploader.deploy_site_digest(
+                    folder, "site", "token", retry_delay=0.05, api_base=mock.url, stats=stats))]
+        for name, run in runs:
+            mock.reset_counters()
+            stats = {}
+            started = time.monotonic()
+            ok, message = run(stats)
+            print(f"{name:15} ok={ok} {time.monotonic() - started:.3f}s "
+                  f"requests={mock.requests} bytes={mock.bytes_received} retries={stats.get('retries', 0)}")
+            if not ok: print(f"  {message}")
+    finally:
+        mock.stop()
@@ -0,0 +1,156 @@
+# SAFI LAB - Persistent file-hash cache shared by the deploy uploaders
+import hashlib
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_CACHE_FILE = os.path.abspath(".file_hash_cache.json")
+READ_BUFFER = 1024 * 1024
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
+
+def hash_file(path, algorithm="sha256"):
+    """Hashes a file with large reads (mmap for big files). Returns the hex digest."""
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            buffer = bytearray(READ_BUFFER)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n: break
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class FileHashCache:
+    """
+    Hashes of files on disk, keyed by (path, size, mtime_ns, inode).
+
+    A file whose key is unchanged is never re-read. Misses are hashed on a
+    thread pool (hashlib releases the GIL). The cache is kept in a JSON file
+    and written by save() when something changed.
+    """
+
+    def __init__(self, cache_file=HASH_CACHE_FILE, workers=4):
+        self.cache_file = cache_file
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def save(self):
+        """Writes the cache if it changed. Returns True if written."""
+        with self._lock:
+            if not self._dirty: return False
+            data = json.dumps(self._entries)
+            self._dirty = False
+        try:
+            tmp_path = self.cache_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_file)
+            return True
+        except OSError as e:
+            print(f"Hash Cache Save Error: {e}")
+            return False
+
+    def _lookup(self, path, key, algorithm):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry["key"] == key and algorithm in entry["hashes"]:
+                self.hits += 1
+                return entry["hashes"][algorithm]
+            self.misses += 1
+            return None
+
+    def _store(self, path, key, algorithm, digest):
+        with self._lock:
+            entry = self._entries.get(path)
+            if not entry or entry["key"] != key:
+                entry = self._entries[path] = {"key": key, "hashes": {}}
+            entry["hashes"][algorithm] = digest
+            self._dirty = True
+
+    def _compute(self, path, key, algorithm):
+        digest = hash_file(path, algorithm)
+        # The file changed while it was read: do not cache a hash of a mix
+        if _file_key(path) == key:
+            self._store(path, key, algorithm, digest)
+        return digest
+
+    def hash(self, path, algorithm="sha256"):
+        path = os.path.abspath(path)
+        key = _file_key(path)
+        return self._lookup(path, key, algorithm) or self._compute(path, key, algorithm)
+
+    def hash_many(self, paths, algorithm="sha256"):
+        """Returns {path: hex digest} for existing files; misses are hashed in parallel."""
+        results = {}
+        misses = []
+        for path in paths:
+            full_path = os.path.abspath(path)
+            try:
+                key = _file_key(full_path)
+            except OSError:
+                continue
+            digest = self._lookup(full_path, key, algorithm)
+            if digest is None:
+                misses.append((path, full_path, key))
+            else:
+                results[path] = digest
+
+        if len(misses) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                digests = pool.map(lambda m: self._compute(m[1], m[2], algorithm), misses)
+                for (path, _, _), digest in zip(misses, digests):
+                    results[path] = digest
+        else:
+            for path, full_path, key in misses:
+                results[path] = self._compute(full_path, key, algorithm)
+        return results
+
+    def prune(self):
+        """Drops entries for files that no longer exist."""
+        with self._lock:
+            for path in [p for p in self._entries if not os.path.exists(p)]:
+                del self._entries[path]
+                self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_cache():
+    """The process-wide cache both uploaders use by default."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = FileHashCache()
+        return _shared
@@ -0,0 +1,239 @@
+# SAFI LAB - Background git sync worker (debounced commit + push)
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from metrics import phase
+
+DEFAULT_WINDOWS_GIT = r"C:\Program Files\Git\cmd\git.exe"
+
+
+def find_git():
+    """Resolves the git binary once. Returns its path or None."""
+    path = shutil.which("git")
+    if path: return path
+    if os.path.exists(DEFAULT_WINDOWS_GIT): return DEFAULT_WINDOWS_GIT
+    return None
+
+
+class GitSyncWorker:
+    """
+    Commits and pushes report changes in the background.
+
+    request() returns immediately. Requests that arrive within `debounce`
+    seconds of each other are folded into one commit and one push (at most
+    `max_wait` seconds after the first). A failed push is retried with
+    exponential backoff. `on_state(status)` is called whenever the state
+    changes, so the UI can show "pending N changes / last pushed at".
+    """
+
+    def __init__(self, repo_dir, remote="origin", branch="master", debounce=5.0, max_wait=30.0,
+                 max_retries=5, retry_delay=2.0, git_cmd=None, on_state=None):
+        self.repo_dir = repo_dir
+        self.remote = remote
+        self.branch = branch
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.git_cmd = git_cmd or find_git()
+        self.on_state = on_state
+        self._cond = threading.Condition()
+        self._requests = []       # (message, paths or None) not committed yet
+        self._unpushed = 0        # requests committed but not pushed
+        self._first_at = None
+        self._last_at = None
+        self._flush_requested = False
+        self._closed = False
+        self._state = "idle"
+        self._failures = 0
+        self._retry_at = None
+        self._gave_up = False
+        self.last_pushed_at = None
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="git-sync", daemon=True)
+        self._thread.start()
+
+    # --- Public ---
+    def request(self, message, paths=None):
+        """Queues a change for commit + push. `paths=None` stages everything."""
+        if not self.git_cmd:
+            return False, "Git not installed - Local only"
+        with self._cond:
+            now = time.monotonic()
+            self._requests.append((message, list(paths) if paths is not None else None))
+            if self._first_at is None: self._first_at = now
+            self._last_at = now
+            self._gave_up = False
+            self._set_state("pending")
+            self._cond.notify_all()
+        return True, "Queued for sync"
+
+    def flush(self, timeout=None):
+        """Syncs now and waits until nothing is pending. Returns False on timeout or error."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._retry_at = None
+            self._gave_up = False
+            self._cond.notify_all()
+            while self._requests or self._unpushed:
+                if self._gave_up: return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: return False
+                self._cond.wait(remaining)
+            return True
+
+    def status(self):
+        with self._cond:
+            return self._status()
+
+    def close(self, timeout=60):
+        """Pushes what is pending (without waiting for backoff) and stops the worker."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # --- Internals ---
+    def _status(self):
+        return {
+            "state": self._state,
+            "pending": len(self._requests) + self._unpushed,
+            "last_pushed_at": self.last_pushed_at,
+            "last_error": self.last_error,
+            "git": self.git_cmd,
+        }
+
+    def _set_state(self, state):
+        self._state = state
+        if self.on_state:
+            # Report from a separate thread so a slow UI never holds up the worker
+            threading.Thread(target=self._report, args=(self._status(),), daemon=True).start()
+
+    def _report(self, status):
+        try:
+            self.on_state(status)
+        except Exception as e:
+            print(f"Sync State Callback Error: {e}")
+
+    def _git(self, *args):
+        # Untranslated output, so "nothing to commit" can be recognized
+        return subprocess.run([self.git_cmd] + list(args), cwd=self.repo_dir,
+                              capture_output=True, text=True, env={**os.environ, "LC_ALL": "C"})
+
+    def _commit(self, requests):
+        with phase("git.commit"):
+            self._commit_requests(requests)
+
+    def _commit_requests(self, requests):
+        if any(paths is None for _, paths in requests):
+            add = self._git("add", "-A")
+        else:
+            paths = self._stageable(sorted({p for _, ps in requests for p in ps}))
+            add = self._git("add", "-A", "--", *paths) if paths else None
+        if add is not None and add.returncode != 0:
+            raise RuntimeError(add.stderr.strip() or "git add failed")
+
+        messages = [message for message, _ in requests]
+        message = messages[0] if len(messages) == 1 else \
+            f"{messages[0]} (+{len(messages) - 1} more)\n\n" + "\n".join(f"- {m}" for m in messages)
+        commit = self._git("commit", "-m", message)
+        if commit.returncode == 0: return
+        # returncode 1 with "nothing to commit" is fine; anything else (no user.name, a hook said no) is not
+        output = commit.stdout + commit.stderr
+        if commit.returncode == 1 and ("nothing to commit" in output or "nothing added to commit" in output):
+            return
+        raise RuntimeError(commit.stderr.strip() or commit.stdout.strip() or "git commit failed")
+
+    def _stageable(self, paths):
+        """
+        Drops paths that neither exist nor are tracked (e.g. a report folder
+        generated and deleted before it was ever committed): git add would
+        fail on them with "pathspec did not match" on every retry.
+        """
+        kept = []
+        for path in paths:
+            if os.path.exists(os.path.join(self.repo_dir, path)) or \
+                    self._git("ls-files", "--error-unmatch", "--", path).returncode == 0:
+                kept.append(path)
+        return kept
+
+    def _push(self):
+        with phase("git.push"):
+            result = self._git("push", "-u", self.remote, self.branch)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or "git push failed")
+
+    def _wait_until_due(self):
+        # Debounce: wait for a quiet period, but never longer than max_wait after the first request
+        while not (self._closed or self._flush_requested):
+            if self._retry_at is not None:
+                due = self._retry_at
+            elif self._first_at is not None:
+                due = min(self._last_at + self.debounce, self._first_at + self.max_wait)
+            else:
+                return
+            now = time.monotonic()
+            if now >= due: return
+            self._cond.wait(due - now)
+
+    def _has_work(self):
+        return bool(self._requests or self._unpushed) and not self._gave_up
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while not self._has_work() and not self._closed:
+                    self._cond.wait()
+                if not self._has_work():
+                    return
+                self._wait_until_due()
+
+                requests, self._requests = self._requests, []
+                self._first_at = self._last_at = None
+                self._flush_requested = False
+                self._set_state("syncing")
+                self._cond.release()
+                error = None
+                committed = False
+                try:
+                    if requests: self._commit(requests)
+                    committed = True
+                    self._push()
+                except Exception as e:
+                    error = e
+                finally:
+                    self._cond.acquire()
+
+                if committed:
+                    self._unpushed += len(requests)
+                else:
+                    # Could not stage/commit: keep the requests for the next attempt
+                    self._requests = requests + self._requests
+
+                if error is None:
+                    self._unpushed = 0
+                    self._failures = 0
+                    self._retry_at = None
+                    self.last_pushed_at = time.strftime('%Y-%m-%d %H:%M:%S')
+                    self.last_error = None
+                    if self._requests:
+                        self._first_at = self._last_at = time.monotonic()
+                    self._set_state("pending" if self._requests else "idle")
+                else:
+                    print(f"Git Sync Error: {error}")
+                    self.last_error = str(error)
+                    self._failures += 1
+                    if self._failures > self.max_retries or (self._closed and self._failures >= 2):
+                        # Give up until the next request or flush
+                        self._failures = 0
+                        self._retry_at = None
+                        self._gave_up = True
+                        self._set_state("error")
+                    else:
+                        self._retry_at = time.monotonic() + self.retry_delay * (2 ** (self._failures - 1))
+                        self._set_state("pending")
+                self._cond.notify_all()
@@ -0,0 +1,159 @@
+# SAFI LAB - Background jobs (report generation) with progress and cancellation
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = {DONE, FAILED, CANCELLED}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    One unit of background work. The job function receives the Job and
+    reports through update(stage, progress); it should call
+    check_cancelled() between steps so cancel() can stop it.
+    """
+
+    def __init__(self, manager, job_id, kind, label):
+        self._manager = manager
+        self.id = job_id
+        self.kind = kind
+        self.label = label
+        self.state = QUEUED
+        self.stage = ""
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._future = None
+        self._last_notify = 0.0
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled("Job cancelled")
+
+    def update(self, stage=None, progress=None, message=None):
+        """Reports progress; stage changes are pushed at once, progress at most every 0.2 s."""
+        stage_changed = stage is not None and stage != self.stage
+        if stage is not None: self.stage = stage
+        if progress is not None: self.progress = max(0.0, min(1.0, progress))
+        if message is not None: self.message = message
+        now = time.monotonic()
+        if stage_changed or now - self._last_notify >= 0.2:
+            self._last_notify = now
+            self._manager._notify(self)
+
+    def to_dict(self):
+        return {
+            "id": self.id, "kind": self.kind, "label": self.label, "state": self.state,
+            "stage": self.stage, "progress": round(self.progress, 3), "message": self.message,
+            "result": self.result, "created_at": self.created_at,
+            "started_at": self.started_at, "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool. submit() returns a job id at once;
+    `on_update(job_dict)` is called on every state/stage change (and
+    throttled progress). Only the last `keep` finished jobs are remembered.
+    """
+
+    def __init__(self, workers=2, on_update=None, keep=100):
+        self.on_update = on_update
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def submit(self, kind, fn, label=""):
+        """Queues fn(job) and returns the job id. fn's return value becomes job.result."""
+        with self._lock:
+            job = Job(self, f"{kind}-{next(self._ids)}", kind, label)
+            self._jobs[job.id] = job
+            self._trim()
+        self._notify(job)
+        job._future = self._pool.submit(self._run, job, fn)
+        return job.id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job.to_dict() if job else None
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in jobs]
+
+    def cancel(self, job_id):
+        """Cancels a queued job now, or asks a running one to stop. Returns False if unknown or finished."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.state in FINISHED:
+            return False
+        job._cancel.set()
+        if job._future is not None and job._future.cancel():
+            # Never started
+            self._finish(job, CANCELLED, "Cancelled")
+        return True
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            if job.state not in FINISHED: job._cancel.set()
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+    # --- Internals ---
+    def _run(self, job, fn):
+        if job.cancel_requested:
+            return self._finish(job, CANCELLED, "Cancelled")
+        job.state = RUNNING
+        job.started_at = time.time()
+        self._notify(job)
+        try:
+            job.result = fn(job)
+            job.check_cancelled()
+            job.progress = 1.0
+            self._finish(job, DONE, job.message or "Done")
+        except JobCancelled:
+            self._finish(job, CANCELLED, "Cancelled")
+        except Exception as e:
+            print(f"Job Error ({job.id}): {e}")
+            self._finish(job, FAILED, str(e))
+
+    def _finish(self, job, state, message):
+        job.state = state
+        job.message = message
+        job.finished_at = time.time()
+        if job.started_at is not None:
+            METRICS.record(f"job.{job.kind}", (job.finished_at - job.started_at) * 1000, error=state == FAILED)
+        self._notify(job)
+
+    def _notify(self, job):
+        if not self.on_update: return
+        try:
+            self.on_update(job.to_dict())
+        except Exception as e:
+            print(f"Job Update Callback Error: {e}")
+
+    def _trim(self):
+        finished = [j for j in self._jobs.values() if j.state in FINISHED]
+        for job in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job.id]
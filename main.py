@@ -1,21 +1,36 @@
 # SAFI LAB - Modern Manager (PyWebView Edition)
+import time
+START_TIME = time.perf_counter()   # the startup report counts from here
+
 import os
 import sys
 import json
-import unicodedata
 import re
 import webbrowser
-import pythoncom
-import win32com.client
-import webview
 import threading
-import base64
 import shutil
 from datetime import datetime
 
 from urllib.parse import quote
-from openpyxl import load_workbook
-import qrcode
+
+from patients import FIELD_COLUMNS, is_yes, normalize_id
+from patient_store import (DrawingsWouldBeLost, ExcelPatientStore, SQLitePatientStore,
+                           apply_workbook_updates, apply_workbook_updates_com,
+                           export_workbook, workbook_records)
+from patient_import import import_patients
+from write_queue import WriteBehindQueue
+from jobs import JobManager
+from report_renderer import make_safe_filename
+from report_batch import build_report_files, generate_reports, report_url
+from report_export import export_name, export_reports, select_patients
+from qr_cache import QRCache
+from search_index import SearchIndex
+from change_feed import ChangeFeed, WorkbookWatcher
+from git_sync import GitSyncWorker
+from workbook_snapshots import SnapshotStore, SnapshotWorker
+from metrics import METRICS, StartupTimer, instrument, phase
+
+STARTUP = StartupTimer(START_TIME)
 
 # ========================= GPU FIX =========================
 # Disable GPU acceleration to prevent GL context errors
@@ -25,10 +40,32 @@ os.environ["QT_WEBENGINE_CHROMIUM_FLAGS"] = "--disable-gpu --disable-software-ra
 EXCEL_FILE      = os.path.abspath("Patients.xlsm")
 SHEET_NAME      = "Patients"
 OUTPUT_ROOT     = os.path.abspath("QR_Patients")
+EXPORT_ROOT     = os.path.abspath("Exports")   # report bundles from export_reports
 DOMAIN_HOST     = "safi-lab-new.vercel.app"
 LAST_UPDATE_COL_INDEX = 18 
-
-import subprocess
+DB_FILE         = os.path.abspath("Patients.db")
+STORE_BACKEND   = "sqlite"   # "sqlite" (primary) or "excel" (legacy COM writes)
+WORKBOOK_FLUSH_DELAY   = 2.0    # seconds before queued workbook writes are saved
+WORKBOOK_FLUSH_TIMEOUT = 120.0
+WORKBOOK_WATCH_INTERVAL = 1.0   # seconds between checks for outside edits to the workbook
+WORKBOOK_RELOAD_FLUSH_TIMEOUT = 10.0   # wait for our own queued writes before re-reading an edited workbook
+WORKBOOK_ALLOW_DRAWING_LOSS = False   # let openpyxl (no Excel) save a workbook with drawings, which removes them
+REPORT_WORKERS  = 4    # processes used by generate_reports
+REPORT_JOB_WORKERS = 2   # report jobs that run at the same time
+QUERY_MAX_LIMIT = 1000   # largest page query_patients returns
+QR_CACHE_ENTRIES = 512
+QR_CACHE_BYTES   = 4 * 1024 * 1024
+GIT_BRANCH      = "master"
+GIT_DEBOUNCE    = 5.0    # seconds of quiet before pending report changes are committed
+GIT_FLUSH_TIMEOUT = 60.0
+BACKUP_DIR      = os.path.abspath("Backups")   # workbook snapshots (python workbook_snapshots.py list|restore)
+BACKUP_INTERVAL = 3600.0   # seconds between snapshots while the app runs
+BACKUP_RECENT   = 10       # newest snapshots always kept, plus the newest...
+BACKUP_HOURLY   = 24       # ...for each of the last N hours...
+BACKUP_DAILY    = 30       # ...and for each of the last N days
+METRICS_FILE    = os.path.abspath("metrics.log")   # JSON lines, one per timed call/phase
+METRICS_FILE_BYTES   = 1024 * 1024   # rotated at this size
+METRICS_FILE_BACKUPS = 3
 
 # =================================================================
  
@@ -37,285 +74,328 @@ import subprocess
 class SafiLabAPI:
     def __init__(self):
         self._window = None
+        self._qr_cache = QRCache(max_entries=QR_CACHE_ENTRIES, max_bytes=QR_CACHE_BYTES)
+        self._jobs = JobManager(workers=REPORT_JOB_WORKERS, on_update=self._on_job_update)
+        self._git_sync = GitSyncWorker(os.getcwd(), branch=GIT_BRANCH, debounce=GIT_DEBOUNCE,
+                                       on_state=self._on_sync_state)
+        self._store = self._create_store()
+        warm_up = self._store.warm_up()
+        self._search = SearchIndex()
+        # Row deltas pushed to the table (our writes + outside edits to the workbook)
+        self._feed = ChangeFeed(self._publish_changes)
+        # Held from a store write to its index update and workbook queue entry, from an index
+        # build's snapshot to its rebuild, and while a re-read sheet replaces the store: a save
+        # meanwhile is either in the snapshot / pending entries or applied after them.
+        # Never held while publishing to the UI (see _publish_row)
+        self._index_lock = threading.Lock()
+        # Keeps the table's deltas in store order: a full reload's list never lands after a newer row
+        self._feed_lock = threading.Lock()
+        threading.Thread(target=self._build_indexes, args=(warm_up,), name="patient-indexes",
+                         daemon=True).start()
+        # SQLite is the primary store; the workbook is mirrored through a write-behind queue
+        self._workbook_writes = None
+        if isinstance(self._store, SQLitePatientStore):
+            self._workbook_writes = WriteBehindQueue(self._write_workbook, delay=WORKBOOK_FLUSH_DELAY,
+                                                     refusals=(DrawingsWouldBeLost,))
+        # Our workbook writes and snapshots never overlap
+        self._workbook_io = threading.Lock()
+        # openpyxl saves remove the workbook's drawings: refused until the user accepts it (backup first)
+        self._drawing_loss_allowed = WORKBOOK_ALLOW_DRAWING_LOSS
+        self._drawings_backed_up = False
+        self._drawings_warned = False
+        self._snapshots = SnapshotWorker(SnapshotStore(BACKUP_DIR, recent=BACKUP_RECENT, hourly=BACKUP_HOURLY,
+                                                       daily=BACKUP_DAILY),
+                                         EXCEL_FILE, interval=BACKUP_INTERVAL, lock=self._workbook_io,
+                                         on_done=lambda: STARTUP.mark("backup")).start()
+        self._watcher = WorkbookWatcher(EXCEL_FILE, self._on_workbook_changed,
+                                        interval=WORKBOOK_WATCH_INTERVAL).start()
+
+    def _create_store(self):
+        if STORE_BACKEND == "excel":
+            return ExcelPatientStore(EXCEL_FILE, SHEET_NAME)
+        return SQLitePatientStore(DB_FILE, seed_workbook=EXCEL_FILE, sheet_name=SHEET_NAME)
 
     def set_window(self, window):
         self._window = window
 
     # --- Data Methods ---
     def get_patients(self):
-        """Reads Excel and returns list of patients as JSON."""
+        """Returns list of patients as JSON."""
         try:
-            wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
-            ws = wb[SHEET_NAME]
-            patients = []
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row[0] is None: continue
-                
-                p_id = str(row[0]).strip()
-                p_name = str(row[1]) if row[1] is not None else ""
-                p_age = str(row[2]) if row[2] is not None else ""
-                p_gender = str(row[3]) if row[3] is not None else ""
-                # Use Last Modified from Col 19 (index 18)
-                p_date = str(row[18]) if len(row) > 18 and row[18] is not None else ""
-                
-                patients.append({
-                    "id": p_id, "name": p_name, "age": p_age, 
-                    "gender": p_gender, "date": p_date
-                })
-            wb.close()
-            return json.dumps(patients)
+            return json.dumps([self._list_row(record) for record in self._store.all()])
         except Exception as e:
             print(f"Error reading Excel: {e}")
             return json.dumps([])
 
+    def query_patients(self, offset=0, limit=100, sort="", filter=""):
+        """
+        Returns one page of the patient list as JSON:
+        {"rows": [...], "total": <matching patients>, "offset": offset}.
+        `sort` is a field name ("-" prefix for descending). `filter` is searched
+        in name, id, phone, clinic and doctor; without `sort` matches are ranked.
+        """
+        try:
+            limit = max(0, min(int(limit), QUERY_MAX_LIMIT))
+            if filter and filter.strip() and self._search.ready:
+                # Ranked, Unicode-aware search (name, id, phone, clinic, doctor)
+                records, total = self._search.search(filter, int(offset), limit, sort)
+            else:
+                records, total = self._store.query(int(offset), limit, sort, filter)
+            return json.dumps({"rows": [self._list_row(r) for r in records], "total": total, "offset": int(offset)})
+        except Exception as e:
+            print(f"Error querying patients: {e}")
+            return json.dumps({"rows": [], "total": 0, "offset": 0})
+
     def get_patient_details(self, pid):
         """Returns full details for a single patient."""
         try:
-            wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
-            ws = wb[SHEET_NAME]
-            data = {}
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row[0] is None: continue
-                if str(row[0]).strip() == str(pid):
-                    data = {
-                        "id": str(row[0]), 
-                        "name": str(row[1]) if row[1] else "",
-                        "age": str(row[2]) if row[2] else "", 
-                        "gender": str(row[3]) if row[3] else "",
-                        "clinic": str(row[4]) if len(row) > 4 and row[4] else "", 
-                        "doctor": str(row[5]) if len(row) > 5 and row[5] else "",
-                        "date": str(row[6]) if len(row) > 6 and row[6] else "", 
-                        "phone": str(row[7]) if len(row) > 7 and row[7] else "",
-                        "email": str(row[8]) if len(row) > 8 and row[8] else "",
-                        "abs": str(row[9]) if len(row) > 9 and row[9] else "", 
-                        "conc": str(row[10]) if len(row) > 10 and row[10] else "", 
-                        "trans": str(row[11]) if len(row) > 11 and row[11] else "",
-                        "last_modified": str(row[18]) if len(row) > 18 and row[18] else ""
-                    }
-                    break
+            record = self._store.get(pid)
+            if record is None:
+                return json.dumps({})
+
+            data = {key: record[key] for key in (
+                "id", "name", "age", "gender", "clinic", "doctor", "date",
+                "phone", "email", "abs", "conc", "trans", "last_modified")}
+
             # Check if report exists
             folder_name = self._get_safe_filename(f"{data.get('name')}_{pid}")
             report_path = os.path.join(OUTPUT_ROOT, folder_name, f"patient_{pid}.html")
             is_generated = os.path.exists(report_path)
 
-            # Read Status Columns (16=P, 17=Q) - Adjusting for 0-based index if using iter_rows, but here we used values_only
-            # Wait, iter_rows returns tuple. 
-            # Row structure: 0=ID, 1=Name, ..., 15=ReportLink(O), 16=QR(P), 17=SendReport(Q) ?? 
-            # Let's check debug output from before:
-            # Row 1: ('ID', 'Name', ..., 'Report Link', 'QR Code', 'Send Report')
-            # So 15 is Report Link, 16 is QR Code, 17 is Send Report?
-            # The user wants Emailed and WhatsApp. Let's use Col 16 (index 15) for Emailed and Col 17 (index 16) for WhatsApp if they are free or repurpose.
-            # Actually, let's stick to the plan: Read specific columns.
-            # Let's assume:
-            # Col 15 (O) = Emailed
-            # Col 16 (P) = WhatsApp
-            # We need to be careful with indices.
-            
-            # Let's look at the row length.
-            emailed = "No"
-            whatsapp = "No"
-            if len(row) > 15 and row[15]: emailed = str(row[15])
-            if len(row) > 16 and row[16]: whatsapp = str(row[16])
-
+            # Status columns: P (index 15) = Emailed, Q (index 16) = WhatsApp
             data["status"] = {
                 "saved": True, # If we found it, it's saved
                 "generated": is_generated,
-                "emailed": emailed.lower() in ['yes', 'true', '1'],
-                "whatsapp": whatsapp.lower() in ['yes', 'true', '1']
+                "emailed": is_yes(record["emailed"]),
+                "whatsapp": is_yes(record["whatsapp"])
             }
-            
-            wb.close()
             return json.dumps(data)
         except Exception as e:
             print(f"Error details: {e}")
             return json.dumps({})
 
     def save_patient(self, data_json):
-        """Saves or updates patient data in Excel."""
+        """Saves or updates patient data in the patient store."""
         try:
             data = json.loads(data_json)
             target_id = data.get('id')
             if not target_id: return False
 
             current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            pythoncom.CoInitialize()
-            xl = win32com.client.Dispatch("Excel.Application")
-            xl.Visible = False
-            xl.DisplayAlerts = False
-            wb = xl.Workbooks.Open(EXCEL_FILE)
-            ws = wb.Worksheets(SHEET_NAME)
-
-            last_row = ws.Cells(ws.Rows.Count, 1).End(-4162).Row
-            found_row = self._find_row_by_id_com(ws, target_id)
-
-            if found_row == 0:
-                found_row = last_row + 1
-
-            # Write Data
-            ws.Cells(found_row, 1).Value = target_id
-            ws.Cells(found_row, 2).Value = data.get('name', '')
-            ws.Cells(found_row, 3).Value = data.get('age', '')
-            ws.Cells(found_row, 4).Value = data.get('gender', '')
-            ws.Cells(found_row, 5).Value = data.get('clinic', '')
-            ws.Cells(found_row, 6).Value = data.get('doctor', '')
-            ws.Cells(found_row, 7).Value = current_timestamp
-            ws.Cells(found_row, 8).Value = data.get('phone', '')
-            ws.Cells(found_row, 9).Value = data.get('email', '')
-            ws.Cells(found_row, 10).Value = data.get('abs', '')
-            ws.Cells(found_row, 11).Value = data.get('conc', '')
-            ws.Cells(found_row, 12).Value = data.get('trans', '')
-            ws.Cells(found_row, 19).Value = current_timestamp
-
-            wb.Save()
-            wb.Close()
-            xl.Quit()
+            record = {key: data.get(key, '') for key in (
+                "name", "age", "gender", "clinic", "doctor",
+                "phone", "email", "abs", "conc", "trans")}
+            record["id"] = str(target_id).strip()
+            record["date"] = current_timestamp
+            record["last_modified"] = current_timestamp
+
+            with self._index_lock:
+                saved = self._store.upsert(record)
+                self._search.add(saved)
+                self._queue_workbook_row(saved)
+            self._publish_row(saved["id"])
+            # Name or id may have changed the report URL
+            self._qr_cache.invalidate_patient(record["id"])
             return True
         except Exception as e:
             print(f"Save Error: {e}")
             return False
-        finally:
-            pythoncom.CoUninitialize()
 
     def delete_patient(self, pid):
-        """Deletes a patient from Excel."""
+        """Deletes a patient from the patient store."""
         try:
-            pythoncom.CoInitialize()
-            xl = win32com.client.Dispatch("Excel.Application")
-            xl.Visible = False
-            xl.DisplayAlerts = False
-            wb = xl.Workbooks.Open(EXCEL_FILE)
-            ws = wb.Worksheets(SHEET_NAME)
-
-            found_row = self._find_row_by_id_com(ws, pid)
-            if found_row >= 2:
-                ws.Rows(found_row).Delete()
-                wb.Save()
-                wb.Close()
-                xl.Quit()
+            with self._index_lock:
+                if not self._store.delete(pid):
+                    return False
+                self._search.remove(pid)
+                if self._workbook_writes:
+                    self._workbook_writes.delete_row(pid)
+            self._publish_row(pid)
+            self._qr_cache.invalidate_patient(pid)
+
+            # --- Delete Local Folder ---
+            target_folder = None
+            try:
+                # Find folder ending with _pid
+                for item in os.listdir(OUTPUT_ROOT):
+                    if item.endswith(f"_{pid}") and os.path.isdir(os.path.join(OUTPUT_ROOT, item)):
+                        target_folder = item
+                        break
                 
-                # --- Delete Local Folder ---
-                try:
-                    # Find folder ending with _pid
-                    target_folder = None
-                    for item in os.listdir(OUTPUT_ROOT):
-                        if item.endswith(f"_{pid}") and os.path.isdir(os.path.join(OUTPUT_ROOT, item)):
-                            target_folder = item
-                            break
-                    
-                    if target_folder:
-                        folder_path = os.path.join(OUTPUT_ROOT, target_folder)
-                        shutil.rmtree(folder_path)
-                        print(f"Deleted folder: {folder_path}")
-                except Exception as e:
-                    print(f"Error deleting folder: {e}")
-
-                return True
-            else:
+                if target_folder:
+                    folder_path = os.path.join(OUTPUT_ROOT, target_folder)
+                    shutil.rmtree(folder_path)
+                    print(f"Deleted folder: {folder_path}")
+            except Exception as e:
+                print(f"Error deleting folder: {e}")
 
-                wb.Close()
-                xl.Quit()
-                return False
+            # Sync the removed folder with GitHub in the background
+            if target_folder:
+                self._git_sync.request(f"Delete patient {pid}", [os.path.join(OUTPUT_ROOT, target_folder)])
+            return True
         except Exception as e:
             print(f"Delete Error: {e}")
             return False
-        finally:
-            pythoncom.CoUninitialize()
-            # Sync with GitHub after deletion
-            try:
-                print("Syncing deletion with GitHub...")
-                self._git_push(f"Delete patient {pid}")
-            except Exception as e:
-                print(f"Git Sync Error: {e}")
+
+    # --- Excel Sync ---
+    def sync_from_excel(self):
+        """Imports Patients.xlsm into the patient store."""
+        if not isinstance(self._store, SQLitePatientStore):
+            return json.dumps({"success": True, "message": "Excel is the active store"})
+        try:
+            count = self._import_workbook()
+            self._reload_indexes()
+            return json.dumps({"success": True, "message": f"Imported {count} patients from Excel"})
+        except Exception as e:
+            print(f"Excel Import Error: {e}")
+            return json.dumps({"success": False, "message": str(e)})
+
+    def sync_to_excel(self):
+        """Exports the patient store back into Patients.xlsm."""
+        if not isinstance(self._store, SQLitePatientStore):
+            return json.dumps({"success": True, "message": "Excel is the active store"})
+        try:
+            self._flush_workbook()
+            with self._workbook_io:
+                count = export_workbook(self._store, EXCEL_FILE, SHEET_NAME,
+                                        allow_drawing_loss=self._may_drop_drawings())
+            self._watcher.acknowledge()
+            return json.dumps({"success": True, "message": f"Exported {count} patients to Excel"})
+        except DrawingsWouldBeLost as e:
+            self._warn_drawing_loss(str(e), once=False)
+            return json.dumps({"success": False, "message": str(e)})
+        except Exception as e:
+            print(f"Excel Export Error: {e}")
+            return json.dumps({"success": False, "message": str(e)})
+
+    def import_patients(self, path=""):
+        """Imports patients from a CSV/XLSX file (asks for one if no path), matched on patient ID."""
+        try:
+            if not path:
+                import webview
+                if not self._window:
+                    return json.dumps({"success": False, "message": "No window to pick a file from"})
+                picked = self._window.create_file_dialog(
+                    webview.OPEN_DIALOG, file_types=("Patient lists (*.csv;*.xlsx;*.xlsm)", "All files (*.*)"))
+                if not picked:
+                    return json.dumps({"success": False, "message": "Import cancelled"})
+                path = picked[0]
+
+            # One workbook save for the whole batch (the Excel store saved in upsert_many)
+            with self._index_lock:
+                summary, saved = import_patients(self._store, path)
+                for record in saved:
+                    self._queue_workbook_row(record)
+            for record in saved:
+                self._qr_cache.invalidate_patient(record["id"])
+            flushed = True
+            if saved:
+                flushed = self._flush_workbook()
+                self._reload_indexes()
+            message = (f"Imported {os.path.basename(path)}: {summary['inserted']} new, "
+                       f"{summary['updated']} updated, {summary['skipped']} skipped, "
+                       f"{summary['error_count']} errors")
+            if not flushed:
+                message += f" - not in Patients.xlsm yet: {self._workbook_status()['last_error'] or 'still saving'}"
+            print(message)
+            return json.dumps({"success": True, "message": message, **summary})
+        except Exception as e:
+            print(f"Patient Import Error: {e}")
+            return json.dumps({"success": False, "message": str(e)})
+
+    def flush_workbook(self):
+        """Writes queued workbook updates now and reports whether they are on disk."""
+        flushed = self._flush_workbook()
+        return json.dumps({"success": flushed, **self._workbook_status()})
+
+    def get_workbook_status(self):
+        """Returns the write-behind state: pending rows, durable flag, last flush/error."""
+        return json.dumps(self._workbook_status())
+
+    def get_sync_status(self):
+        """Returns the git sync state: pending changes, last push time, last error."""
+        return json.dumps(self._git_sync.status())
+
+    def sync_now(self):
+        """Commits and pushes pending report changes without waiting for the debounce."""
+        synced = self._git_sync.flush(timeout=GIT_FLUSH_TIMEOUT)
+        return json.dumps({"success": synced, **self._git_sync.status()})
+
+    def _shutdown(self):
+        """Flushes pending workbook writes, takes a last snapshot and syncs git before the app exits."""
+        self._watcher.stop()
+        self._jobs.shutdown(wait=True)
+        if self._workbook_writes:
+            self._workbook_writes.close()
+        self._snapshots.stop(final=True)
+        self._git_sync.close(timeout=GIT_FLUSH_TIMEOUT)
+
+    def startup_ready(self):
+        """Called by the UI once the first page of patients is on screen. Returns the startup report."""
+        STARTUP.mark("first_data")
+        report = STARTUP.report()
+        print("Startup: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in report.items()))
+        return json.dumps(report)
+
+    def get_metrics(self):
+        """
+        Returns latency histograms per API method ("api.*") and internal phase
+        (workbook.*, store.*, report.*, qr.*, git.*, job.*): count, errors,
+        mean/p50/p95/p99/max in ms.
+        """
+        return json.dumps(METRICS.snapshot())
 
     def generate_report(self, pid):
-        """Runs the VBA macro to generate report."""
-        def run_macro():
-            try:
-                pythoncom.CoInitialize()
-                xl = win32com.client.Dispatch("Excel.Application")
-                xl.Visible = False
-                xl.DisplayAlerts = False
-                wb = xl.Workbooks.Open(EXCEL_FILE)
-                xl.Run("Generate_From_Python", pid)
-                wb.Save()
-                wb.Close()
-                xl.Quit()
-                
-                # --- Fix File Structure for Cloudflare & QR Code ---
-                try:
-                    # Find folder
-                    target_folder = None
-                    for item in os.listdir(OUTPUT_ROOT):
-                        if item.endswith(f"_{pid}") and os.path.isdir(os.path.join(OUTPUT_ROOT, item)):
-                            target_folder = item
-                            break
-                    
-                    if target_folder:
-                        folder_path = os.path.join(OUTPUT_ROOT, target_folder)
-                        
-                        # 2. Construct Correct URL
-                        from urllib.parse import quote
-                        safe_folder_url = quote(target_folder)
-                        # Point directly to the HTML file
-                        correct_url = f"https://{DOMAIN_HOST}/QR_Patients/{safe_folder_url}/patient_{pid}.html"
-                        
-                        # 3. Generate QR
-                        qr_img = qrcode.make(correct_url)
-                        qr_filename = f"qr_{pid}.png"
-                        qr_full_path = os.path.join(folder_path, qr_filename)
-                        qr_img.save(qr_full_path)
-                        print(f"Regenerated QR code with URL: {correct_url}")
-
-                except Exception as e:
-                    print(f"Structure/QR Fix Error: {e}")
-
-                # --- Git Push (Vercel Deploy) ---
-                try:
-                    print(f"Syncing to GitHub for Vercel deployment...")
-                    success, msg = self._git_push(f"Update report for patient {pid}")
-                    
-                    if success:
-                        return True, f"Success & Pushed: {msg}"
-                    else:
-                        return True, f"Generated but Push Failed: {msg}"
-                        
-                except Exception as e:
-                    print(f"Push Error: {e}")
-                    return True, f"Generated but Push Error: {e}"
-
-                return True, "Success"
-            except Exception as e:
-                return False, str(e)
-            finally:
-                pythoncom.CoUninitialize()
+        """
+        Queues the patient report (HTML, PDF, QR) as a background job and returns
+        {"success", "job_id"} at once. Progress arrives through onJobUpdate().
+        """
+        pid = str(pid).strip()
+        job_id = self._jobs.submit("report", lambda job: self._build_report(job, pid), label=f"Report {pid}")
+        return json.dumps({"success": True, "job_id": job_id, "message": "Report queued"})
+
+    def generate_reports(self, ids_json="all"):
+        """
+        Queues reports for a list of ids (JSON array) or "all" as one background job
+        (built on a process pool, then synced to git once). Returns {"success", "job_id"}.
+        """
+        job_id = self._jobs.submit("batch", lambda job: self._build_reports(job, ids_json), label="Generate reports")
+        return json.dumps({"success": True, "job_id": job_id, "message": "Report generation queued"})
+
+    def export_reports(self, filter_json="{}"):
+        """
+        Queues a job that bundles the reports of the patients matching
+        {"clinic", "doctor", "date_from", "date_to", "merge_pdf"} into one zip
+        under Exports (plus one merged PDF if asked). Returns {"success", "job_id"}.
+        """
+        try:
+            options = json.loads(filter_json or "{}")
+        except ValueError as e:
+            return json.dumps({"success": False, "message": f"Invalid filter: {e}"})
+        job_id = self._jobs.submit("export", lambda job: self._export_reports(job, options), label="Export reports")
+        return json.dumps({"success": True, "job_id": job_id, "message": "Report export queued"})
+
+    def get_job(self, job_id):
+        """Returns the state of a background job, or {} if unknown."""
+        return json.dumps(self._jobs.get(job_id) or {})
+
+    def get_jobs(self):
+        return json.dumps(self._jobs.list())
 
-        # Run in thread to not block UI (though pywebview might block anyway if not careful)
-        # For simplicity in this structure, we'll run synchronously or use a simple thread wrapper if needed.
-        # Since pywebview calls are async from JS side, we can block here but it freezes UI.
-        # Better to return a promise or just block for now as it's a local operation.
-        success, msg = run_macro()
-        return json.dumps({"success": success, "message": msg})
+    def cancel_job(self, job_id):
+        """Cancels a queued job, or stops a running one at its next step."""
+        if self._jobs.cancel(job_id):
+            return json.dumps({"success": True, "message": "Cancelling"})
+        return json.dumps({"success": False, "message": "Job not found or already finished"})
 
     def get_qr_data(self, name, pid):
         """Returns base64 image of QR code."""
         try:
             folder_name = self._get_safe_filename(f"{name}_{pid}")
             qr_path = os.path.join(OUTPUT_ROOT, folder_name, f"qr_{pid}.png")
-            
-            if os.path.exists(qr_path):
-                with open(qr_path, "rb") as img_file:
-                    b64 = base64.b64encode(img_file.read()).decode('utf-8')
-                    return f"data:image/png;base64,{b64}"
-            
-            # Generate temporary preview
-            url = f"https://{DOMAIN_HOST}/{folder_name}/patient_{pid}.html"
-            qr = qrcode.make(url)
-            from io import BytesIO
-            buffered = BytesIO()
-            qr.save(buffered, format="PNG")
-            b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            return f"data:image/png;base64,{b64}"
+            # Saved report QR if there is one, otherwise a preview of the same URL
+            url = report_url(DOMAIN_HOST, folder_name, pid)
+            return self._qr_cache.get(url, qr_path)
         except Exception as e:
             print(f"QR Error: {e}")
             return None
@@ -337,9 +417,7 @@ class SafiLabAPI:
         webbrowser.open(f"mailto:{email}?subject={quote(subject)}&body={quote(body)}")
         
         # Update Status
-        self._update_cell(pid, 16, "Yes") # Col 16 = P (1-based) -> actually let's verify column mapping.
-        # If row has 15 items (0-14), 15 is P.
-        # Let's use a helper that opens writeable workbook.
+        self._set_status(pid, "emailed") # Col 16 = P
 
     def send_whatsapp(self, pid):
         details = json.loads(self.get_patient_details(pid))
@@ -356,7 +434,7 @@ class SafiLabAPI:
         webbrowser.open(f"https://wa.me/{phone_clean}?text={quote(message)}")
         
         # Update Status
-        self._update_cell(pid, 17, "Yes") # Col 17 = Q
+        self._set_status(pid, "whatsapp") # Col 17 = Q
 
     def open_folder(self, pid):
         details = json.loads(self.get_patient_details(pid))
@@ -388,104 +466,286 @@ class SafiLabAPI:
             return False
 
     # --- Helpers ---
-    def _find_row_by_id_com(self, ws_com, patient_id):
-        target_str = str(patient_id).strip().lower()
-        def normalize(s):
-            s = str(s).strip().lower()
-            if s.endswith(".0"): return s[:-2]
-            return s
-        target_norm = normalize(target_str)
-
-        try:
-            last_row = int(ws_com.Cells(ws_com.Rows.Count, 1).End(-4162).Row)
-        except: return 0
-            
-        for r in range(2, last_row + 1):
-            try:
-                val = ws_com.Cells(r, 1).Value
-                if val is None: continue
-                if normalize(val) == target_norm: return r
-            except: continue
-        return 0
+    def _list_row(self, record):
+        return {
+            "id": record["id"], "name": record["name"], "age": record["age"],
+            # Use Last Modified from Col 19 (index 18)
+            "gender": record["gender"], "date": record["last_modified"]
+        }
 
     def _get_safe_filename(self, text):
         if not text: return "unknown"
-        # Match VBA: badChars = Array("\", "/", ":", "*", "?", """", "<", ">", "|")
-        # VBA does NOT lowercase and does NOT replace spaces.
-        bad_chars = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
-        for char in bad_chars:
-            text = text.replace(char, '_')
-        return text
-
-    def _update_cell(self, pid, col_index, value):
-        """Updates a specific cell for a patient."""
+        # Match VBA MakeSafeFileName: does NOT lowercase and does NOT replace spaces.
+        return make_safe_filename(text)
+
+    def _set_status(self, pid, field):
+        """Marks a status column (emailed / whatsapp) as Yes."""
         try:
-            pythoncom.CoInitialize()
-            xl = win32com.client.Dispatch("Excel.Application")
-            xl.Visible = False
-            xl.DisplayAlerts = False
-            wb = xl.Workbooks.Open(EXCEL_FILE)
-            ws = wb.Worksheets(SHEET_NAME)
-
-            found_row = self._find_row_by_id_com(ws, pid)
-            if found_row >= 2:
-                ws.Cells(found_row, col_index).Value = value
-                wb.Save()
-            
-            wb.Close()
-            xl.Quit()
+            with self._index_lock:
+                if self._store.set_field(pid, field, "Yes") and self._workbook_writes:
+                    self._workbook_writes.set_cell(pid, FIELD_COLUMNS[field], "Yes")
         except Exception as e:
-            print(f"Update Cell Error: {e}")
-        finally:
-            pythoncom.CoUninitialize()
-
-    def _git_push(self, message):
-        """Commits and pushes changes to GitHub."""
+            print(f"Update Status Error: {e}")
+
+    def _queue_workbook_row(self, record):
+        if self._workbook_writes:
+            self._workbook_writes.set_row(record["id"], {
+                FIELD_COLUMNS[key]: value for key, value in record.items() if key != "id"})
+
+    def _flush_workbook(self, timeout=None):
+        if not self._workbook_writes: return True
+        return self._workbook_writes.flush(timeout=timeout or WORKBOOK_FLUSH_TIMEOUT)
+
+    def _import_workbook(self, flush_timeout=None):
+        """
+        Makes the store match Patients.xlsm (rows added, changed or deleted in
+        Excel). Our writes not in the sheet yet (still queued, e.g. Excel has
+        the file locked, or saved while the sheet was read) are newer than the
+        sheet: they are applied on top of its rows, and stay queued for the
+        workbook. Returns the sheet's row count.
+        """
+        self._flush_workbook(flush_timeout)
+        # No write of ours lands between reading the sheet and taking what is still queued,
+        # and no save reaches the store or the queue until the sheet's rows are in
+        with self._workbook_io:
+            records = workbook_records(EXCEL_FILE, SHEET_NAME)
+            if not records:
+                print(f"No patients in {EXCEL_FILE}; store left unchanged")
+                return 0
+            with self._index_lock:
+                pending = self._workbook_writes.pending_entries()
+                rows = {normalize_id(r["id"]): r for r in records}
+                if pending:
+                    print(f"Workbook flush pending, applying {len(pending)} unsaved rows over the sheet")
+                fields = {col: field for field, col in FIELD_COLUMNS.items()}
+                for key, entry in pending.items():
+                    base = None if entry["delete"] else rows.get(key) or self._store.get(entry["pid"])
+                    if entry["delete"] and not entry["cells"]:
+                        rows.pop(key, None)
+                        continue
+                    record = dict(base or {})
+                    record.update({fields[col]: value for col, value in entry["cells"].items() if col in fields})
+                    record["id"] = entry["pid"]
+                    rows[key] = record
+                removed = self._store.replace_all(list(rows.values()))
+        if removed: print(f"Removed {removed} patients no longer in {EXCEL_FILE}")
+        return len(records)
+
+    def _workbook_status(self):
+        if not self._workbook_writes:
+            return {"pending": 0, "durable": True, "last_flush": None, "last_error": None}
+        return self._workbook_writes.status()
+
+    def _write_workbook(self, entries):
+        # COM keeps the sheet's drawings; openpyxl works where Excel is not installed
+        with self._workbook_io, phase("workbook.flush"):
+            if sys.platform == "win32":
+                apply_workbook_updates_com(EXCEL_FILE, SHEET_NAME, entries)
+            else:
+                try:
+                    apply_workbook_updates(EXCEL_FILE, SHEET_NAME, entries,
+                                           allow_drawing_loss=self._may_drop_drawings())
+                except DrawingsWouldBeLost as e:
+                    # Stays queued (and in SQLite) until the user accepts the loss
+                    self._warn_drawing_loss(str(e))
+                    raise
+        self._watcher.acknowledge()
+
+    def _may_drop_drawings(self):
+        # Called with _workbook_io held. The first write that may drop drawings is preceded by a snapshot
+        if not self._drawing_loss_allowed: return False
+        if not self._drawings_backed_up:
+            self._snapshots.store.snapshot(EXCEL_FILE)
+            self._drawings_backed_up = True
+        return True
+
+    def _warn_drawing_loss(self, message, once=True):
+        if once and self._drawings_warned: return
+        self._drawings_warned = True
+        # Asked from its own thread: the writer that got here holds the workbook lock
+        threading.Thread(target=self._confirm_drawing_loss, args=(message,), name="drawing-loss-dialog",
+                         daemon=True).start()
+
+    def _confirm_drawing_loss(self, message):
+        # A native dialog rather than a page callback, so nothing in the page can accept this by itself
+        if not self._window: return
+        try:
+            accepted = self._window.create_confirmation_dialog("Patients.xlsm", (
+                f"{message}.\n\nPatients are still saved in the app, but Patients.xlsm is not being updated. "
+                "Update it anyway? A backup is taken first and the pictures and shapes are removed."))
+        except Exception as e:
+            print(f"UI Dialog Error: {e}")
+            return
+        result = self._allow_drawing_loss() if accepted else {
+            "success": False, "message": "Patients.xlsm not updated (it has drawings)"}
+        self._push_js(f"showToast({json.dumps(result['message'])})")
+
+    def _allow_drawing_loss(self):
+        """Lets saves without Excel rewrite Patients.xlsm although that removes its drawings (backed up first)."""
+        try:
+            with self._workbook_io:
+                self._snapshots.store.snapshot(EXCEL_FILE)
+            self._drawings_backed_up = True
+            self._drawing_loss_allowed = True
+            if self._workbook_writes:
+                self._workbook_writes.flush(wait=False)
+            return {"success": True, "message": "Workbook backed up; saving to Excel again"}
+        except Exception as e:
+            print(f"Workbook Backup Error: {e}")
+            return {"success": False, "message": f"Backup failed, workbook left as is: {e}"}
+
+    def _build_report(self, job, pid):
+        job.update("loading")
+        record = self._store.get(pid)
+        if record is None:
+            raise ValueError(f"Patient ID {pid} not found.")
+
+        def stage(name):
+            job.update(name)
+            job.check_cancelled()
+
+        # --- HTML, QR and PDF (PDF via Word on Windows only) ---
+        result = build_report_files(record, OUTPUT_ROOT, DOMAIN_HOST, make_pdf=sys.platform == "win32",
+                                    progress=stage)
+        result.pop("timings", None)   # built in this process, so already in the metrics
+        job.check_cancelled()
+        if not result["success"]:
+            raise RuntimeError(result["message"])
+        if not result["changed"]:
+            job.message = "Report already up to date"
+            return result
+        self._qr_cache.invalidate_patient(pid)
+
+        # --- Git Push (Vercel Deploy), in the background ---
+        job.update("syncing")
+        queued, msg = self._git_sync.request(f"Update report for patient {pid}", result["changed"])
+        job.message = f"Generated - {msg}"
+        return result
+
+    def _build_reports(self, job, ids_json):
+        job.update("loading")
+        records = self._store.all()
+        if ids_json != "all":
+            wanted = {normalize_id(pid) for pid in json.loads(ids_json)}
+            records = [r for r in records if normalize_id(r["id"]) in wanted]
+
+        def progress(done, total, result):
+            job.update("reports", done / total, f"{done}/{total}")
+
+        results = generate_reports(records, OUTPUT_ROOT, DOMAIN_HOST,
+                                   workers=REPORT_WORKERS, make_pdf=sys.platform == "win32",
+                                   progress=progress, cancelled=lambda: job.cancel_requested)
+        for r in results:
+            if r["changed"]: self._qr_cache.invalidate_patient(r["id"])
+        ok = sum(1 for r in results if r["success"])
+        changed = [path for r in results for path in r["changed"]]
+        job.message = f"Generated {ok}/{len(results)} reports ({len(changed)} files changed)"
+        if changed:
+            # Whatever was built is synced, even if the job was cancelled part way
+            job.update("syncing")
+            queued, sync_msg = self._git_sync.request(f"Update reports for {ok} patients", changed)
+            job.message += f" - {sync_msg}"
+        job.check_cancelled()
+        return {"total": len(results), "generated": ok, "changed": len(changed),
+                "failed": [r["id"] for r in results if not r["success"]]}
+
+    def _export_reports(self, job, options):
+        job.update("selecting")
+        filters = {key: str(options.get(key) or "").strip() for key in ("clinic", "doctor", "date_from", "date_to")}
+        undated = []
+        records = select_patients(self._store.all(), undated=undated, **filters)
+        if not records:
+            message = "No patients match the export filter"
+            if undated: message += f" ({len(undated)} left out, sample date not readable)"
+            raise ValueError(message)
+
+        def progress(done, total):
+            job.update("bundling", done / total, f"{done}/{total}")
+
+        zip_path = os.path.join(EXPORT_ROOT, export_name(**filters))
+        try:
+            result = export_reports(records, OUTPUT_ROOT, zip_path, merge_pdf=bool(options.get("merge_pdf")),
+                                    progress=progress, cancelled=lambda: job.cancel_requested)
+        except InterruptedError:
+            job.check_cancelled()
+            raise
+        job.message = f"Exported {result['patients']}/{len(records)} patients to {os.path.basename(zip_path)}"
+        if result["missing"]:
+            job.message += f" ({len(result['missing'])} without reports)"
+        # Excluded from a date range only because their sample date could not be read
+        result["undated"] = undated
+        if undated:
+            job.message += f" - {len(undated)} left out, sample date not readable"
+        if result.get("pdf_error"):
+            job.message += " - merged PDF failed"
+        return result
+
+    def _on_job_update(self, job):
+        self._push_js(f"onJobUpdate({json.dumps(job)})")
+
+    def _build_indexes(self, warm_up=None):
         try:
-            # Determine git command
-            git_cmd = "git"
+            # A first-run seed from the workbook happens in the warm-up, not under the index lock
+            if warm_up: warm_up.join()
+            with self._index_lock:
+                records = self._store.all()
+                self._search.rebuild(records)
+                self._feed.reset([self._list_row(r) for r in records])
+        except Exception as e:
+            print(f"Index Build Error: {e}")
+
+    def _reload_indexes(self):
+        """Rebuilds the search index and pushes whatever rows changed to the UI."""
+        with phase("index.rebuild"):
+            with self._index_lock:
+                records = self._store.all()
+                self._search.rebuild(records)
+                # Taken before a save can follow, so that save's row is published after this list
+                self._feed_lock.acquire()
             try:
-                subprocess.run(["git", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-            except (FileNotFoundError, subprocess.CalledProcessError):
-                # Try default Windows path
-                default_path = r"C:\Program Files\Git\cmd\git.exe"
-                if os.path.exists(default_path):
-                    git_cmd = default_path
-                else:
-                    print("Git not found. Skipping sync.")
-                    return False, "Git not installed - Local only"
-
-            # 1. Add all changes (including deletions)
-            subprocess.run([git_cmd, "add", "-A"], cwd=os.getcwd(), check=True)
-            
-            # 2. Commit
-            subprocess.run([git_cmd, "commit", "-m", message], cwd=os.getcwd(), check=False)
-            
-            # 3. Push
-            result = subprocess.run([git_cmd, "push", "-u", "origin", "master"], cwd=os.getcwd(), capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                print("Git Push Successful")
-                return True, "Synced to GitHub"
-            else:
-                print(f"Git Push Error: {result.stderr}")
-                return False, f"Push Failed: {result.stderr}"
+                self._feed.update([self._list_row(r) for r in records])
+            finally:
+                self._feed_lock.release()
+
+    def _publish_row(self, pid):
+        """Pushes a patient's current row (or its removal) to the table, outside the index lock."""
+        with self._feed_lock:
+            record = self._store.get(pid)
+            if record: self._feed.upsert(self._list_row(record))
+            else: self._feed.remove(pid)
+
+    def _on_workbook_changed(self):
+        # Patients.xlsm was saved outside the app (e.g. edited in Excel)
+        print("Workbook changed on disk, reloading patients")
+        if isinstance(self._store, SQLitePatientStore):
+            self._import_workbook(flush_timeout=WORKBOOK_RELOAD_FLUSH_TIMEOUT)
+        self._reload_indexes()
+
+    def _publish_changes(self, delta):
+        self._push_js(f"onPatientsChanged({json.dumps(delta)})")
+
+    def _on_sync_state(self, status):
+        self._push_js(f"onSyncStatus({json.dumps(status)})")
+
+    def _push_js(self, script):
+        if not self._window: return
+        try:
+            self._window.evaluate_js(script)
         except Exception as e:
-            print(f"Git Error: {e}")
-            return False, str(e)
+            print(f"UI Push Error: {e}")
+
+# Every public API call is timed as "api.<method>". Public methods are exactly what the page can
+# call, so shutdown and the drawing-loss opt-in stay underscored (neither timed nor exposed)
+instrument(SafiLabAPI, "api.")
 
 if __name__ == '__main__':
-    # --- Auto-Backup ---
-    try:
-        if os.path.exists(EXCEL_FILE):
-            backup_name = "Patients_Backup.xlsm"
-            backup_path = os.path.join(os.path.dirname(EXCEL_FILE), backup_name)
-            shutil.copy2(EXCEL_FILE, backup_path)
-            print(f"Backup created: {backup_path}")
-    except Exception as e:
-        print(f"Backup failed: {e}")
+    STARTUP.mark("imports")
+    METRICS.configure(log_file=METRICS_FILE, max_bytes=METRICS_FILE_BYTES, backups=METRICS_FILE_BACKUPS)
 
+    import webview   # Qt + browser engine, only needed for the window
+    STARTUP.mark("webview")
     api = SafiLabAPI()
+    STARTUP.mark("api")
     window = webview.create_window(
         'SAFI LAB - Modern Manager 2026', 
         'web/index.html', 
@@ -495,4 +755,6 @@ if __name__ == '__main__':
         resizable=True
     )
     api.set_window(window)
+    window.events.loaded += lambda: STARTUP.mark("window")
     webview.start(debug=False, http_port=23456, gui='qt')
+    api._shutdown()
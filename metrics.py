@@ -0,0 +1,192 @@
+# SAFI LAB - Latency metrics: per-call / per-phase histograms and a rotating metrics file
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# Histogram bucket upper bounds in ms (the last one catches everything slower)
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float("inf"))
+
+
+class Histogram:
+    """Fixed-bucket latency histogram with count, error count, mean and max."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms, error=False):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if error: self.errors += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (capped at the max seen)."""
+        if not self.count: return 0.0
+        target = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {("inf" if b == float("inf") else str(b)): n for b, n in zip(BUCKETS_MS, self.buckets) if n},
+        }
+
+
+class Metrics:
+    """
+    Registry of named latency series ("api.save_patient", "workbook.open", ...).
+
+    Use `with phase(name):` around a step, or instrument() on a class to time
+    every public method. With configure(log_file=...) every observation is
+    also appended as a JSON line to a size-rotated file.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._since = time.time()
+        self._logger = None
+
+    def configure(self, log_file=None, max_bytes=1024 * 1024, backups=3):
+        if self._logger:
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+                handler.close()
+            self._logger = None
+        if log_file:
+            logger = logging.getLogger("safilab.metrics")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            self._logger = logger
+
+    def record(self, name, ms, error=False):
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = Histogram()
+            series.observe(ms, error)
+        if self._logger:
+            try:
+                self._logger.info(json.dumps({"t": round(time.time(), 3), "name": name,
+                                              "ms": round(ms, 3), "error": error}))
+            except Exception as e:
+                print(f"Metrics Log Error: {e}")
+
+    @contextmanager
+    def phase(self, name, timings=None):
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            self.record(name, ms, error)
+            if timings is not None: timings.append((name, ms, error))
+
+    def record_all(self, timings):
+        """Records (name, ms, error) observations made elsewhere, e.g. in a worker process."""
+        for name, ms, error in timings:
+            self.record(name, ms, error)
+
+    def snapshot(self):
+        with self._lock:
+            series = {name: h.to_dict() for name, h in sorted(self._series.items())}
+        return {"since": self._since, "buckets_ms": [str(b) for b in BUCKETS_MS], "series": series}
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._since = time.time()
+
+
+METRICS = Metrics()
+
+
+class StartupTimer:
+    """Startup milestones ("imports", "window", "first_data", ...) in ms since `started` (a perf_counter value)."""
+
+    def __init__(self, started, metrics=METRICS):
+        self.started = started
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._marks = {}
+
+    def mark(self, name):
+        """Records the first time `name` is reached; later calls are ignored."""
+        ms = (time.perf_counter() - self.started) * 1000
+        with self._lock:
+            if name in self._marks: return self._marks[name]
+            self._marks[name] = round(ms, 1)
+        self.metrics.record("startup." + name, ms)
+        return ms
+
+    def report(self):
+        with self._lock:
+            return dict(self._marks)
+
+
+def phase(name, timings=None):
+    """
+    Times a block into the shared registry: `with phase("workbook.open"): ...`
+    The observation is also appended to `timings` if given, so a worker
+    process can hand it back to the parent (METRICS.record_all).
+    """
+    return METRICS.phase(name, timings)
+
+
+def _is_failure(result):
+    # API methods report errors by value rather than raising
+    if result is False: return True
+    return isinstance(result, str) and result.startswith('{"success": false')
+
+
+def instrument(cls, prefix, metrics=METRICS):
+    """Wraps every public method of `cls` so each call is timed as <prefix><method>."""
+    for attr, fn in list(vars(cls).items()):
+        if attr.startswith("_") or not callable(fn):
+            continue
+
+        def wrap(fn, name):
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                error = True
+                try:
+                    result = fn(*args, **kwargs)
+                    error = _is_failure(result)
+                    return result
+                finally:
+                    metrics.record(name, (time.perf_counter() - started) * 1000, error)
+            return timed
+
+        setattr(cls, attr, wrap(fn, prefix + attr))
+    return cls
@@ -1,15 +1,98 @@
 import os
 import requests
 import zipfile
-import io
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
 
-def deploy_site(folder_path, site_id, token):
+from file_hash_cache import hash_file, shared_cache
+
+API_BASE = "https://api.netlify.com/api/v1"
+
+# Already-compressed types: deflating them again only burns CPU
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".pdf", ".zip", ".gz", ".woff", ".woff2"}
+COPY_CHUNK = 1024 * 1024
+
+def _iter_files(folder_path):
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            # Archive name should be relative to the root folder
+            # e.g. if folder is QR_Patients, and file is QR_Patients/sub/file.txt
+            # arcname should be sub/file.txt
+            yield file_path, os.path.relpath(file_path, folder_path)
+
+def _read(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+def _add_member(zip_file, file_path, arcname, data=None):
+    """
+    Adds one file through zip_file.open(..., "w"), copied in COPY_CHUNK pieces
+    from `data` if it was already read, else straight from disk.
+    """
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    stored = os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS
+    zinfo.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    with zip_file.open(zinfo, "w", force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dest:
+        if data is not None:
+            for start in range(0, len(data), COPY_CHUNK):
+                dest.write(data[start:start + COPY_CHUNK])
+        else:
+            with open(file_path, "rb") as src:
+                for chunk in iter(lambda: src.read(COPY_CHUNK), b""):
+                    dest.write(chunk)
+
+def build_zip(folder_path, out_file, workers=0):
+    """
+    Writes a zip of `folder_path` into the open binary file `out_file`.
+
+    Already-compressed files (png, pdf, jpg...) are stored as-is; everything
+    else is deflated. Members are written one at a time through ZipFile.open.
+    With workers > 0 the files are read ahead on a thread pool while the
+    previous ones are compressed, keeping at most 2 * workers files in memory.
+    Returns the number of files added.
+    """
+    count = 0
+    with zipfile.ZipFile(out_file, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        pending = []
+
+        def drain(limit):
+            while len(pending) > limit:
+                file_path, arcname, future = pending.pop(0)
+                _add_member(zip_file, file_path, arcname, future.result())
+
+        try:
+            for file_path, arcname in _iter_files(folder_path):
+                count += 1
+                if pool is None:
+                    _add_member(zip_file, file_path, arcname)
+                else:
+                    pending.append((file_path, arcname, pool.submit(_read, file_path)))
+                    drain(workers * 2)
+            drain(0)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+    return count
+
+def deploy_site(folder_path, site_id, token, compress_workers=0, api_base=API_BASE):
     """
     Zips the folder and deploys it to Netlify.
     
+    The archive is built in a temp file on disk and streamed to the API from
+    there, so memory stays flat no matter how many patient folders there are
+    (requests asks the body for a file descriptor, so an in-memory spool
+    would be written out anyway).
+    
     :param folder_path: Path to the folder to deploy (e.g. QR_Patients)
     :param site_id: Netlify Site ID (API ID)
     :param token: Netlify Personal Access Token
+    :param compress_workers: Threads reading files ahead of the zip writer (0 = serial)
+    :param api_base: API root (point it at a local mock server for testing)
     :return: (success, message_or_url)
     """
     if not os.path.exists(folder_path):
@@ -17,44 +100,157 @@ def deploy_site(folder_path, site_id, token):
 
     print(f"Preparing to deploy {folder_path} to Netlify...")
 
-    # 1. Create Zip in Memory
+    with tempfile.NamedTemporaryFile(suffix=".zip") as zip_file:
+        # 1. Create Zip (on disk)
+        try:
+            count = build_zip(folder_path, zip_file, compress_workers)
+            zip_size = zip_file.tell()
+            zip_file.seek(0)
+            print(f"Zipped {count} files, {zip_size} bytes.")
+        except Exception as e:
+            return False, f"Error zipping files: {e}"
+
+        # 2. Upload to Netlify (streamed from the temp file)
+        url = f"{api_base}/sites/{site_id}/deploys"
+        headers = {
+            "Content-Type": "application/zip",
+            "Content-Length": str(zip_size),
+            "Authorization": f"Bearer {token}"
+        }
+
+        try:
+            response = requests.post(url, headers=headers, data=zip_file)
+            
+            if response.status_code == 200:
+                data = response.json()
+                deploy_url = data.get('ssl_url') or data.get('url')
+                # Netlify usually returns the deploy specific URL, but we want the main site URL usually.
+                # However, for verification, the deploy URL is fine. 
+                # Actually, let's return the main site URL if possible, or just the deploy URL.
+                # The 'url' field in response is usually the deploy preview URL (e.g. 64b...--site.netlify.app)
+                # The 'ssl_url' is the main custom domain or netlify subdomain.
+                return True, f"Deployed Successfully! URL: {deploy_url}"
+            else:
+                return False, f"Netlify Error {response.status_code}: {response.text}"
+        except Exception as e:
+            return False, f"Upload Request Error: {e}"
+
+
+def file_sha1(file_path):
+    """SHA1 of a file, as Netlify expects in the digest manifest."""
+    return hash_file(file_path, "sha1")
+
+def _upload_file(session, url, headers, file_path, max_retries, retry_delay):
+    """PUTs one file, retrying with exponential backoff. Returns (bytes sent, retries)."""
+    for attempt in range(max_retries + 1):
+        try:
+            with open(file_path, "rb") as f:
+                response = session.put(url, headers=headers, data=f)
+            if response.status_code == 200:
+                return os.path.getsize(file_path), attempt
+            error = f"HTTP {response.status_code}: {response.text}"
+            # Client errors other than rate limiting will not get better with a retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < max_retries:
+            time.sleep(retry_delay * (2 ** attempt))
+    raise RuntimeError(f"{file_path}: {error}")
+
+def deploy_site_digest(folder_path, site_id, token, workers=8, max_retries=3, retry_delay=1.0,
+                       api_base=API_BASE, stats=None, hash_cache=None):
+    """
+    Deploys the folder to Netlify with a file digest instead of a zip.
+    
+    Sends the manifest (path -> SHA1) first, then uploads only the files
+    Netlify reports as required, on a bounded thread pool sharing one
+    keep-alive session. Each file is retried with backoff on its own.
+    
+    :param folder_path: Path to the folder to deploy (e.g. QR_Patients)
+    :param site_id: Netlify Site ID (API ID)
+    :param token: Netlify Personal Access Token
+    :param workers: Concurrent uploads
+    :param api_base: API root (point it at a local mock server for testing)
+    :param stats: Optional dict filled with files, bytes, requests, retries and seconds
+    :param hash_cache: FileHashCache to use (default: the shared on-disk cache)
+    :return: (success, message_or_url)
+    """
+    if not os.path.exists(folder_path):
+        return False, "Folder not found"
+
+    if stats is None: stats = {}
+    stats.update({"files_total": 0, "files_uploaded": 0, "bytes_total": 0, "bytes_uploaded": 0,
+                  "requests": 0, "retries": 0, "seconds": 0.0})
+    started = time.monotonic()
+
+    # 1. Digest manifest
     try:
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Archive name should be relative to the root folder
-                    # e.g. if folder is QR_Patients, and file is QR_Patients/sub/file.txt
-                    # arcname should be sub/file.txt
-                    arcname = os.path.relpath(file_path, folder_path)
-                    zip_file.write(file_path, arcname)
-        
-        zip_data = zip_buffer.getvalue()
-        print(f"Zipped {len(zip_data)} bytes.")
+        hash_cache = hash_cache or shared_cache()
+        files = list(_iter_files(folder_path))
+        hashes = hash_cache.hash_many([file_path for file_path, _ in files], "sha1")
+        hash_cache.save()
+        digests = {}
+        paths_by_sha = {}
+        for file_path, arcname in files:
+            deploy_path = "/" + arcname.replace(os.sep, "/")
+            sha = hashes[file_path]
+            digests[deploy_path] = sha
+            paths_by_sha.setdefault(sha, (deploy_path, file_path))
+            stats["files_total"] += 1
+            stats["bytes_total"] += os.path.getsize(file_path)
     except Exception as e:
-        return False, f"Error zipping files: {e}"
+        return False, f"Error hashing files: {e}"
 
-    # 2. Upload to Netlify
-    url = f"https://api.netlify.com/api/v1/sites/{site_id}/deploys"
-    headers = {
-        "Content-Type": "application/zip",
-        "Authorization": f"Bearer {token}"
-    }
+    print(f"Deploying {len(digests)} files to Netlify by digest...")
 
+    headers = {"Authorization": f"Bearer {token}"}
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     try:
-        response = requests.post(url, headers=headers, data=zip_data)
-        
-        if response.status_code == 200:
-            data = response.json()
-            deploy_url = data.get('ssl_url') or data.get('url')
-            # Netlify usually returns the deploy specific URL, but we want the main site URL usually.
-            # However, for verification, the deploy URL is fine. 
-            # Actually, let's return the main site URL if possible, or just the deploy URL.
-            # The 'url' field in response is usually the deploy preview URL (e.g. 64b...--site.netlify.app)
-            # The 'ssl_url' is the main custom domain or netlify subdomain.
-            return True, f"Deployed Successfully! URL: {deploy_url}"
-        else:
-            return False, f"Netlify Error {response.status_code}: {response.text}"
-    except Exception as e:
-        return False, f"Upload Request Error: {e}"
+        # 2. Create the deploy; Netlify answers with the SHA1s it does not have yet
+        try:
+            response = session.post(f"{api_base}/sites/{site_id}/deploys", headers=headers, json={"files": digests})
+            stats["requests"] += 1
+            if response.status_code != 200:
+                return False, f"Netlify Error {response.status_code}: {response.text}"
+            deploy = response.json()
+        except Exception as e:
+            return False, f"Upload Request Error: {e}"
+
+        # 3. Upload the required files (one path per distinct SHA1)
+        required = [paths_by_sha[sha] for sha in dict.fromkeys(deploy.get("required") or []) if sha in paths_by_sha]
+        upload_headers = dict(headers, **{"Content-Type": "application/octet-stream"})
+        lock = threading.Lock()
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(_upload_file, session,
+                            f"{api_base}/deploys/{deploy['id']}/files{quote(deploy_path)}",
+                            upload_headers, file_path, max_retries, retry_delay): deploy_path
+                for deploy_path, file_path in required
+            }
+            for future in as_completed(futures):
+                try:
+                    sent, retries = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                with lock:
+                    stats["files_uploaded"] += 1
+                    stats["bytes_uploaded"] += sent
+                    stats["requests"] += retries + 1
+                    stats["retries"] += retries
+    finally:
+        session.close()
+        stats["seconds"] = round(time.monotonic() - started, 3)
+
+    if errors:
+        print(f"Netlify upload errors: {errors}")
+        return False, f"{len(errors)} of {len(required)} files failed to upload: {errors[0]}"
+
+    deploy_url = deploy.get('ssl_url') or deploy.get('url')
+    return True, (f"Deployed Successfully! URL: {deploy_url} "
+                  f"({stats['files_uploaded']} of {stats['files_total']} files uploaded in {stats['seconds']}s)")
@@ -0,0 +1,176 @@
+# SAFI LAB - Bulk patient import from CSV / XLSX (referral clinic spreadsheets)
+import csv
+import os
+import re
+import sys
+from datetime import datetime
+
+from metrics import phase
+from patients import FIELD_COLUMNS, normalize_id
+from sheet_reader import iter_sheet, read_sheet
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Fields an import may set (status columns and last-modified are ours)
+IMPORT_FIELDS = ["id", "name", "age", "gender", "clinic", "doctor", "date",
+                 "phone", "email", "abs", "conc", "trans"]
+# Normalized header text -> field. Our own Patients headers plus common variants.
+HEADER_ALIASES = {
+    "id": "id", "patientid": "id", "patientno": "id", "code": "id", "رقم": "id", "الرقم": "id", "الكود": "id",
+    "name": "name", "patientname": "name", "fullname": "name", "الاسم": "name", "اسم": "name",
+    "age": "age", "العمر": "age", "السن": "age",
+    "gender": "gender", "sex": "gender", "النوع": "gender", "الجنس": "gender",
+    "clinic": "clinic", "centre": "clinic", "center": "clinic", "العيادة": "clinic", "المركز": "clinic",
+    "doctor": "doctor", "dr": "doctor", "referringdoctor": "doctor", "الطبيب": "doctor", "الدكتور": "doctor",
+    "date": "date", "visitdate": "date", "التاريخ": "date",
+    "phone": "phone", "mobile": "phone", "tel": "phone", "telephone": "phone", "whatsapp": "phone",
+    "الهاتف": "phone", "الموبايل": "phone", "التليفون": "phone",
+    "email": "email", "mail": "email", "البريد": "email",
+    "abs": "abs", "absorbance": "abs",
+    "conc": "conc", "concentration": "conc",
+    "trans": "trans", "transmittance": "trans",
+}
+HEADER_SCAN_COLUMNS = 64   # header cells looked at in a spreadsheet
+MAX_REPORTED_ERRORS = 100
+
+
+def _header_key(text):
+    return re.sub(r"[\W_]+", "", str(text or "").strip().lower())
+
+
+def map_header(header):
+    """Returns {column index: field} for the recognised header cells (first match wins)."""
+    columns = {}
+    for index, text in enumerate(header):
+        field = HEADER_ALIASES.get(_header_key(text))
+        if field and field not in columns.values():
+            columns[index] = field
+    if "id" not in columns.values():
+        raise ValueError("No patient ID column found in the header row")
+    return columns
+
+
+def _text(value):
+    if value is None: return ""
+    if isinstance(value, datetime): return value.strftime(TIMESTAMP_FORMAT)
+    return str(value).strip()
+
+
+def _iter_csv(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        columns = None
+        for line, row in enumerate(csv.reader(f, dialect), start=1):
+            if columns is None:
+                if any(cell.strip() for cell in row):
+                    columns = map_header(row)
+                continue
+            yield line, {field: _text(row[i]) for i, field in columns.items() if i < len(row)}
+
+
+def _iter_sheet(path):
+    # First sheet, first row is the header; only the mapped columns are decoded
+    header = next((values for _, values in iter_sheet(path, None, range(HEADER_SCAN_COLUMNS))), None)
+    if header is None: return
+    columns = map_header(header)
+    indexes = sorted(columns)
+    for row, values in read_sheet(path, None, indexes, min_row=2):
+        yield row, {columns[i]: _text(v) for i, v in zip(indexes, values)}
+
+
+def iter_import_rows(path):
+    """Yields (line/row number, {field: text}) from a .csv, .xlsx or .xlsm file."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".csv", ".txt"):
+        return _iter_csv(path)
+    if ext in (".xlsx", ".xlsm"):
+        return _iter_sheet(path)
+    raise ValueError(f"Unsupported file type: {ext or path}")
+
+
+def import_patients(store, path, now=None):
+    """
+    Imports patients from `path` into `store` with one batched upsert.
+
+    Rows are matched on normalize_id(); a later row with the same id fills in
+    over an earlier one. Blank cells keep the existing value. Rows that change
+    nothing are skipped. Returns (summary, saved records) where summary is
+    {"inserted", "updated", "skipped", "errors": [{"row", "message"}], "error_count"}.
+    """
+    now = (now or datetime.now()).strftime(TIMESTAMP_FORMAT)
+    summary = {"inserted": 0, "updated": 0, "skipped": 0, "errors": [], "error_count": 0}
+    batch = {}
+
+    with phase("import.read"):
+        for row, data in iter_import_rows(path):
+            if not any(data.values()): continue
+            if not data.get("id"):
+                summary["error_count"] += 1
+                if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                    summary["errors"].append({"row": row, "message": "Missing patient ID"})
+                continue
+            key = normalize_id(data["id"])
+            if key in batch:
+                # Duplicate in the file: counted once, its non-blank cells win
+                summary["skipped"] += 1
+                batch[key].update({field: value for field, value in data.items() if value and field != "id"})
+            else:
+                batch[key] = data
+
+    changes = []
+    with phase("import.compare"):
+        for data in batch.values():
+            existing = store.get(data["id"])
+            incoming = {field: value for field, value in data.items() if value and field in IMPORT_FIELDS}
+            if existing and all(existing.get(field, "") == value for field, value in incoming.items()
+                                if field != "id"):
+                summary["skipped"] += 1
+                continue
+            record = dict(incoming)
+            record["id"] = existing["id"] if existing else data["id"]
+            if not existing and not record.get("date"):
+                record["date"] = now
+            record["last_modified"] = now
+            changes.append(record)
+            summary["updated" if existing else "inserted"] += 1
+
+    with phase("import.save"):
+        saved = store.upsert_many(changes) if changes else []
+    return summary, saved
+
+
+def workbook_entries(records):
+    """Write-behind style entries ({key: {"pid", "delete", "cells"}}) for apply_workbook_updates."""
+    return {normalize_id(r["id"]): {"pid": r["id"], "delete": False,
+                                    "cells": {FIELD_COLUMNS[k]: v for k, v in r.items() if k != "id"}}
+            for r in records}
+
+
+if __name__ == '__main__':
+    # Usage: python patient_import.py referrals.csv|xlsx [Patients.xlsm] [Patients.db] [--drop-drawings]
+    from patient_store import DrawingsWouldBeLost, SQLitePatientStore, apply_workbook_updates
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args:
+        print("Usage: python patient_import.py <file.csv|file.xlsx> [workbook] [database] [--drop-drawings]")
+        sys.exit(1)
+    excel_path = os.path.abspath(args[1] if len(args) > 1 else "Patients.xlsm")
+    db_path = os.path.abspath(args[2] if len(args) > 2 else "Patients.db")
+    store = SQLitePatientStore(db_path, seed_workbook=excel_path)
+    started = datetime.now()
+    result, saved_records = import_patients(store, os.path.abspath(args[0]))
+    if saved_records:
+        try:
+            # openpyxl removes the workbook's drawings; --drop-drawings accepts that
+            apply_workbook_updates(excel_path, "Patients", workbook_entries(saved_records),
+                                   allow_drawing_loss="--drop-drawings" in sys.argv)
+        except DrawingsWouldBeLost as e:
+            print(f"Workbook not updated (the patients are in {db_path}): {e}")
+    store.close()
+    print(f"Inserted {result['inserted']}, updated {result['updated']}, skipped {result['skipped']}, "
+          f"errors {result['error_count']} in {(datetime.now() - started).total_seconds():.1f}s")
+    for error in result["errors"]:
+        print(f"  row {error['row']}: {error['message']}")
@@ -0,0 +1,578 @@
+# SAFI LAB - Patient persistence (SQLite primary store + Excel sync)
+import os
+import sys
+import sqlite3
+import threading
+import zipfile
+from datetime import datetime
+
+from metrics import phase
+from patients import (COL_ID, COL_TRANS, FIELD_COLUMNS, RECORD_COLUMNS, PatientCache, RowIndex,
+                      normalize_id, values_to_record)
+from sheet_reader import read_sheet
+
+FIELDS = list(FIELD_COLUMNS)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Fields the patient list can be sorted by (prefix with "-" for descending)
+SORT_FIELDS = ["id", "name", "age", "gender", "date", "clinic", "doctor", "last_modified"]
+NUMERIC_SORT_FIELDS = {"age"}
+# Workbook parts an openpyxl save does not keep: drawings (shapes, pictures such as the EMF logos),
+# form controls and OLE objects. xl/media/ is left out, pictures only show through a drawing
+DRAWING_PARTS = ("xl/drawings/", "xl/embeddings/", "xl/ctrlProps/", "xl/activeX/")
+
+
+class DrawingsWouldBeLost(Exception):
+    """An openpyxl save would strip the workbook's drawings; nothing was written."""
+
+
+def parse_sort(sort):
+    """'-name' -> ('name', True). Unknown or empty fields mean sheet order."""
+    sort = (sort or "").strip()
+    descending = sort.startswith("-")
+    field = sort.lstrip("-+")
+    return (field if field in SORT_FIELDS else None), descending
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+def sort_records(records, sort):
+    """Sorts records by a sort spec (see parse_sort); stable, so ties keep their order."""
+    field, descending = parse_sort(sort)
+    if not field:
+        return list(records)
+    key = (lambda r: _number(r[field])) if field in NUMERIC_SORT_FIELDS else (lambda r: r[field].lower())
+    return sorted(records, key=key, reverse=descending)
+
+
+def _empty_record(pid):
+    record = {key: "" for key in FIELDS}
+    record["id"] = str(pid).strip()
+    return record
+
+
+class PatientStore:
+    """
+    Interface SafiLabAPI uses to read and write patients.
+
+    Records are dicts keyed by FIELD_COLUMNS (all values are strings).
+    Ids are matched with normalize_id().
+    """
+
+    def all(self):
+        """Returns every record in sheet order."""
+        raise NotImplementedError
+
+    def get(self, pid):
+        """Returns the record for a patient id, or None."""
+        raise NotImplementedError
+
+    def upsert(self, record):
+        """Inserts or updates a record, keeping fields it does not mention."""
+        raise NotImplementedError
+
+    def upsert_many(self, records):
+        """Upserts a batch of records. Returns the saved records."""
+        return [self.upsert(r) for r in records]
+
+    def delete(self, pid):
+        """Deletes a patient. Returns True if a record was removed."""
+        raise NotImplementedError
+
+    def replace_all(self, records, keep=()):
+        """
+        Makes the store hold exactly `records`, in that order: upserts them and
+        deletes every other patient except the normalized ids in `keep`.
+        Returns the number of patients removed.
+        """
+        self.upsert_many(records)
+        wanted = {normalize_id(r["id"]) for r in records} | set(keep)
+        stale = [r["id"] for r in self.all() if normalize_id(r["id"]) not in wanted]
+        for pid in stale:
+            self.delete(pid)
+        return len(stale)
+
+    def set_field(self, pid, field, value):
+        """Updates one field of an existing patient. Returns True if found."""
+        raise NotImplementedError
+
+    def query(self, offset=0, limit=100, sort=None, text=""):
+        """
+        Returns (records, total) for one page of the patient list.
+
+        `text` matches id or name (case-insensitive substring), `sort` is a
+        SORT_FIELDS name, optionally prefixed with "-". Ties keep sheet order.
+        """
+        records = self.all()
+        text = (text or "").strip().lower()
+        if text:
+            records = [r for r in records if text in r["id"].lower() or text in r["name"].lower()]
+        records = sort_records(records, sort)
+        offset = max(0, int(offset))
+        return records[offset:offset + max(0, int(limit))], len(records)
+
+    def warm_up(self):
+        """Optional background preload at startup."""
+        return None
+
+    def close(self):
+        pass
+
+
+class SQLitePatientStore(PatientStore):
+    """
+    Patient store backed by an indexed SQLite database.
+
+    If `seed_workbook` is given and the database is empty, the workbook is
+    imported on first use.
+    """
+
+    def __init__(self, db_file, seed_workbook=None, sheet_name="Patients"):
+        self.db_file = db_file
+        self.seed_workbook = seed_workbook
+        self.sheet_name = sheet_name
+        self._lock = threading.RLock()
+        self._seeded = seed_workbook is None
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._create_schema()
+
+    def _create_schema(self):
+        columns = ", ".join(f"{key} TEXT NOT NULL DEFAULT ''" for key in FIELDS)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS patients ("
+                f"key TEXT PRIMARY KEY, seq INTEGER NOT NULL, {columns})")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_seq ON patients(seq)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name COLLATE NOCASE)")
+
+    def _ensure_seeded(self):
+        if self._seeded: return
+        self._seeded = True
+        count = self._conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+        if count == 0 and os.path.exists(self.seed_workbook):
+            imported = import_workbook(self, self.seed_workbook, self.sheet_name)
+            print(f"Imported {imported} patients from {self.seed_workbook}")
+
+    def _to_record(self, row):
+        return {key: row[key] for key in FIELDS}
+
+    def all(self):
+        with self._lock:
+            self._ensure_seeded()
+            rows = self._conn.execute(f"SELECT {', '.join(FIELDS)} FROM patients ORDER BY seq").fetchall()
+            return [self._to_record(r) for r in rows]
+
+    def query(self, offset=0, limit=100, sort=None, text=""):
+        where, params = "", []
+        text = (text or "").strip()
+        if text:
+            pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where = "WHERE id LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\'"
+            params = [pattern, pattern]
+        field, descending = parse_sort(sort)
+        order = "seq"
+        if field:
+            direction = "DESC" if descending else "ASC"
+            if field in NUMERIC_SORT_FIELDS:
+                # Blank values sort as the largest number, like the in-memory query
+                order = f"({field} = '') {direction}, CAST({field} AS REAL) {direction}, seq"
+            else:
+                order = f"{field} COLLATE NOCASE {direction}, seq"
+        with self._lock, phase("store.query"):
+            self._ensure_seeded()
+            total = self._conn.execute(f"SELECT COUNT(*) FROM patients {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT {', '.join(FIELDS)} FROM patients {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                params + [max(0, int(limit)), max(0, int(offset))]).fetchall()
+            return [self._to_record(r) for r in rows], total
+
+    def get(self, pid):
+        with self._lock, phase("store.get"):
+            self._ensure_seeded()
+            row = self._conn.execute(
+                f"SELECT {', '.join(FIELDS)} FROM patients WHERE key = ?", (normalize_id(pid),)).fetchone()
+            return self._to_record(row) if row else None
+
+    def _upsert(self, record):
+        key = normalize_id(record["id"])
+        existing = self._conn.execute(
+            f"SELECT {', '.join(FIELDS)} FROM patients WHERE key = ?", (key,)).fetchone()
+        merged = self._to_record(existing) if existing else _empty_record(record["id"])
+        merged.update({k: "" if v is None else str(v) for k, v in record.items() if k in FIELD_COLUMNS})
+        if existing:
+            assignments = ", ".join(f"{k} = ?" for k in FIELDS)
+            self._conn.execute(
+                f"UPDATE patients SET {assignments} WHERE key = ?",
+                [merged[k] for k in FIELDS] + [key])
+        else:
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM patients").fetchone()[0]
+            placeholders = ", ".join("?" for _ in FIELDS)
+            self._conn.execute(
+                f"INSERT INTO patients (key, seq, {', '.join(FIELDS)}) VALUES (?, ?, {placeholders})",
+                [key, seq] + [merged[k] for k in FIELDS])
+        return merged
+
+    def upsert(self, record):
+        with self._lock, phase("store.upsert"):
+            self._ensure_seeded()
+            with self._conn:
+                return self._upsert(record)
+
+    def upsert_many(self, records):
+        """Upserts a batch of records in a single transaction."""
+        with self._lock:
+            with self._conn:
+                return [self._upsert(r) for r in records]
+
+    def replace_all(self, records, keep=()):
+        """Same as PatientStore.replace_all, in one transaction; `seq` follows the order of `records`."""
+        with self._lock:
+            with self._conn:
+                keys = [normalize_id(r["id"]) for r in records]
+                for record in records:
+                    self._upsert(record)
+                self._conn.executemany("UPDATE patients SET seq = ? WHERE key = ?",
+                                       [(i, key) for i, key in enumerate(keys, start=1)])
+                wanted = set(keys) | set(keep)
+                stale = [row[0] for row in self._conn.execute("SELECT key FROM patients") if row[0] not in wanted]
+                self._conn.executemany("DELETE FROM patients WHERE key = ?", [(key,) for key in stale])
+                # Rows only kept (not in `records`) go after the sheet's rows
+                self._conn.executemany("UPDATE patients SET seq = ? WHERE key = ?",
+                                       [(len(keys) + i, key) for i, key in enumerate(
+                                           sorted(wanted - set(keys)), start=1)])
+                return len(stale)
+
+    def delete(self, pid):
+        with self._lock:
+            self._ensure_seeded()
+            with self._conn:
+                cur = self._conn.execute("DELETE FROM patients WHERE key = ?", (normalize_id(pid),))
+                return cur.rowcount > 0
+
+    def set_field(self, pid, field, value):
+        if field not in FIELD_COLUMNS or field == "id":
+            raise ValueError(f"Unknown field: {field}")
+        with self._lock:
+            self._ensure_seeded()
+            with self._conn:
+                cur = self._conn.execute(
+                    f"UPDATE patients SET {field} = ? WHERE key = ?", (str(value), normalize_id(pid)))
+                return cur.rowcount > 0
+
+    def warm_up(self):
+        def run():
+            try:
+                with self._lock:
+                    self._ensure_seeded()
+            except Exception as e:
+                print(f"Store warm-up failed: {e}")
+
+        thread = threading.Thread(target=run, name="patient-store-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ExcelPatientStore(PatientStore):
+    """
+    Legacy store: reads through PatientCache, writes through Excel COM automation.
+
+    Windows only (needs pywin32 and Excel installed).
+    """
+
+    def __init__(self, excel_file, sheet_name="Patients"):
+        self.excel_file = excel_file
+        self.sheet_name = sheet_name
+        self._cache = PatientCache(excel_file, sheet_name)
+
+    def all(self):
+        return self._cache.all()
+
+    def get(self, pid):
+        return self._cache.get(pid)
+
+    def warm_up(self):
+        return self._cache.warm_up()
+
+    def _open(self):
+        import pythoncom
+        import win32com.client
+        with phase("workbook.open"):
+            pythoncom.CoInitialize()
+            xl = win32com.client.Dispatch("Excel.Application")
+            xl.Visible = False
+            xl.DisplayAlerts = False
+            wb = xl.Workbooks.Open(self.excel_file)
+            return xl, wb, wb.Worksheets(self.sheet_name)
+
+    def _close(self, xl, wb, save):
+        import pythoncom
+        try:
+            if save:
+                with phase("workbook.save"):
+                    wb.Save()
+            wb.Close()
+            xl.Quit()
+        finally:
+            self._cache.invalidate()
+            pythoncom.CoUninitialize()
+
+    def upsert(self, record):
+        xl, wb, ws = self._open()
+        try:
+            index = RowIndex.from_com(ws)
+            found_row = index.find(record["id"]) or index.append(record["id"])
+            for key, value in record.items():
+                if key in FIELD_COLUMNS:
+                    ws.Cells(found_row, FIELD_COLUMNS[key] + 1).Value = value
+        finally:
+            self._close(xl, wb, save=True)
+        return self.get(record["id"])
+
+    def upsert_many(self, records):
+        """
+        Upserts a batch through one workbook open/save. A full A-L block is
+        written with one COM call per row; other fields cell by cell.
+        """
+        block = [key for key, col in sorted(FIELD_COLUMNS.items(), key=lambda item: item[1]) if col <= COL_TRANS]
+        xl, wb, ws = self._open()
+        try:
+            index = RowIndex.from_com(ws)
+            for record in records:
+                found_row = index.find(record["id"]) or index.append(record["id"])
+                rest = record
+                if all(key in record for key in block):
+                    ws.Range(ws.Cells(found_row, 1), ws.Cells(found_row, COL_TRANS + 1)).Value = \
+                        (tuple(record[key] for key in block),)
+                    rest = {key: value for key, value in record.items() if key not in block}
+                for key, value in rest.items():
+                    if key in FIELD_COLUMNS:
+                        ws.Cells(found_row, FIELD_COLUMNS[key] + 1).Value = value
+        finally:
+            self._close(xl, wb, save=True)
+        return [self.get(r["id"]) for r in records]
+
+    def delete(self, pid):
+        xl, wb, ws = self._open()
+        found_row = 0
+        try:
+            found_row = RowIndex.from_com(ws).find(pid)
+            if found_row >= 2:
+                ws.Rows(found_row).Delete()
+        finally:
+            self._close(xl, wb, save=found_row >= 2)
+        return found_row >= 2
+
+    def set_field(self, pid, field, value):
+        xl, wb, ws = self._open()
+        found_row = 0
+        try:
+            found_row = RowIndex.from_com(ws).find(pid)
+            if found_row >= 2:
+                ws.Cells(found_row, FIELD_COLUMNS[field] + 1).Value = value
+        finally:
+            self._close(xl, wb, save=found_row >= 2)
+        return found_row >= 2
+
+
+# ========================= EXCEL SYNC =========================
+
+def workbook_records(excel_file, sheet_name="Patients"):
+    """The sheet's patient rows as records, in sheet order."""
+    return [values_to_record(values) for _, values in read_sheet(excel_file, sheet_name, RECORD_COLUMNS, min_row=2)
+            if values[0] is not None]
+
+
+def import_workbook(store, excel_file, sheet_name="Patients", keep=()):
+    """
+    Makes the store match the workbook: every patient row is loaded in sheet
+    order and patients no longer in the sheet are removed, except the
+    normalized ids in `keep`. An empty sheet never empties the store.
+    Returns the row count.
+    """
+    records = workbook_records(excel_file, sheet_name)
+    if not records:
+        print(f"No patients in {excel_file}; store left unchanged")
+        return 0
+    removed = store.replace_all(records, keep)
+    if removed: print(f"Removed {removed} patients no longer in {excel_file}")
+    return len(records)
+
+
+def _excel_value(text):
+    """Converts a stored string back to the type Excel would have parsed it as."""
+    if text == "": return None
+    try:
+        if str(int(text)) == text: return int(text)
+    except ValueError: pass
+    try:
+        if repr(float(text)) == text: return float(text)
+    except ValueError: pass
+    try:
+        return datetime.strptime(text, TIMESTAMP_FORMAT)
+    except ValueError: pass
+    return text
+
+
+def workbook_drawings(excel_file):
+    """Parts of the workbook that an openpyxl save would drop (empty if it has none)."""
+    with zipfile.ZipFile(excel_file) as zf:
+        return [name for name in zf.namelist() if name.startswith(DRAWING_PARTS)]
+
+
+def _check_drawings(excel_file, allow_drawing_loss):
+    if allow_drawing_loss: return
+    parts = workbook_drawings(excel_file)
+    if parts:
+        raise DrawingsWouldBeLost(
+            f"{os.path.basename(excel_file)} has drawings ({', '.join(parts)}) that saving it without Excel would remove")
+
+
+def export_workbook(store, excel_file, sheet_name="Patients", allow_drawing_loss=False):
+    """
+    Writes the store back into the workbook's column layout
+    (A-L data, P/Q status, S last-modified). Rows missing from the store are
+    removed and new patients are appended. VBA is kept; drawings are not, so
+    a workbook with drawings raises DrawingsWouldBeLost unless
+    `allow_drawing_loss`. Returns the number of patients written.
+    """
+    from openpyxl import load_workbook
+    _check_drawings(excel_file, allow_drawing_loss)
+    records = {normalize_id(r["id"]): r for r in store.all()}
+    wb = load_workbook(excel_file, keep_vba=True)
+    ws = wb[sheet_name]
+
+    seen = set()
+    stale_rows = []
+    last_row = 1
+    for r in range(2, ws.max_row + 1):
+        value = ws.cell(row=r, column=1).value
+        if value is None: continue
+        last_row = r
+        key = normalize_id(value)
+        record = records.get(key)
+        if record is None:
+            stale_rows.append(r)
+            continue
+        seen.add(key)
+        for field, col in FIELD_COLUMNS.items():
+            ws.cell(row=r, column=col + 1).value = _excel_value(record[field])
+
+    for key, record in records.items():
+        if key in seen: continue
+        last_row += 1
+        for field, col in FIELD_COLUMNS.items():
+            ws.cell(row=last_row, column=col + 1).value = _excel_value(record[field])
+
+    for r in reversed(stale_rows):
+        ws.delete_rows(r)
+
+    tmp_path = excel_file + ".tmp"
+    wb.save(tmp_path)
+    wb.close()
+    os.replace(tmp_path, excel_file)
+    return len(records)
+
+
+def _workbook_row_values(entry):
+    return {col: _excel_value(str(value)) for col, value in entry["cells"].items()}
+
+
+def apply_workbook_updates(excel_file, sheet_name, entries, allow_drawing_loss=False):
+    """
+    Applies queued row updates to the workbook with a single openpyxl save.
+
+    `entries` maps normalized id -> {"pid", "delete", "cells": {0-based col: value}}.
+    A delete removes the existing row; cells then update (or append) the row.
+    openpyxl drops drawings, so a workbook with drawings raises
+    DrawingsWouldBeLost (and is left untouched) unless `allow_drawing_loss`.
+    """
+    from openpyxl import load_workbook
+    _check_drawings(excel_file, allow_drawing_loss)
+    with phase("workbook.open"):
+        wb = load_workbook(excel_file, keep_vba=True)
+    ws = wb[sheet_name]
+    with phase("workbook.row_lookup"):
+        index = RowIndex.from_values(
+            next(ws.iter_cols(min_col=1, max_col=1, min_row=2, values_only=True), ()))
+
+    for entry in entries.values():
+        r = index.find(entry["pid"])
+        if entry["delete"] and r:
+            ws.delete_rows(r)
+            index.delete(r)
+            r = 0
+        if not entry["cells"]: continue
+        if r == 0:
+            r = index.append(entry["pid"])
+            ws.cell(row=r, column=COL_ID + 1).value = _excel_value(str(entry["pid"]).strip())
+        for col, value in _workbook_row_values(entry).items():
+            ws.cell(row=r, column=col + 1).value = value
+
+    tmp_path = excel_file + ".tmp"
+    with phase("workbook.save"):
+        wb.save(tmp_path)
+        wb.close()
+        os.replace(tmp_path, excel_file)
+
+
+def apply_workbook_updates_com(excel_file, sheet_name, entries):
+    """Same as apply_workbook_updates, through one Excel COM open/save (keeps drawings)."""
+    import pythoncom
+    import win32com.client
+    pythoncom.CoInitialize()
+    try:
+        with phase("workbook.open"):
+            xl = win32com.client.Dispatch("Excel.Application")
+            xl.Visible = False
+            xl.DisplayAlerts = False
+            wb = xl.Workbooks.Open(excel_file)
+        try:
+            ws = wb.Worksheets(sheet_name)
+            index = RowIndex.from_com(ws)
+            for entry in entries.values():
+                r = index.find(entry["pid"])
+                if entry["delete"] and r >= 2:
+                    ws.Rows(r).Delete()
+                    index.delete(r)
+                    r = 0
+                if not entry["cells"]: continue
+                if r == 0:
+                    r = index.append(entry["pid"])
+                    ws.Cells(r, COL_ID + 1).Value = str(entry["pid"]).strip()
+                for col, value in entry["cells"].items():
+                    ws.Cells(r, col + 1).Value = value
+            with phase("workbook.save"):
+                wb.Save()
+        finally:
+            wb.Close()
+            xl.Quit()
+    finally:
+        pythoncom.CoUninitialize()
+
+
+if __name__ == '__main__':
+    # Usage: python patient_store.py import|export [Patients.xlsm] [Patients.db] [--drop-drawings]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args or args[0] not in ("import", "export"):
+        print("Usage: python patient_store.py import|export [workbook] [database] [--drop-drawings]")
+        sys.exit(1)
+    excel_path = os.path.abspath(args[1] if len(args) > 1 else "Patients.xlsm")
+    db_path = os.path.abspath(args[2] if len(args) > 2 else "Patients.db")
+    store = SQLitePatientStore(db_path)
+    if args[0] == "import":
+        print(f"Imported {import_workbook(store, excel_path)} patients into {db_path}")
+    else:
+        # openpyxl removes the workbook's drawings; --drop-drawings accepts that
+        count = export_workbook(store, excel_path, allow_drawing_loss="--drop-drawings" in sys.argv)
+        print(f"Exported {count} patients to {excel_path}")
+    store.close()
@@ -0,0 +1,211 @@
+# SAFI LAB - Patients sheet layout and in-process cache
+import os
+import threading
+
+from metrics import phase
+from sheet_reader import read_sheet
+
+# ========================= SHEET LAYOUT =========================
+# 0-based positions in the Patients sheet (A=0 ... S=18)
+COL_ID        = 0
+COL_NAME      = 1
+COL_AGE       = 2
+COL_GENDER    = 3
+COL_CLINIC    = 4
+COL_DOCTOR    = 5
+COL_DATE      = 6
+COL_PHONE     = 7
+COL_EMAIL     = 8
+COL_ABS       = 9
+COL_CONC      = 10
+COL_TRANS     = 11
+COL_EMAILED   = 15   # P
+COL_WHATSAPP  = 16   # Q
+COL_LAST_MOD  = 18   # S
+
+# Record key -> 0-based column
+FIELD_COLUMNS = {
+    "id": COL_ID,
+    "name": COL_NAME,
+    "age": COL_AGE,
+    "gender": COL_GENDER,
+    "clinic": COL_CLINIC,
+    "doctor": COL_DOCTOR,
+    "date": COL_DATE,
+    "phone": COL_PHONE,
+    "email": COL_EMAIL,
+    "abs": COL_ABS,
+    "conc": COL_CONC,
+    "trans": COL_TRANS,
+    "emailed": COL_EMAILED,
+    "whatsapp": COL_WHATSAPP,
+    "last_modified": COL_LAST_MOD,
+}
+# Columns a record is built from, in FIELD_COLUMNS order (what the sheet readers project)
+RECORD_COLUMNS = tuple(FIELD_COLUMNS.values())
+
+
+def normalize_id(value):
+    """Normalizes a patient id for matching: trim, lowercase, drop a trailing '.0'."""
+    s = str(value).strip().lower()
+    if s.endswith(".0"): return s[:-2]
+    return s
+
+
+def values_to_record(values):
+    """Converts values projected on RECORD_COLUMNS into a patient record dict."""
+    record = {key: "" if value is None else str(value) for key, value in zip(FIELD_COLUMNS, values)}
+    record["id"] = record["id"].strip()
+    return record
+
+
+def is_yes(value):
+    return str(value).lower() in ['yes', 'true', '1']
+
+
+class RowIndex:
+    """
+    Maps normalized patient ids to 1-based sheet rows.
+
+    Built from one bulk read of column A and kept current in place as rows are
+    appended or deleted. If an id appears twice, the first row wins, like the
+    old linear scan.
+    """
+
+    def __init__(self, first_row=2):
+        self.first_row = first_row
+        self.last_row = first_row - 1
+        self._rows = {}
+
+    @classmethod
+    def from_values(cls, values, first_row=2):
+        """Builds the index from column A values, starting at `first_row`."""
+        return cls.from_rows(((first_row + offset, value) for offset, value in enumerate(values)), first_row)
+
+    @classmethod
+    def from_rows(cls, rows, first_row=2):
+        """Builds the index from (row, column A value) pairs in sheet order."""
+        index = cls(first_row)
+        for row, value in rows:
+            if value is None: continue
+            index.last_row = row
+            index._rows.setdefault(normalize_id(value), []).append(row)
+        return index
+
+    @classmethod
+    def from_com(cls, ws_com, first_row=2):
+        """Builds the index with a single COM read of column A."""
+        with phase("workbook.row_lookup"):
+            last_row = int(ws_com.Cells(ws_com.Rows.Count, 1).End(-4162).Row)
+            if last_row < first_row:
+                return cls(first_row)
+            values = ws_com.Range(ws_com.Cells(first_row, 1), ws_com.Cells(last_row, 1)).Value
+        if not isinstance(values, tuple):
+            values = ((values,),)
+        return cls.from_values((v[0] for v in values), first_row)
+
+    def find(self, pid):
+        """Returns the row for a patient id, or 0."""
+        rows = self._rows.get(normalize_id(pid))
+        return rows[0] if rows else 0
+
+    def append(self, pid):
+        """Records a new row for `pid` after the last one and returns it."""
+        self.last_row += 1
+        self._rows.setdefault(normalize_id(pid), []).append(self.last_row)
+        return self.last_row
+
+    def delete(self, row):
+        """Forgets `row` and shifts every row below it up by one."""
+        for key in list(self._rows):
+            rows = [r - 1 if r > row else r for r in self._rows[key] if r != row]
+            if rows: self._rows[key] = rows
+            else: del self._rows[key]
+        if self.last_row >= row:
+            self.last_row -= 1
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class PatientCache:
+    """
+    Parses the Patients sheet once and serves reads from memory.
+
+    The parsed data is keyed on the workbook's (mtime, size). A change on disk,
+    or an explicit invalidate() from our own write paths, causes a reload on the
+    next access.
+    """
+
+    def __init__(self, excel_file, sheet_name):
+        self.excel_file = excel_file
+        self.sheet_name = sheet_name
+        self._lock = threading.RLock()
+        self._signature = None
+        self._records = []
+        self._by_row = {}
+        self._index = RowIndex()
+
+    def _file_signature(self):
+        st = os.stat(self.excel_file)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self, signature):
+        with phase("workbook.read"):
+            self._parse(signature)
+
+    def _parse(self, signature):
+        records = []
+        by_row = {}
+        ids = []
+        for row, values in read_sheet(self.excel_file, self.sheet_name, RECORD_COLUMNS, min_row=2):
+            if values[0] is None: continue
+            record = values_to_record(values)
+            records.append(record)
+            by_row[row] = record
+            ids.append((row, values[0]))
+        self._records = records
+        self._by_row = by_row
+        self._index = RowIndex.from_rows(ids)
+        self._signature = signature
+
+    def _ensure_fresh(self):
+        signature = self._file_signature()
+        if signature != self._signature:
+            self._load(signature)
+
+    def all(self):
+        """Returns every patient record in sheet order."""
+        with self._lock:
+            self._ensure_fresh()
+            return list(self._records)
+
+    def get(self, pid):
+        """Returns the record for a patient id, or None."""
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_row.get(self._index.find(pid))
+
+    def find_row(self, pid):
+        """Returns the sheet row of a patient id, or 0."""
+        with self._lock:
+            self._ensure_fresh()
+            return self._index.find(pid)
+
+    def invalidate(self):
+        """Drops the parsed data so the next read reloads the workbook."""
+        with self._lock:
+            self._signature = None
+
+    def warm_up(self):
+        """Loads the sheet in a background thread."""
+        def run():
+            try:
+                with self._lock:
+                    self._ensure_fresh()
+            except Exception as e:
+                print(f"Cache warm-up failed: {e}")
+
+        thread = threading.Thread(target=run, name="patient-cache-warmup", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,99 @@
+# SAFI LAB - Local QR generation and an in-memory LRU of QR data URIs
+import base64
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from metrics import phase
+
+
+def qr_png_bytes(url):
+    """Generates the QR code for `url` locally and returns PNG bytes."""
+    import qrcode   # pulls in PIL, imported on first QR
+    buffered = BytesIO()
+    with phase("qr.generate"):
+        qrcode.make(url).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def write_qr(url, path):
+    """Writes the QR PNG for `url` to `path`."""
+    with open(path, "wb") as f:
+        f.write(qr_png_bytes(url))
+
+
+def to_data_uri(png_bytes):
+    return "data:image/png;base64," + base64.b64encode(png_bytes).decode('utf-8')
+
+
+class QRCache:
+    """
+    LRU cache of ready-to-send QR data URIs keyed by the encoded URL.
+
+    Bounded by both entry count and total size of the cached strings.
+    """
+
+    def __init__(self, max_entries=512, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, png_path=None):
+        """
+        Returns the data URI for `url`. On a miss it uses `png_path` if that
+        file exists (the saved report QR), otherwise it generates the QR.
+        """
+        with self._lock:
+            data_uri = self._entries.get(url)
+            if data_uri is not None:
+                self._entries.move_to_end(url)
+                self.hits += 1
+                return data_uri
+            self.misses += 1
+
+        if png_path and os.path.exists(png_path):
+            with open(png_path, "rb") as f:
+                data_uri = to_data_uri(f.read())
+        else:
+            data_uri = to_data_uri(qr_png_bytes(url))
+        self.put(url, data_uri)
+        return data_uri
+
+    def put(self, url, data_uri):
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[url] = data_uri
+            self._size += len(data_uri)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self, url):
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= len(old)
+
+    def invalidate_patient(self, pid):
+        """Drops every cached QR that points at patient_<pid>.html (any name/folder)."""
+        suffix = f"/patient_{str(pid).strip()}.html"
+        with self._lock:
+            for url in [u for u in self._entries if u.endswith(suffix)]:
+                self._size -= len(self._entries.pop(url))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size,
+                    "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,192 @@
+# SAFI LAB - Batch report generation (HTML, QR, PDF) across a process pool
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from urllib.parse import quote
+
+from metrics import METRICS, phase
+from qr_cache import write_qr
+from report_manifest import ReportManifest
+from report_renderer import export_pdf, report_folder_name, report_inputs, write_report
+
+
+def report_url(domain_host, folder_name, pid):
+    """Public URL of a report (what the QR code points to)."""
+    return f"https://{domain_host}/QR_Patients/{quote(folder_name)}/patient_{pid}.html"
+
+
+def build_report_files(record, output_root, domain_host, make_pdf=False, year=None, force=False, progress=None,
+                       steps=("html", "qr", "pdf")):
+    """
+    Writes patient_<id>.html, qr_<id>.png and (optionally) patient_<id>.pdf
+    for one patient, skipping outputs whose manifest says they are current.
+    `steps` limits which outputs are considered (the PDF needs the HTML to
+    exist already). `progress(stage)` is called before each output ("html",
+    "qr", "pdf"); an exception it raises stops the build. Returns a result dict:
+    {"id", "success", "message", "folder", "paths", "changed", "timings"};
+    "timings" holds the (phase, ms, error) of each output built, already
+    recorded in this process's metrics.
+    """
+    pid = str(record.get("id", "")).strip()
+    result = {"id": pid, "success": False, "message": "", "folder": None, "paths": [], "changed": [],
+              "timings": []}
+    try:
+        year = year or datetime.now().year
+        folder_path = os.path.join(output_root, report_folder_name(record))
+        manifest = ReportManifest(folder_path)
+        result["folder"] = folder_path
+
+        def output(kind, name, inputs, build):
+            path = os.path.join(folder_path, name)
+            result["paths"].append(path)
+            if not force and manifest.is_current(name, inputs):
+                return
+            with phase("report." + kind, result["timings"]):
+                build(path)
+            manifest.record(name, inputs)
+            result["changed"].append(path)
+
+        def stage(name):
+            if progress: progress(name)
+
+        html_name = f"patient_{pid}.html"
+        if "html" in steps:
+            stage("html")
+            output("html", html_name, report_inputs(record, year),
+                   lambda path: write_report(record, output_root, year))
+
+        if "qr" in steps:
+            url = report_url(domain_host, os.path.basename(folder_path), pid)
+            stage("qr")
+            output("qr", f"qr_{pid}.png", {"url": url},
+                   lambda path: write_qr(url, path))
+
+        if make_pdf and "pdf" in steps:
+            stage("pdf")
+            try:
+                output("pdf", f"patient_{pid}.pdf", {"html": manifest.output_hash(html_name)},
+                       lambda path: export_pdf(os.path.join(folder_path, html_name), path))
+            except Exception as e:
+                # Like the VBA version, a failed PDF does not fail the report
+                print(f"PDF Export Error ({pid}): {e}")
+
+        if manifest.save():
+            result["changed"].append(manifest.path)
+
+        result["success"] = True
+        result["message"] = "Generated" if result["changed"] else "Up to date"
+    except Exception as e:
+        result["message"] = str(e)
+    return result
+
+
+def generate_reports(records, output_root, domain_host, workers=None, make_pdf=False, progress=None, force=False,
+                     cancelled=None):
+    """
+    Builds reports for many patients on a process pool.
+
+    At most `workers` patients are in flight at once (default: CPU count, max 8).
+    HTML and QR are built in the pool; PDFs are exported afterwards one at a
+    time in this process, because every Word.Application Dispatch attaches
+    to the same running Word, and a Quit() in one process would kill the
+    conversions of the others.
+    `progress(done, total, result)` is called in this process after each
+    step (total counts the PDF pass too). Once `cancelled()` returns True no
+    new patients are started; those are returned with message "Cancelled".
+    Returns one result dict per patient, in input order; each result's
+    "changed" lists only the files that were actually rewritten. Report
+    phases timed in the pool are recorded in this process's metrics.
+    """
+    records = list(records)
+    if not records: return []
+    total = len(records) * (2 if make_pdf else 1)
+    workers = max(1, min(workers or os.cpu_count() or 1, 8, len(records)))
+    year = datetime.now().year
+
+    results = [None] * len(records)
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        queue = iter(enumerate(records))
+
+        def submit_next():
+            if cancelled and cancelled(): return False
+            for i, record in queue:
+                future = pool.submit(build_report_files, record, output_root, domain_host, False, year, force)
+                pending[future] = i
+                return True
+            return False
+
+        # Bounded: never more than 2 tasks per worker queued at a time
+        for _ in range(workers * 2):
+            if not submit_next(): break
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = pending.pop(future)
+                try:
+                    result = future.result()
+                    # Timed in the worker, whose metrics nobody reads
+                    METRICS.record_all(result.pop("timings", ()))
+                except Exception as e:
+                    result = {"id": str(records[i].get("id", "")), "success": False,
+                              "message": str(e), "folder": None, "paths": [], "changed": []}
+                results[i] = result
+                done += 1
+                if progress:
+                    try:
+                        progress(done, total, result)
+                    except Exception as e:
+                        print(f"Progress Callback Error: {e}")
+                submit_next()
+
+    if make_pdf:
+        for i, record in enumerate(records):
+            result = results[i]
+            if result is None or not result["success"]: continue
+            if cancelled and cancelled(): break
+            pdf = build_report_files(record, output_root, domain_host, True, year, force, steps=("pdf",))
+            pdf.pop("timings", None)   # built here, so already recorded
+            result["paths"] += pdf["paths"]
+            result["changed"] += [path for path in pdf["changed"] if path not in result["changed"]]
+            if pdf["changed"]: result["message"] = "Generated"
+            done += 1
+            if progress:
+                try:
+                    progress(done, total, result)
+                except Exception as e:
+                    print(f"Progress Callback Error: {e}")
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = {"id": str(records[i].get("id", "")), "success": False,
+                          "message": "Cancelled", "folder": None, "paths": [], "changed": []}
+    return results
+
+
+if __name__ == '__main__':
+    # Usage: python report_batch.py all | <id> [<id> ...]
+    from patient_store import SQLitePatientStore
+    from patients import normalize_id
+
+    if len(sys.argv) < 2:
+        print("Usage: python report_batch.py all | <id> [<id> ...]")
+        sys.exit(1)
+
+    store = SQLitePatientStore(os.path.abspath("Patients.db"), seed_workbook=os.path.abspath("Patients.xlsm"))
+    records = store.all()
+    if sys.argv[1] != "all":
+        wanted = {normalize_id(pid) for pid in sys.argv[1:]}
+        records = [r for r in records if normalize_id(r["id"]) in wanted]
+    store.close()
+
+    def show(done, total, result):
+        status = "OK" if result["success"] else f"FAILED: {result['message']}"
+        print(f"[{done}/{total}] {result['id']} {status}")
+
+    results = generate_reports(records, os.path.abspath("QR_Patients"), "safi-lab-new.vercel.app",
+                               make_pdf=sys.platform == "win32", progress=show)
+    ok = sum(1 for r in results if r["success"])
+    print(f"Generated {ok}/{len(results)} reports.")
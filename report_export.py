@@ -0,0 +1,180 @@
+# SAFI LAB - Export bundle: selected patients' reports streamed into one zip (and optionally one merged PDF)
+import os
+import re
+import sys
+import zipfile
+from datetime import date, datetime
+
+from metrics import phase
+from report_renderer import make_safe_filename, report_folder_name
+
+DATE_FORMAT = '%Y-%m-%d'
+# Sample dates: the app writes 'YYYY-MM-DD HH:MM:SS'; imports and hand edits also bring
+# 'YYYY/MM/DD' and day/month order dates such as '12/15/2025' or '15.12.2025'
+YEAR_FIRST_RE = re.compile(r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?![\d])")
+YEAR_LAST_RE = re.compile(r"(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})(?![\d])")
+# Already compressed, so stored as-is instead of deflated again
+STORED_EXTENSIONS = (".pdf", ".png")
+
+
+def _matches(value, wanted):
+    return not wanted or str(value or "").strip().casefold() == wanted.strip().casefold()
+
+
+def parse_date(value):
+    """
+    A sample date as a date, or None. Any time of day is ignored. In
+    'a/b/YYYY' the day is whichever part is over 12; when both are 12 or
+    less (03/04/2025) the order cannot be told and None is returned.
+    """
+    if isinstance(value, datetime): return value.date()
+    if isinstance(value, date): return value
+    text = str(value or "").strip()
+    match = YEAR_FIRST_RE.match(text)
+    if match:
+        year, month, day = (int(part) for part in match.groups())
+    else:
+        match = YEAR_LAST_RE.match(text)
+        if not match: return None
+        first, second, year = (int(part) for part in match.groups())
+        if first > 12 >= second: day, month = first, second
+        elif second > 12 >= first or first == second: day, month = second, first
+        else: return None
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def _record_date(record):
+    return parse_date(record.get("date"))
+
+
+def select_patients(records, clinic="", doctor="", date_from="", date_to="", undated=None):
+    """
+    Records whose clinic / doctor match (case-insensitive, blank = any) and
+    whose sample date is within [date_from, date_to] ('YYYY-MM-DD', either
+    end optional). With a date range, the ids of matching records whose date
+    cannot be read are left out and appended to `undated` (if given).
+    """
+    start = datetime.strptime(date_from, DATE_FORMAT).date() if date_from else None
+    end = datetime.strptime(date_to, DATE_FORMAT).date() if date_to else None
+    selected = []
+    for record in records:
+        if not (_matches(record.get("clinic"), clinic) and _matches(record.get("doctor"), doctor)):
+            continue
+        if start or end:
+            day = _record_date(record)
+            if day is None:
+                if undated is not None: undated.append(str(record.get("id", "")))
+                continue
+            if (start and day < start) or (end and day > end):
+                continue
+        selected.append(record)
+    return selected
+
+
+def report_files(record, output_root):
+    """Existing report outputs of a patient: [(path, name in the bundle)]."""
+    pid = str(record.get("id", "")).strip()
+    folder_name = report_folder_name(record)
+    folder = os.path.join(output_root, folder_name)
+    files = []
+    for name in (f"patient_{pid}.pdf", f"patient_{pid}.html", f"qr_{pid}.png"):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            files.append((path, f"{folder_name}/{name}"))
+    return files
+
+
+def export_reports(records, output_root, zip_path, merge_pdf=False, progress=None, cancelled=None):
+    """
+    Writes the reports of `records` into `zip_path`, one member at a time
+    straight from disk (the zip is never held in memory; it is written to a
+    temp file and swapped in when complete). With `merge_pdf`, the patients'
+    PDFs are also combined into <zip name>.pdf (needs pypdf).
+
+    `progress(done, total)` is called after each patient; once `cancelled()`
+    returns True the export stops and nothing is left behind. Returns
+    {"zip", "pdf", "patients", "files", "bytes", "missing": [ids without reports]}
+    (plus "pdf_error" if the merge failed).
+    """
+    records = list(records)
+    total = len(records)
+    summary = {"zip": zip_path, "pdf": None, "patients": 0, "files": 0, "bytes": 0, "missing": []}
+    pdfs = []
+    tmp_path = zip_path + ".tmp"
+    os.makedirs(os.path.dirname(zip_path) or ".", exist_ok=True)
+    try:
+        with phase("export.zip"), zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for done, record in enumerate(records, start=1):
+                if cancelled and cancelled():
+                    raise InterruptedError("Export cancelled")
+                files = report_files(record, output_root)
+                if not files:
+                    summary["missing"].append(str(record.get("id", "")))
+                for path, name in files:
+                    stored = name.lower().endswith(STORED_EXTENSIONS)
+                    zf.write(path, name, zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+                    if name.lower().endswith(".pdf"): pdfs.append(path)
+                    summary["files"] += 1
+                if files: summary["patients"] += 1
+                if progress: progress(done, total)
+        os.replace(tmp_path, zip_path)
+        summary["bytes"] = os.path.getsize(zip_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    if merge_pdf and pdfs:
+        try:
+            summary["pdf"] = merge_pdfs(pdfs, os.path.splitext(zip_path)[0] + ".pdf")
+        except Exception as e:
+            # The zip is complete; a failed merge does not fail the export
+            print(f"PDF Merge Error: {e}")
+            summary["pdf_error"] = str(e)
+    return summary
+
+
+def merge_pdfs(paths, out_path):
+    """Concatenates PDFs into `out_path` (temp file, then swapped in). Returns out_path."""
+    from pypdf import PdfWriter   # optional, only needed for merged exports
+    tmp_path = out_path + ".tmp"
+    with phase("export.merge_pdf"):
+        writer = PdfWriter()
+        try:
+            for path in paths:
+                writer.append(path)
+            with open(tmp_path, "wb") as f:
+                writer.write(f)
+        finally:
+            writer.close()
+        os.replace(tmp_path, out_path)
+    return out_path
+
+
+def export_name(clinic="", doctor="", date_from="", date_to="", now=None):
+    """File name for a bundle, e.g. Reports_Land-clinic_2025-12-01_2025-12-31_20251231-103000.zip"""
+    parts = [p for p in (clinic, doctor, date_from, date_to) if p]
+    label = "_".join(p.strip().replace(" ", "-") for p in parts)
+    stamp = (now or datetime.now()).strftime("%Y%m%d-%H%M%S")
+    return make_safe_filename(f"Reports_{label + '_' if label else ''}{stamp}.zip")
+
+
+if __name__ == '__main__':
+    # Usage: python report_export.py [clinic=...] [doctor=...] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [merge]
+    from patient_store import SQLitePatientStore
+
+    options = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    store = SQLitePatientStore(os.path.abspath("Patients.db"), seed_workbook=os.path.abspath("Patients.xlsm"))
+    undated = []
+    selected = select_patients(store.all(), options.get("clinic", ""), options.get("doctor", ""),
+                               options.get("from", ""), options.get("to", ""), undated)
+    store.close()
+    zip_path = os.path.abspath(os.path.join("Exports", export_name(
+        options.get("clinic", ""), options.get("doctor", ""), options.get("from", ""), options.get("to", ""))))
+    result = export_reports(selected, os.path.abspath("QR_Patients"), zip_path, merge_pdf="merge" in sys.argv[1:],
+                            progress=lambda done, total: print(f"[{done}/{total}]", end="\r"))
+    print(f"Exported {result['files']} files for {result['patients']} patients to {result['zip']}")
+    if result["pdf"]: print(f"Merged PDF: {result['pdf']}")
+    if result["missing"]: print(f"No reports yet for: {', '.join(result['missing'])}")
+    if undated: print(f"Left out, sample date not readable: {', '.join(undated)}")
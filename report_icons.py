@@ -0,0 +1,85 @@
+# SAFI LAB - Local icon bundle for the reports (inlined into each page as one SVG sprite)
+# assets/report_icons/NOTICE.md says where the icons come from and how to swap in the twemoji originals
+import os
+import re
+import sys
+import urllib.request
+
+ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "report_icons")
+TWEMOJI_VERSION = "15.1.0"   # pinned, so `fetch` always gives the same files
+SVG_SOURCE = f"https://cdn.jsdelivr.net/gh/jdecked/twemoji@{TWEMOJI_VERSION}/assets/svg/"
+FETCH_TIMEOUT = 20
+SVG_RE = re.compile(r"<svg\b([^>]*)>(.*)</svg>", re.S)
+VIEWBOX_RE = re.compile(r"viewBox=[\"']([^\"']+)[\"']")
+_svgs = {}   # code -> (viewBox, inner markup), or None if not in the bundle
+
+
+def icon_path(code):
+    return os.path.join(ICON_DIR, f"{code}.svg")
+
+
+def load_svg(code):
+    """Returns (viewBox, inner markup) of a bundled icon, or None if it is not in the bundle."""
+    if code not in _svgs:
+        svg = None
+        try:
+            with open(icon_path(code), "r", encoding="utf-8") as f:
+                match = SVG_RE.search(f.read())
+            if match:
+                viewbox = VIEWBOX_RE.search(match.group(1))
+                svg = (viewbox.group(1) if viewbox else "0 0 36 36", match.group(2).strip())
+        except OSError:
+            pass
+        _svgs[code] = svg
+    return _svgs[code]
+
+
+def sprite(codes):
+    """One hidden <svg> holding a <symbol id='i-<code>'> per icon."""
+    symbols = []
+    for code in codes:
+        viewbox, inner = load_svg(code)
+        symbols.append(f"<symbol id='i-{code}' viewBox='{viewbox}'>{inner}</symbol>")
+    return f"<svg xmlns='http://www.w3.org/2000/svg' style='display:none'>{''.join(symbols)}</svg>"
+
+
+def fetch_icons(codes, force=False):
+    """Downloads the pinned twemoji SVGs into the bundle (`force` replaces bundled ones). Returns the fetched codes."""
+    os.makedirs(ICON_DIR, exist_ok=True)
+    fetched = []
+    for code in codes:
+        path = icon_path(code)
+        if os.path.exists(path) and not force: continue
+        with urllib.request.urlopen(SVG_SOURCE + f"{code}.svg", timeout=FETCH_TIMEOUT) as response:
+            data = response.read()
+        if not SVG_RE.search(data.decode("utf-8")):
+            raise ValueError(f"{code}.svg is not an SVG")
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        _svgs.pop(code, None)
+        fetched.append(code)
+    return fetched
+
+
+if __name__ == '__main__':
+    # Usage: python report_icons.py fetch | rewrite [QR_Patients]
+    from report_renderer import ICONS, rewrite_reports
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "fetch":
+        fetched = fetch_icons(ICONS.values(), force="--force" in sys.argv)
+        print(f"Fetched {len(fetched)} icons into {ICON_DIR}")
+    elif command == "rewrite":
+        from patient_store import SQLitePatientStore
+        # Patient data lets the report manifests be updated instead of dropped
+        records = []
+        if os.path.exists("Patients.db"):
+            store = SQLitePatientStore(os.path.abspath("Patients.db"))
+            records = store.all()
+            store.close()
+        changed = rewrite_reports(os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else "QR_Patients"), records)
+        print(f"Inlined icons in {len(changed)} reports")
+    else:
+        print("Usage: python report_icons.py fetch [--force] | rewrite [QR_Patients]")
+        sys.exit(1)
@@ -0,0 +1,77 @@
+# SAFI LAB - Per-folder content-hash manifest for generated report files
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = ".report_manifest.json"
+
+
+def file_hash(path):
+    """SHA256 of a file's contents, or None if it does not exist."""
+    if not os.path.exists(path): return None
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def input_hash(inputs):
+    """Stable SHA256 of the JSON-serializable inputs of an output file."""
+    data = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ReportManifest:
+    """
+    QR_Patients/<name>_<id>/.report_manifest.json
+
+    For each output file name it records the hash of the inputs it was built
+    from and the hash of the file that was written. An output only needs to be
+    rebuilt when its inputs changed, or the file is missing or was modified.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.entries = {}
+        self._dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("files", {})
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, name, inputs):
+        entry = self.entries.get(name)
+        if not entry or entry.get("input") != input_hash(inputs):
+            return False
+        return file_hash(os.path.join(self.folder, name)) == entry.get("output")
+
+    def record(self, name, inputs):
+        """Stores the hashes after `name` was (re)written."""
+        self.entries[name] = {
+            "input": input_hash(inputs),
+            "output": file_hash(os.path.join(self.folder, name)),
+        }
+        self._dirty = True
+
+    def forget(self, name):
+        """Drops the entry for `name`, so it is rebuilt next time."""
+        if self.entries.pop(name, None) is not None:
+            self._dirty = True
+
+    def output_hash(self, name):
+        entry = self.entries.get(name)
+        return entry.get("output") if entry else None
+
+    def save(self):
+        """Writes the manifest if anything changed. Returns True if it was written."""
+        if not self._dirty: return False
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        return True
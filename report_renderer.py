@@ -0,0 +1,263 @@
+# SAFI LAB - Patient report renderer (Python port of the VBA BuildHTML_Patient)
+import os
+import re
+import codecs
+import hashlib
+import threading
+from datetime import datetime
+from string import Template
+
+from report_icons import ICON_DIR, load_svg, sprite
+from report_manifest import ReportManifest, input_hash
+
+TWEMOJI_BASE = "https://twemoji.maxcdn.com/v/latest/72x72/"
+ICONS = {
+    "person": "1f464",
+    "id": "1f4c3",
+    "age": "1f382",
+    "gender": "26a7",
+    "clinic": "1f3e5",
+    "doctor": "1f468-200d-2695-fe0f",
+    "cal": "1f4c5",
+    "phone": "1f4de",
+    "mail": "1f4e7",
+    "lab": "1f52c",
+}
+# The icon tags as the VBA wrote them; inline_icons() swaps them for the local sprite
+ICON_IMG_RE = re.compile(r"<img src='" + re.escape(TWEMOJI_BASE) + r"([0-9a-f-]+)\.png'([^>]*?)/>")
+
+FOOTER_YEAR_RE = re.compile(r"<footer>© (\d{4}) SAFI LAB")
+
+# Same markup, in the same order, as the VBA string concatenation
+_TEMPLATE_PARTS = [
+    "<!doctype html><html lang='en'><head><meta charset='utf-8'><meta name='viewport' content='width=device-width,initial-scale=1'>",
+    "<title>SAFI LAB - ${pname}</title>",
+    "<style>",
+    "body{font-family:Inter,Segoe UI,Arial,sans-serif;background:#f8fbff;margin:0;padding:28px;color:#1b2733}",
+    ".card{max-width:820px;margin:0 auto;background:#fff;border-radius:12px;padding:26px;box-shadow:0 12px 36px rgba(4,22,46,0.06)}",
+    "header{display:flex;align-items:center;justify-content:center;flex-direction:column;margin-bottom:8px}",
+    "h1{color:#063970;margin:6px 0;font-size:22px}",
+    ".subtitle{color:#0b66a3;font-size:14px;margin-bottom:10px}",
+    ".section-title{display:flex;align-items:center;color:#074a8a;font-weight:700;margin-top:18px;margin-bottom:8px}",
+    ".icon{width:20px;height:20px;margin-right:10px;opacity:0.95}",
+    "table{width:100%;border-collapse:collapse;font-size:15px}",
+    "td{padding:10px;border-bottom:1px solid #eef6ff}",
+    "td.label{width:32%;font-weight:700;color:#233b4d}",
+    ".val{color:#0b2f4a}",
+    ".val-strong{color:#007a3d;font-weight:700}",
+    "footer{font-size:13px;color:#6b7b86;text-align:center;margin-top:16px}",
+    "</style></head><body>",
+    "<div class='card'>",
+    "<header><img src='${ico_lab}' style='width:36px;height:36px;'/><h1>SAFI LAB - Patient Report</h1><div class='subtitle'>Professional Laboratory Report</div></header>",
+    "<div class='section-title'><img src='${ico_id}' class='icon'/>Identification</div>",
+    "<table>",
+    "<tr><td class='label'><img src='${ico_id}' class='icon'/> Patient ID</td><td class='val'>${pid}</td></tr>",
+    "<tr><td class='label'><img src='${ico_person}' class='icon'/> Full Name</td><td class='val'>${pname}</td></tr>",
+    "<tr><td class='label'><img src='${ico_age}' class='icon'/> Age</td><td class='val'>${age} years</td></tr>",
+    "<tr><td class='label'><img src='${ico_gender}' class='icon'/> Gender</td><td class='val'>${gender}</td></tr>",
+    "<tr><td class='label'><img src='${ico_clinic}' class='icon'/> Clinic</td><td class='val'>${clinic}</td></tr>",
+    "<tr><td class='label'><img src='${ico_doctor}' class='icon'/> Doctor</td><td class='val'>${doctor}</td></tr>",
+    "<tr><td class='label'><img src='${ico_cal}' class='icon'/> Sample Date</td><td class='val'>${sample_date}</td></tr>",
+    "<tr><td class='label'><img src='${ico_phone}' class='icon'/> Phone</td><td class='val'>${phone}</td></tr>",
+    "<tr><td class='label'><img src='${ico_mail}' class='icon'/> Email</td><td class='val'>${email}</td></tr>",
+    "</table>",
+    "<div class='section-title'><img src='${ico_lab}' class='icon'/> Test Results</div>",
+    "<table>",
+    "<tr><td class='label'>ABS</td><td class='val-strong'>${abs}</td></tr>",
+    "<tr><td class='label'>CONC</td><td class='val-strong'>${conc}</td></tr>",
+    "<tr><td class='label'>TRANS</td><td class='val-strong'>${trans}</td></tr>",
+    "</table>",
+    "<footer>© ${year} SAFI LAB - Confidential</footer>",
+    "</div></body></html>",
+]
+
+# Record fields that appear in the report
+REPORT_FIELDS = ["id", "name", "age", "gender", "clinic", "doctor", "date",
+                 "phone", "email", "abs", "conc", "trans"]
+
+_template = None
+# One Word conversion at a time. Dispatch attaches to the one running Word for every process,
+# and a lock only covers this process: call export_pdf from a single process (generate_reports
+# runs the PDF pass in the parent, never in its pool).
+_word_lock = threading.Lock()
+
+
+def _compiled_template():
+    """Builds the report template once per process, with the icons already inlined (or their URLs filled in)."""
+    global _template
+    if _template is None:
+        html = _linked_template_html()
+        inlined = inline_icons(html)
+        if inlined == html:
+            print(f"Report icons missing from {ICON_DIR} (python report_icons.py fetch); linking the twemoji CDN")
+        _template = Template(inlined)
+    return _template
+
+
+def _linked_template_html():
+    # The template with the icons linked from the twemoji CDN, as reports were written before the bundle
+    icons = {f"ico_{key}": f"{TWEMOJI_BASE}{code}.png" for key, code in ICONS.items()}
+    return Template("".join(_TEMPLATE_PARTS)).safe_substitute(icons)
+
+
+def inline_icons(html):
+    """
+    Replaces a report's twemoji <img> tags with <use> references to one SVG
+    sprite placed after <body>, so the page loads in a single request.
+    The page is returned unchanged if any of its icons is not in the bundle.
+    """
+    codes = list(dict.fromkeys(m.group(1) for m in ICON_IMG_RE.finditer(html)))
+    if not codes or any(load_svg(code) is None for code in codes):
+        return html
+    html = ICON_IMG_RE.sub(lambda m: f"<svg{m.group(2)}><use href='#i-{m.group(1)}'/></svg>", html)
+    return html.replace("<body>", "<body>" + sprite(codes), 1)
+
+
+def template_fingerprint():
+    """Hash of the compiled template, so a layout change invalidates existing reports."""
+    return hashlib.sha256(_compiled_template().template.encode("utf-8")).hexdigest()
+
+
+def make_safe_filename(name):
+    """Matches VBA MakeSafeFileName: replaces \\ / : * ? \" < > | with '_'."""
+    for ch in ['\\', '/', ':', '*', '?', '"', '<', '>', '|']:
+        name = name.replace(ch, '_')
+    return name
+
+
+def escape_html(s):
+    """Matches VBA EscapeHtml (single quotes are left alone)."""
+    s = s.replace("&", "&amp;")
+    s = s.replace("<", "&lt;")
+    s = s.replace(">", "&gt;")
+    s = s.replace('"', "&quot;")
+    return s
+
+
+def _field(record, key):
+    # VBA: Trim(CStr(cell)) - Trim only strips spaces
+    value = record.get(key)
+    return "" if value is None else str(value).strip(" ")
+
+
+def render_report(record, year=None):
+    """Returns the report HTML for one patient record."""
+    values = {
+        "pid": _field(record, "id"),
+        "pname": _field(record, "name"),
+        "age": _field(record, "age"),
+        "gender": _field(record, "gender"),
+        "clinic": _field(record, "clinic"),
+        "doctor": _field(record, "doctor"),
+        "sample_date": _field(record, "date"),
+        "phone": _field(record, "phone"),
+        "email": _field(record, "email"),
+        "abs": _field(record, "abs"),
+        "conc": _field(record, "conc"),
+        "trans": _field(record, "trans"),
+    }
+    values = {key: escape_html(value) for key, value in values.items()}
+    values["year"] = str(year or datetime.now().year)
+    return _compiled_template().substitute(values)
+
+
+def render_reports(records, year=None):
+    """Renders a list of patient records in one call."""
+    year = year or datetime.now().year
+    return [render_report(record, year) for record in records]
+
+
+def report_inputs(record, year=None):
+    """Everything the report HTML depends on (used by the report manifest)."""
+    inputs = {key: _field(record, key) for key in REPORT_FIELDS}
+    inputs["year"] = int(year or datetime.now().year)
+    inputs["template"] = template_fingerprint()
+    return inputs
+
+
+def report_folder_name(record):
+    return make_safe_filename(f"{_field(record, 'name')}_{_field(record, 'id')}")
+
+
+def write_report(record, output_root, year=None):
+    """
+    Writes QR_Patients/<name>_<id>/patient_<id>.html and returns its path.
+
+    Like the VBA WriteTextFile_UTF8 (CreateTextFile with Unicode=True), the
+    file is UTF-16 LE with a BOM.
+    """
+    folder = os.path.join(output_root, report_folder_name(record))
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"patient_{_field(record, 'id')}.html")
+    with open(path, "wb") as f:
+        f.write(codecs.BOM_UTF16_LE + render_report(record, year).encode("utf-16-le"))
+    return path
+
+
+def rewrite_reports(output_root, records=()):
+    """
+    Inlines the icons of reports already in QR_Patients (written before the
+    bundle existed), keeping each file's encoding. Returns the rewritten paths.
+
+    Each folder's report manifest follows the rewrite: an entry that matched
+    the old file and its patient in `records` is re-recorded against the
+    bundled template, any other entry for a rewritten file is dropped so the
+    next generation rebuilds it instead of trusting a stale hash.
+    """
+    by_folder = {report_folder_name(record): record for record in records}
+    linked_fingerprint = hashlib.sha256(_linked_template_html().encode("utf-8")).hexdigest()
+    changed = []
+    for folder, _, names in os.walk(output_root):
+        manifest = None
+        for name in names:
+            if not (name.startswith("patient_") and name.endswith(".html")): continue
+            path = os.path.join(folder, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            utf16 = data.startswith(codecs.BOM_UTF16_LE)
+            html = data[len(codecs.BOM_UTF16_LE):].decode("utf-16-le") if utf16 else data.decode("utf-8-sig")
+            inlined = inline_icons(html)
+            if inlined == html: continue
+            old_hash = hashlib.sha256(data).hexdigest()
+            with open(path + ".tmp", "wb") as f:
+                f.write(codecs.BOM_UTF16_LE + inlined.encode("utf-16-le") if utf16 else inlined.encode("utf-8"))
+            os.replace(path + ".tmp", path)
+            changed.append(path)
+
+            manifest = manifest or ReportManifest(folder)
+            entry = manifest.entries.get(name)
+            record = by_folder.get(os.path.basename(folder))
+            year = FOOTER_YEAR_RE.search(html)
+            if entry and record and year and entry.get("output") == old_hash:
+                inputs = report_inputs(record, int(year.group(1)))
+                if entry.get("input") == input_hash(dict(inputs, template=linked_fingerprint)):
+                    manifest.record(name, inputs)
+                    continue
+            manifest.forget(name)
+        if manifest: manifest.save()
+    return changed
+
+
+def write_reports(records, output_root, year=None):
+    """Writes reports for many patients. Returns the list of HTML paths."""
+    year = year or datetime.now().year
+    return [write_report(record, output_root, year) for record in records]
+
+
+def export_pdf(html_path, pdf_path):
+    """Converts a report to PDF through Word, like the VBA ConvertHTMLToPDF_UsingWord (Windows only)."""
+    import pythoncom
+    import win32com.client
+    with _word_lock:
+        pythoncom.CoInitialize()
+        try:
+            word = win32com.client.Dispatch("Word.Application")
+            word.Visible = False
+            try:
+                doc = word.Documents.Open(html_path)
+                doc.ExportAsFixedFormat(pdf_path, 17) # wdExportFormatPDF
+                doc.Close(False)
+            finally:
+                word.Quit()
+        finally:
+            pythoncom.CoUninitialize()
@@ -0,0 +1,189 @@
+# SAFI LAB - In-process patient search index (normalized tokens + trigrams)
+import heapq
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from patient_store import sort_records
+from patients import normalize_id
+
+# Field -> weight in the ranking
+FIELD_WEIGHTS = {"id": 5, "name": 4, "phone": 3, "clinic": 1, "doctor": 1}
+# Match kinds, multiplied by the field weight
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+
+# Arabic letter variants folded to one form (alef/hamza, alef maqsura, taa marbuta)
+_ARABIC_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ؤ": "و", "ئ": "ي", "ى": "ي", "ة": "ه",
+    "ـ": None,  # tatweel
+})
+_TOKEN_RE = re.compile(r"\w+")
+_PHONE_QUERY_RE = re.compile(r"^[\d\s+\-().]+$")
+
+
+def normalize_text(text):
+    """
+    Folds text for matching: case, Latin accents, Arabic diacritics and
+    letter variants, Arabic-Indic digits.
+    """
+    text = unicodedata.normalize("NFKD", str(text or "").translate(_ARABIC_FOLD))
+    chars = []
+    for ch in text:
+        if unicodedata.category(ch) == "Mn":
+            continue  # combining marks: accents, harakat, hamza above/below
+        if ch.isdigit():
+            ch = str(unicodedata.digit(ch, ch))
+        chars.append(ch)
+    return "".join(chars).translate(_ARABIC_FOLD).casefold()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(normalize_text(text))
+
+
+def phone_digits(text):
+    return "".join(ch for ch in normalize_text(text) if ch.isdigit())
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class SearchIndex:
+    """
+    Ranked patient search over id, name, phone digits, clinic and doctor.
+
+    Every field is reduced to normalized tokens; exact tokens, prefixes and
+    substrings (through a trigram index) score by field weight. All query
+    tokens must match. A query that is only digits and phone punctuation is
+    matched as one digit string, so "079 123-4567" finds "0791234567".
+    Updated incrementally with add() / remove().
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._docs = {}                    # key -> (order, record, {field: tokens})
+        self._tokens = defaultdict(set)    # token -> {(key, field)}
+        self._grams = defaultdict(set)     # trigram -> {token} (over the vocabulary, not per patient)
+        self._next_order = 0
+        self.ready = False
+
+    # --- Building ---
+    def _fields(self, record):
+        fields = {}
+        for field in FIELD_WEIGHTS:
+            value = record.get(field, "")
+            tokens = [phone_digits(value)] if field == "phone" else tokenize(value)
+            fields[field] = [t for t in tokens if t]
+        return fields
+
+    def add(self, record):
+        """Adds or replaces a patient."""
+        key = normalize_id(record.get("id", ""))
+        if not key: return
+        with self._lock:
+            order = self._remove(key)
+            if order is None:
+                order = self._next_order
+                self._next_order += 1
+            fields = self._fields(record)
+            self._docs[key] = (order, dict(record), fields)
+            for field, tokens in fields.items():
+                posting = (key, field)
+                for token in tokens:
+                    postings = self._tokens.get(token)
+                    if postings is None:
+                        postings = self._tokens[token] = set()
+                        for gram in trigrams(token):
+                            self._grams[gram].add(token)
+                    postings.add(posting)
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None: return None
+        order, _, fields = doc
+        for field, tokens in fields.items():
+            posting = (key, field)
+            for token in tokens:
+                postings = self._tokens.get(token)
+                if postings is None: continue
+                postings.discard(posting)
+                if postings: continue
+                # Last patient with this token: drop it from the vocabulary
+                del self._tokens[token]
+                for gram in trigrams(token):
+                    grams = self._grams.get(gram)
+                    if grams is not None:
+                        grams.discard(token)
+                        if not grams: del self._grams[gram]
+        return order
+
+    def remove(self, pid):
+        with self._lock:
+            return self._remove(normalize_id(pid)) is not None
+
+    def rebuild(self, records):
+        """Replaces the whole index (records in sheet order)."""
+        with self._lock:
+            self._docs.clear()
+            self._tokens.clear()
+            self._grams.clear()
+            self._next_order = 0
+            for record in records:
+                self.add(record)
+            self.ready = True
+
+    # --- Querying ---
+    def _match(self, term):
+        """Returns {key: best score} for one query term."""
+        if len(term) >= 3:
+            grams = sorted((self._grams.get(g, set()) for g in trigrams(term)), key=len)
+            tokens = set.intersection(*grams) if grams[0] else set()
+        else:
+            # Too short for trigrams: prefix scan of the vocabulary
+            tokens = [token for token in self._tokens if token.startswith(term)]
+
+        scores = {}
+        for token in tokens:
+            if token == term: kind = EXACT
+            elif token.startswith(term): kind = PREFIX
+            elif term in token: kind = SUBSTRING
+            else: continue
+            for key, field in self._tokens[token]:
+                score = kind * FIELD_WEIGHTS[field]
+                if score > scores.get(key, 0):
+                    scores[key] = score
+        return scores
+
+    def search(self, query, offset=0, limit=50, sort=None):
+        """
+        Returns (records, total) for one page of matches. Without `sort`,
+        results are ranked by score, then sheet order.
+        """
+        query = str(query or "")
+        if _PHONE_QUERY_RE.match(query) and len(phone_digits(query)) >= 3:
+            terms = [phone_digits(query)]
+        else:
+            terms = tokenize(query)
+        if not terms: return [], 0
+
+        with self._lock:
+            scores = None
+            for term in dict.fromkeys(terms):
+                matched = self._match(term)
+                scores = matched if scores is None else {k: scores[k] + v for k, v in matched.items() if k in scores}
+                if not scores: return [], 0
+            offset, limit = max(0, int(offset)), max(0, int(limit))
+            docs = self._docs
+            rank = lambda k: (-scores[k], docs[k][0])
+            if sort:
+                records = sort_records([docs[k][1] for k in sorted(scores, key=rank)], sort)
+                return records[offset:offset + limit], len(scores)
+            # Only the requested page has to be ordered
+            ranked = heapq.nsmallest(offset + limit, scores, key=rank)[offset:]
+            return [docs[k][1] for k in ranked], len(scores)
+
+    def __len__(self):
+        return len(self._docs)
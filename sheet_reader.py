@@ -0,0 +1,238 @@
+# SAFI LAB - Streaming .xlsx/.xlsm sheet reader with column projection (openpyxl fallback)
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import ParseError, fromstring, iterparse
+
+from metrics import phase
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+ROW_TAG = MAIN_NS + "row"
+CELL_TAG = MAIN_NS + "c"
+VALUE_TAG = MAIN_NS + "v"
+INLINE_TAG = MAIN_NS + "is"
+STRING_TAG = MAIN_NS + "si"
+TEXT_TAG = MAIN_NS + "t"
+DIGITS = "0123456789"
+# First element of the sheet part (skipping the <?xml ...?> declaration)
+ROOT_RE = re.compile(rb"<([A-Za-z_][\w.:-]*)(?:\s[^>]*)?>")
+READ_CHUNK = 1024 * 1024
+_COLUMNS = {}   # column letters -> 0-based index
+
+
+class UnsupportedCell(Exception):
+    """The fast reader met something it does not decode; read_sheet() falls back to openpyxl."""
+
+
+def _column_index(letters):
+    """'A' -> 0, 'S' -> 18, 'AB' -> 27."""
+    index = _COLUMNS.get(letters)
+    if index is None:
+        index = 0
+        for ch in letters:
+            index = index * 26 + ord(ch) - 64
+        index = _COLUMNS[letters] = index - 1
+    return index
+
+
+def _part_targets(zf, rels_path, base):
+    """Relationship id -> (type, part path) for a .rels file."""
+    targets = {}
+    with zf.open(rels_path) as f:
+        for _, node in iterparse(f):
+            if node.tag == PKG_REL_NS + "Relationship":
+                target = node.get("Target")
+                path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(base, target))
+                targets[node.get("Id")] = (node.get("Type", "").rsplit("/", 1)[-1], path)
+    return targets
+
+
+def _workbook_parts(zf, sheet_name):
+    """Returns (sheet part, sharedStrings part or None, styles part or None, date1904). No name: the first sheet."""
+    sheet_rid, date1904 = None, False
+    with zf.open("xl/workbook.xml") as f:
+        for _, node in iterparse(f):
+            if node.tag == MAIN_NS + "sheet" and sheet_rid is None and sheet_name in (None, node.get("name")):
+                sheet_rid = node.get(REL_NS + "id")
+            elif node.tag == MAIN_NS + "workbookPr":
+                date1904 = node.get("date1904", "").lower() in ("1", "true")
+    if sheet_rid is None:
+        raise KeyError(f"Worksheet {sheet_name} does not exist.")
+    targets = _part_targets(zf, "xl/_rels/workbook.xml.rels", "xl")
+    by_type = {kind: path for kind, path in targets.values()}
+    return targets[sheet_rid][1], by_type.get("sharedStrings"), by_type.get("styles"), date1904
+
+
+def _text(node):
+    """Text of an <si> or <is> element. Plain <t> directly; rich text and _xHHHH_ escapes the way openpyxl does."""
+    if len(node) == 1 and node[0].tag == TEXT_TAG:
+        text = node[0].text or ""
+        if "_x" not in text: return text
+    from openpyxl.cell.text import Text
+    return Text.from_tree(node).content
+
+
+def _read_shared_strings(zf, part):
+    strings = []
+    if part is None: return strings
+    with zf.open(part) as f:
+        for _, node in iterparse(f):
+            if node.tag != STRING_TAG: continue
+            strings.append(_text(node).replace('x005F_', ''))
+            node.clear()
+    return strings
+
+
+def _read_date_styles(zf, part):
+    """Returns (style ids with a date format, style ids with a timedelta format), as openpyxl decides them."""
+    from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+    dates, timedeltas = set(), set()
+    if part is None: return dates, timedeltas
+    custom, in_xfs, xfs = {}, False, []
+    with zf.open(part) as f:
+        for event, node in iterparse(f, events=("start", "end")):
+            if node.tag == MAIN_NS + "cellXfs":
+                in_xfs = event == "start"
+            elif event == "end" and node.tag == MAIN_NS + "numFmt":
+                custom[int(node.get("numFmtId"))] = node.get("formatCode")
+            elif event == "end" and in_xfs and node.tag == MAIN_NS + "xf":
+                xfs.append(int(node.get("numFmtId", 0)))
+    for style_id, fmt_id in enumerate(xfs):
+        fmt = custom[fmt_id] if fmt_id in custom else builtin_format_code(fmt_id)
+        if is_date_format(fmt): dates.add(style_id)
+        if is_timedelta_format(fmt): timedeltas.add(style_id)
+    return dates, timedeltas
+
+
+def _row_batches(zf, part):
+    """
+    Yields the <row> elements of a worksheet part, parsed a chunk of complete
+    rows at a time (one C-level parse per chunk instead of a Python event per
+    element). Each chunk is wrapped in the sheet's own root tag so namespace
+    prefixes resolve.
+    """
+    with zf.open(part) as f:
+        buffer = b""
+        while ROOT_RE.search(buffer) is None:
+            chunk = f.read(READ_CHUNK)
+            if not chunk: raise UnsupportedCell("No worksheet root element")
+            buffer += chunk
+        root = ROOT_RE.search(buffer)
+        prefix = root.group(1).rpartition(b":")[0]
+        prefix = prefix + b":" if prefix else b""
+        opening, closing = root.group(0), b"</" + root.group(1) + b">"
+        row_end, data_end = b"</" + prefix + b"row>", b"</" + prefix + b"sheetData>"
+        start = buffer.find(b"<" + prefix + b"sheetData")
+        while start < 0 or buffer.find(b">", start) < 0:
+            chunk = f.read(READ_CHUNK)
+            if not chunk: return
+            buffer += chunk
+            start = buffer.find(b"<" + prefix + b"sheetData")
+        tag_end = buffer.find(b">", start)
+        if buffer[tag_end - 1:tag_end] == b"/": return   # <sheetData/>
+        buffer = buffer[tag_end + 1:]
+
+        while True:
+            chunk = f.read(READ_CHUNK)
+            done = not chunk
+            buffer += chunk
+            end = buffer.find(data_end)
+            if end >= 0:
+                complete, buffer, done = buffer[:end], b"", True
+            else:
+                cut = buffer.rfind(row_end)
+                if cut < 0 and not done: continue
+                cut = cut + len(row_end) if cut >= 0 else len(buffer)
+                complete, buffer = buffer[:cut], buffer[cut:]
+            if complete.strip():
+                yield fromstring(opening + complete + closing)
+            if done: return
+
+
+def iter_sheet(path, sheet_name, columns, min_row=1):
+    """
+    Streams a worksheet straight from the zip and yields (row number, values)
+    for every row from `min_row`, with values for `columns` (0-based) only.
+    `sheet_name` None reads the first sheet.
+    Values are what openpyxl's read_only/data_only mode gives (str, int,
+    float, bool, datetime). Raises UnsupportedCell for anything else.
+    """
+    from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+    wanted = {col: i for i, col in enumerate(columns)}
+    width = len(columns)
+
+    with zipfile.ZipFile(path) as zf:
+        sheet_part, strings_part, styles_part, date1904 = _workbook_parts(zf, sheet_name)
+        strings = _read_shared_strings(zf, strings_part)
+        dates, timedeltas = _read_date_styles(zf, styles_part)
+        epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+        row_number = 0
+        for rows in _row_batches(zf, sheet_part):
+            for node in rows:
+                if node.tag != ROW_TAG: continue
+                r = node.get("r")
+                row_number = int(r) if r else row_number + 1
+                if row_number < min_row: continue
+                values = [None] * width
+                col = -1
+                for cell in node:
+                    if cell.tag != CELL_TAG: continue
+                    ref = cell.get("r")
+                    col = _column_index(ref.rstrip(DIGITS)) if ref else col + 1
+                    slot = wanted.get(col)
+                    if slot is None: continue
+                    kind = cell.get("t", "n")
+                    if kind == "inlineStr":
+                        child = cell.find(INLINE_TAG)
+                        values[slot] = _text(child) if child is not None else None
+                        continue
+                    text = cell.findtext(VALUE_TAG) or None
+                    if text is None: continue
+                    if kind == "n":
+                        value = float(text) if ("." in text or "E" in text or "e" in text) else int(text)
+                        style = int(cell.get("s", 0))
+                        if style in dates:
+                            try:
+                                value = from_excel(value, epoch, timedelta=style in timedeltas)
+                            except (OverflowError, ValueError):
+                                raise UnsupportedCell(f"{ref}: date serial {value} out of range")
+                        values[slot] = value
+                    elif kind == "s":
+                        values[slot] = strings[int(text)]
+                    elif kind in ("str", "e"):
+                        values[slot] = text
+                    elif kind == "b":
+                        values[slot] = bool(int(text))
+                    else:
+                        raise UnsupportedCell(f"{ref}: cell type {kind!r}")
+                yield row_number, tuple(values)
+
+
+def iter_sheet_openpyxl(path, sheet_name, columns, min_row=1):
+    """Same rows and values as iter_sheet(), through openpyxl's read-only mode."""
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name else wb.worksheets[0]
+        for offset, row in enumerate(ws.iter_rows(min_row=min_row, values_only=True)):
+            yield min_row + offset, tuple(row[col] if col < len(row) else None for col in columns)
+    finally:
+        wb.close()
+
+
+def read_sheet(path, sheet_name, columns, min_row=1):
+    """
+    Returns [(row number, values)] for `columns` of a sheet. Uses the
+    streaming reader and re-reads with openpyxl if it meets a cell it does
+    not support (or the file is not a plain xlsx/xlsm zip).
+    """
+    with phase("workbook.read_fast"):
+        try:
+            return list(iter_sheet(path, sheet_name, columns, min_row))
+        except (UnsupportedCell, ParseError, zipfile.BadZipFile) as e:
+            print(f"Fast sheet reader fell back to openpyxl: {e}")
+    with phase("workbook.read_openpyxl"):
+        return list(iter_sheet_openpyxl(path, sheet_name, columns, min_row))
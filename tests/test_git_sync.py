@@ -0,0 +1,129 @@
+# SAFI LAB - GitSyncWorker against a local bare origin
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from git_sync import GitSyncWorker, find_git
+
+pytestmark = pytest.mark.skipif(find_git() is None, reason="git not installed")
+
+
+def git(cwd, *args):
+    return subprocess.run(["git"] + list(args), cwd=cwd, capture_output=True, text=True, check=True).stdout
+
+
+@pytest.fixture
+def repo(tmp_path):
+    origin = tmp_path / "origin.git"
+    work = tmp_path / "work"
+    git(tmp_path, "init", "-q", "--bare", str(origin))
+    git(tmp_path, "init", "-q", "-b", "master", str(work))
+    git(work, "config", "user.email", "lab@example.invalid")
+    git(work, "config", "user.name", "SAFI LAB")
+    git(work, "remote", "add", "origin", str(origin))
+    (work / "README").write_text("reports\n")
+    git(work, "add", "README")
+    git(work, "commit", "-q", "-m", "init")
+    return work, origin
+
+
+def write_report(work, folder, pid):
+    path = work / "QR_Patients" / folder
+    path.mkdir(parents=True, exist_ok=True)
+    (path / f"patient_{pid}.html").write_text(f"report {pid}")
+    return str(path)
+
+
+def pushed_files(origin):
+    return git(origin, "ls-tree", "-r", "--name-only", "master").split()
+
+
+def test_requests_are_committed_and_pushed(repo):
+    work, origin = repo
+    worker = GitSyncWorker(str(work), debounce=0.05)
+    try:
+        worker.request("Update report for patient 1", [write_report(work, "a_1", "1")])
+        worker.request("Update report for patient 2", [write_report(work, "b_2", "2")])
+        assert worker.flush(timeout=30)
+        assert worker.status()["pending"] == 0
+    finally:
+        worker.close()
+    assert "QR_Patients/a_1/patient_1.html" in pushed_files(origin)
+    assert "QR_Patients/b_2/patient_2.html" in pushed_files(origin)
+
+
+def test_generate_then_delete_within_debounce_does_not_wedge(repo):
+    work, origin = repo
+    worker = GitSyncWorker(str(work), debounce=0.2, max_retries=1, retry_delay=0.05)
+    try:
+        folder = write_report(work, "gone_1", "1")
+        worker.request("Update report for patient 1", [folder])
+        shutil.rmtree(folder)
+        worker.request("Delete patient 1", [folder])
+        assert worker.flush(timeout=30)
+
+        worker.request("Update report for patient 2", [write_report(work, "kept_2", "2")])
+        assert worker.flush(timeout=30)
+        status = worker.status()
+        assert status["pending"] == 0
+        assert status["state"] == "idle"
+    finally:
+        worker.close()
+    files = pushed_files(origin)
+    assert "QR_Patients/kept_2/patient_2.html" in files
+    assert not any(f.startswith("QR_Patients/gone_1/") for f in files)
+
+
+def test_deleting_a_pushed_report_is_synced(repo):
+    work, origin = repo
+    worker = GitSyncWorker(str(work), debounce=0.05)
+    try:
+        folder = write_report(work, "old_3", "3")
+        worker.request("Update report for patient 3", [folder])
+        assert worker.flush(timeout=30)
+        shutil.rmtree(folder)
+        worker.request("Delete patient 3", [folder])
+        assert worker.flush(timeout=30)
+    finally:
+        worker.close()
+    assert not any(f.startswith("QR_Patients/old_3/") for f in pushed_files(origin))
+
+
+def test_failed_commit_is_reported_not_pushed(repo):
+    work, origin = repo
+    hook = work / ".git" / "hooks" / "pre-commit"
+    hook.write_text("#!/bin/sh\necho 'rejected by hook' >&2\nexit 1\n")
+    hook.chmod(0o755)
+    worker = GitSyncWorker(str(work), debounce=0.05, max_retries=1, retry_delay=0.05)
+    try:
+        worker.request("Update report for patient 4", [write_report(work, "hook_4", "4")])
+        assert not worker.flush(timeout=30)
+        status = worker.status()
+        assert status["state"] == "error"
+        assert status["pending"] == 1
+        assert "rejected by hook" in status["last_error"]
+        assert status["last_pushed_at"] is None
+    finally:
+        worker.close(timeout=5)
+    # Nothing was committed, so nothing reached the origin
+    assert git(origin, "branch", "--list").strip() == ""
+
+
+def test_nothing_to_commit_still_pushes(repo):
+    work, origin = repo
+    worker = GitSyncWorker(str(work), debounce=0.05)
+    try:
+        worker.request("Update report for patient 5", [write_report(work, "same_5", "5")])
+        assert worker.flush(timeout=30)
+        # Same content again: git has nothing to commit, which is not an error
+        worker.request("Update report for patient 5", [write_report(work, "same_5", "5")])
+        assert worker.flush(timeout=30)
+        assert worker.status()["last_error"] is None
+    finally:
+        worker.close()
+    assert "QR_Patients/same_5/patient_5.html" in pushed_files(origin)
@@ -1,29 +1,36 @@
 // Global State
-let allPatients = [];
 let currentPatientId = null;
 
 // Initialization
+const SPLASH_MAX_WAIT = 10000;   // hide the splash even if the first load never finishes
+
 document.addEventListener('DOMContentLoaded', () => {
-    // Splash Screen Logic
-    setTimeout(() => {
-        const splash = document.getElementById('splash-screen');
-        if (splash) {
-            splash.classList.add('fade-out');
-            setTimeout(() => {
-                splash.remove();
-            }, 1000); // Wait for transition
-        }
-    }, 4000); // Show for 4 seconds
+    // Splash stays up until the first page of patients is on screen
+    setTimeout(hideSplash, SPLASH_MAX_WAIT);
 
     updateClock();
     setInterval(updateClock, 1000);
+    initPatientTable();
 
     // Initial Load
-    window.addEventListener('pywebviewready', function () {
-        loadPatients();
+    window.addEventListener('pywebviewready', async function () {
+        await loadPatients();
+        requestAnimationFrame(() => {
+            hideSplash();
+            window.pywebview.api.startup_ready();
+        });
     });
 });
 
+function hideSplash() {
+    const splash = document.getElementById('splash-screen');
+    if (!splash || splash.classList.contains('fade-out')) return;
+    splash.classList.add('fade-out');
+    setTimeout(() => {
+        splash.remove();
+    }, 1000); // Wait for transition
+}
+
 // Navigation
 function switchTab(tabId) {
     // Update Nav Buttons
@@ -42,6 +49,7 @@ function switchTab(tabId) {
         'settings': 'Settings'
     };
     document.getElementById('page-title').innerText = titles[tabId];
+    if (tabId === 'settings') loadMetrics();
 }
 
 // Theme
@@ -71,11 +79,28 @@ function showToast(message) {
 
 // --- API Calls ---
 
+// Patient table: pages are fetched from Python on demand and only the
+// rows in view (plus a small overscan) are in the DOM.
+const PAGE_SIZE = 200;
+const OVERSCAN = 10;
+const SEARCH_DELAY = 250;
+const table = {
+    sort: '',
+    filter: '',
+    total: 0,
+    pages: new Map(),     // page index -> rows
+    stale: new Map(),     // previous pages, shown until a refresh arrives
+    loading: new Set(),   // page indexes being fetched
+    generation: 0,        // bumped on every reset so stale responses are dropped
+    rowHeight: 0,
+    frame: null
+};
+let searchTimer = null;
+
 async function loadPatients() {
     try {
-        const response = await window.pywebview.api.get_patients();
-        allPatients = JSON.parse(response);
-        renderTable(allPatients);
+        resetTable();
+        await fetchPage(0);
         showToast('Patients Loaded');
     } catch (error) {
         console.error('Error loading patients:', error);
@@ -83,40 +108,174 @@ async function loadPatients() {
     }
 }
 
-function renderTable(patients) {
-    const tbody = document.getElementById('patient-table-body');
-    tbody.innerHTML = '';
-
-    patients.forEach(p => {
-        const tr = document.createElement('tr');
-        tr.onclick = () => selectPatient(p.id);
-        tr.innerHTML = `
-            <td>${p.id}</td>
-            <td>${p.name}</td>
-            <td>${p.age}</td>
-            <td>${p.gender}</td>
-            <td>${p.date || ''}</td>
-        `;
-        tbody.appendChild(tr);
+function resetTable() {
+    table.generation++;
+    table.pages.clear();
+    table.stale.clear();
+    table.loading.clear();
+    table.total = 0;
+    const container = document.querySelector('.table-container');
+    if (container) container.scrollTop = 0;
+}
+
+async function fetchPage(page) {
+    if (table.pages.has(page) || table.loading.has(page)) return;
+    const generation = table.generation;
+    table.loading.add(page);
+    try {
+        const response = await window.pywebview.api.query_patients(
+            page * PAGE_SIZE, PAGE_SIZE, table.sort, table.filter);
+        if (generation !== table.generation) return;
+        const data = JSON.parse(response);
+        table.total = data.total;
+        table.pages.set(page, data.rows);
+        scheduleRender();
+    } finally {
+        if (generation === table.generation) table.loading.delete(page);
+    }
+}
+
+function scheduleRender() {
+    if (table.frame) return;
+    table.frame = requestAnimationFrame(() => {
+        table.frame = null;
+        renderTable();
     });
 }
 
+function patientAt(index) {
+    const page = table.pages.get(Math.floor(index / PAGE_SIZE)) || table.stale.get(Math.floor(index / PAGE_SIZE));
+    return page ? page[index % PAGE_SIZE] : null;
+}
+
+// Refetches pages in view without clearing the screen or the scroll position
+function refreshTable() {
+    table.generation++;
+    table.stale = new Map([...table.stale, ...table.pages]);
+    table.pages.clear();
+    table.loading.clear();
+    scheduleRender();
+}
+
+// Called from Python with the rows that changed: {added, changed, removed, total}
+function onPatientsChanged(delta) {
+    // Changed rows are patched in place in the loaded pages
+    const changed = new Map(delta.changed.map(p => [p.id, p]));
+    let patched = false;
+    for (const pages of [table.pages, table.stale]) {
+        pages.forEach(rows => rows.forEach((p, i) => {
+            if (changed.has(p.id)) {
+                rows[i] = changed.get(p.id);
+                patched = true;
+            }
+        }));
+    }
+    // Added or removed rows shift positions: refetch the visible pages
+    if (delta.added.length || delta.removed.length) {
+        refreshTable();
+    } else if (patched) {
+        scheduleRender();
+    }
+    if (currentPatientId && delta.removed.includes(currentPatientId)) {
+        currentPatientId = null;
+        updateStatusIndicators(null);
+    }
+}
+
+function escapeHtml(value) {
+    return String(value ?? '').replace(/[&<>"']/g, ch => (
+        { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[ch]));
+}
+
+function spacerRow(height) {
+    return height > 0 ? `<tr class="spacer" style="height:${height}px"><td colspan="5"></td></tr>` : '';
+}
+
+function renderTable() {
+    const container = document.querySelector('.table-container');
+    const tbody = document.getElementById('patient-table-body');
+    const rowHeight = table.rowHeight || 33;
+    const headerHeight = container.querySelector('thead').offsetHeight;
+    const scrollTop = Math.max(0, container.scrollTop - headerHeight);
+
+    const first = Math.max(0, Math.floor(scrollTop / rowHeight) - OVERSCAN);
+    const last = Math.min(table.total, Math.ceil((scrollTop + container.clientHeight) / rowHeight) + OVERSCAN);
+
+    // Fetch any page in view that is not loaded yet
+    for (let page = Math.floor(first / PAGE_SIZE); page <= Math.floor(Math.max(first, last - 1) / PAGE_SIZE); page++) {
+        if (page * PAGE_SIZE < table.total) fetchPage(page);
+    }
+
+    let html = spacerRow(first * rowHeight);
+    for (let i = first; i < last; i++) {
+        const p = patientAt(i);
+        if (!p) {
+            html += '<tr class="placeholder"><td colspan="5">&hellip;</td></tr>';
+            continue;
+        }
+        const selected = p.id === currentPatientId ? ' class="selected"' : '';
+        html += `<tr data-id="${escapeHtml(p.id)}"${selected}>
+            <td>${escapeHtml(p.id)}</td>
+            <td>${escapeHtml(p.name)}</td>
+            <td>${escapeHtml(p.age)}</td>
+            <td>${escapeHtml(p.gender)}</td>
+            <td>${escapeHtml(p.date || '')}</td>
+        </tr>`;
+    }
+    html += spacerRow((table.total - last) * rowHeight);
+    tbody.innerHTML = html;
+
+    // Measure the real row height once rows are on screen
+    if (!table.rowHeight) {
+        const row = tbody.querySelector('tr[data-id]');
+        if (row && row.offsetHeight) {
+            table.rowHeight = row.offsetHeight;
+            scheduleRender();
+        }
+    }
+}
+
 function filterPatients() {
-    const query = document.getElementById('search-input').value.toLowerCase();
-    const filtered = allPatients.filter(p =>
-        p.name.toLowerCase().includes(query) ||
-        p.id.toLowerCase().includes(query)
-    );
-    renderTable(filtered);
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+        const query = document.getElementById('search-input').value.trim();
+        if (query === table.filter) return;
+        table.filter = query;
+        resetTable();
+        fetchPage(0);
+    }, SEARCH_DELAY);
+}
+
+function sortPatients(field) {
+    // Same column toggles ascending -> descending -> sheet order
+    if (table.sort === field) table.sort = '-' + field;
+    else if (table.sort === '-' + field) table.sort = '';
+    else table.sort = field;
+    document.querySelectorAll('.patient-table th[data-sort]').forEach(th => {
+        th.classList.toggle('sort-asc', table.sort === th.dataset.sort);
+        th.classList.toggle('sort-desc', table.sort === '-' + th.dataset.sort);
+    });
+    resetTable();
+    fetchPage(0);
+}
+
+function initPatientTable() {
+    const container = document.querySelector('.table-container');
+    container.addEventListener('scroll', scheduleRender, { passive: true });
+    window.addEventListener('resize', scheduleRender);
+    // One delegated handler instead of one per row
+    document.getElementById('patient-table-body').addEventListener('click', (event) => {
+        const row = event.target.closest('tr[data-id]');
+        if (row) selectPatient(row.dataset.id);
+    });
 }
 
 async function selectPatient(id) {
     currentPatientId = id;
 
     // Highlight Row
-    const rows = document.querySelectorAll('.patient-table tr');
-    rows.forEach(r => r.classList.remove('selected'));
-    // (Simple highlight logic, could be improved with ID lookup)
+    document.querySelectorAll('#patient-table-body tr[data-id]').forEach(r =>
+        r.classList.toggle('selected', r.dataset.id === id));
 
     try {
         const response = await window.pywebview.api.get_patient_details(id);
@@ -238,7 +397,7 @@ async function savePatient() {
         const result = await window.pywebview.api.save_patient(JSON.stringify(data));
         if (result) {
             showToast('Patient Saved Successfully');
-            loadPatients(); // Refresh list
+            // The table is patched by onPatientsChanged
             selectPatient(data.id);
         } else {
             showToast('Failed to save');
@@ -265,7 +424,6 @@ async function deletePatient() {
         if (result) {
             showToast('Patient Deleted');
             clearForm();
-            loadPatients();
         } else {
             showToast('Delete failed');
         }
@@ -276,36 +434,120 @@ async function deletePatient() {
     }
 }
 
+// Background jobs: the API returns a job id at once and pushes onJobUpdate()
+const jobs = new Map();           // job id -> latest job state
+const reportJobs = new Map();     // job id -> { pid, name } for single reports
+const FINISHED_STATES = ['done', 'failed', 'cancelled'];
+
 async function generateReport() {
     if (!currentPatientId) {
         showToast('Save patient first');
         return;
     }
 
-    setLoading(true);
-    showToast('Generating Report... Please Wait');
-
     try {
-        const result = await window.pywebview.api.generate_report(currentPatientId);
-        const res = JSON.parse(result);
-
+        const pid = currentPatientId;
+        const name = document.getElementById('p-name').value;
+        const res = JSON.parse(await window.pywebview.api.generate_report(pid));
         if (res.success) {
-            showToast('Report Generated!');
-            switchTab('reports');
-            const name = document.getElementById('p-name').value;
-            updateQRPreview(name, currentPatientId);
-            selectPatient(currentPatientId);
+            reportJobs.set(res.job_id, { pid, name });
+            showToast('Report queued');
         } else {
             showToast('Generation Failed: ' + res.message);
         }
     } catch (error) {
         console.error(error);
         showToast('Error calling generator');
-    } finally {
-        setLoading(false);
     }
 }
 
+async function generateAllReports() {
+    if (!confirm('Generate reports for all patients?')) return;
+
+    try {
+        const res = JSON.parse(await window.pywebview.api.generate_reports('all'));
+        showToast(res.message);
+    } catch (error) {
+        console.error(error);
+        showToast('Error calling batch generator');
+    }
+}
+
+async function exportReports() {
+    const filter = {
+        clinic: document.getElementById('export-clinic').value,
+        doctor: document.getElementById('export-doctor').value,
+        date_from: document.getElementById('export-from').value,
+        date_to: document.getElementById('export-to').value,
+        merge_pdf: document.getElementById('export-merge-pdf').checked
+    };
+    try {
+        const res = JSON.parse(await window.pywebview.api.export_reports(JSON.stringify(filter)));
+        showToast(res.message);
+    } catch (error) {
+        console.error(error);
+        showToast('Error starting report export');
+    }
+}
+
+async function cancelJob(jobId) {
+    try {
+        const res = JSON.parse(await window.pywebview.api.cancel_job(jobId));
+        showToast(res.message);
+    } catch (error) {
+        console.error(error);
+    }
+}
+
+// Called from Python on every job state/stage change
+function onJobUpdate(job) {
+    jobs.set(job.id, job);
+    renderJobs();
+    if (!FINISHED_STATES.includes(job.state)) return;
+
+    // Finished jobs leave the list after a while
+    setTimeout(() => {
+        jobs.delete(job.id);
+        renderJobs();
+    }, 10000);
+
+    const report = reportJobs.get(job.id);
+    reportJobs.delete(job.id);
+    if (job.state === 'done') {
+        showToast(report ? 'Report Generated!' : job.message);
+        if (report && report.pid === currentPatientId) {
+            updateQRPreview(report.name, report.pid);
+            selectPatient(report.pid);
+        }
+    } else if (job.state === 'failed') {
+        showToast('Generation Failed: ' + job.message);
+    } else {
+        showToast(`${job.label} cancelled`);
+    }
+}
+
+function renderJobs() {
+    const list = document.getElementById('job-list');
+    if (!list) return;
+    if (!jobs.size) {
+        list.innerHTML = '<p class="status-text">No report jobs running</p>';
+        return;
+    }
+    list.innerHTML = [...jobs.values()].reverse().map(job => {
+        const finished = FINISHED_STATES.includes(job.state);
+        const detail = finished ? job.message : (job.stage || job.state) + (job.message ? ` ${job.message}` : '');
+        return `<div class="job-item ${job.state}">
+            <div class="job-info">
+                <span class="job-label">${escapeHtml(job.label)}</span>
+                <span class="job-detail">${escapeHtml(detail)}</span>
+                <div class="job-progress"><div style="width:${Math.round(job.progress * 100)}%"></div></div>
+            </div>
+            ${finished ? '' : `<button class="btn-outline" title="Cancel" onclick="cancelJob('${job.id}')">
+                <span class="material-icons-round">close</span></button>`}
+        </div>`;
+    }).join('');
+}
+
 async function updateQRPreview(name, id) {
     try {
         const qrData = await window.pywebview.api.get_qr_data(name, id);
@@ -361,6 +603,85 @@ function openVercel() {
     window.pywebview.api.open_vercel();
 }
 
+// Excel Sync
+async function syncFromExcel() {
+    setLoading(true);
+    try {
+        const res = JSON.parse(await window.pywebview.api.sync_from_excel());
+        showToast(res.message);
+    } catch (error) {
+        console.error(error);
+        showToast('Excel import failed');
+    } finally {
+        setLoading(false);
+    }
+}
+
+async function syncToExcel() {
+    setLoading(true);
+    try {
+        const res = JSON.parse(await window.pywebview.api.sync_to_excel());
+        showToast(res.message);
+    } catch (error) {
+        console.error(error);
+        showToast('Excel export failed');
+    } finally {
+        setLoading(false);
+    }
+}
+
+async function importPatients() {
+    setLoading(true);
+    try {
+        const res = JSON.parse(await window.pywebview.api.import_patients());
+        showToast(res.message);
+        if (res.errors && res.errors.length) {
+            console.warn('Import errors', res.errors);
+        }
+    } catch (error) {
+        console.error(error);
+        showToast('Patient import failed');
+    } finally {
+        setLoading(false);
+    }
+}
+
+// Called from Python whenever the git sync state changes
+function onSyncStatus(status) {
+    const el = document.getElementById('sync-status');
+    if (!el) return;
+    let text = '';
+    if (status.state === 'syncing') text = 'Syncing...';
+    else if (status.pending) text = `Pending ${status.pending} change${status.pending > 1 ? 's' : ''}`;
+    else if (status.last_pushed_at) text = `Last pushed ${status.last_pushed_at}`;
+    if (status.state === 'error') text = 'Sync failed';
+    el.innerText = text;
+    el.title = status.last_error || '';
+    el.classList.toggle('error', status.state === 'error');
+}
+
+// Performance panel (Settings tab)
+async function loadMetrics() {
+    const body = document.getElementById('metrics-body');
+    if (!body) return;
+    try {
+        const metrics = JSON.parse(await window.pywebview.api.get_metrics());
+        const rows = Object.entries(metrics.series);
+        body.innerHTML = rows.length ? rows.map(([name, m]) => `<tr class="${m.errors ? 'errors' : ''}">
+            <td>${escapeHtml(name)}</td>
+            <td>${m.count}</td>
+            <td>${m.errors}</td>
+            <td>${m.p50_ms.toFixed(1)}</td>
+            <td>${m.p95_ms.toFixed(1)}</td>
+            <td>${m.max_ms.toFixed(1)}</td>
+        </tr>`).join('') : '<tr><td colspan="6" class="status-text">No calls recorded yet</td></tr>';
+        const since = new Date(metrics.since * 1000).toLocaleString('en-US', { hour12: false });
+        document.getElementById('metrics-since').innerText = `Since ${since}`;
+    } catch (error) {
+        console.error(error);
+    }
+}
+
 function updateClock() {
     const now = new Date();
     const timeString = now.toLocaleTimeString('en-US', { hour12: false });
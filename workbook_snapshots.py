@@ -0,0 +1,309 @@
+# SAFI LAB - Incremental, content-addressed workbook snapshots (replaces the single Patients_Backup.xlsm)
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import phase
+
+ID_FORMAT = "%Y%m%d-%H%M%S"
+READ_BUFFER = 1024 * 1024
+
+
+def _member_info(member):
+    """A ZipInfo with the member's name, date, compress type and attributes from the manifest."""
+    zinfo = zipfile.ZipInfo(member["name"], tuple(member["date_time"]))
+    zinfo.compress_type = member["method"]
+    zinfo.external_attr = member["external_attr"]
+    return zinfo
+
+
+def _copy_member(src, zip_file, member):
+    """Writes `member` into `zip_file` through ZipFile.open, reading its content from the open file `src`."""
+    with zip_file.open(_member_info(member), "w", force_zip64=member["size"] > zipfile.ZIP64_LIMIT) as dest:
+        for chunk in iter(lambda: src.read(READ_BUFFER), b""):
+            dest.write(chunk)
+
+
+class _RawObject:
+    """Reads an object stored by older versions: the member's bytes as they were in the zip (stored or deflated)."""
+
+    def __init__(self, path, method):
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"Unsupported compress type {method} in {path}")
+        self._f = open(path, "rb")
+        self._inflate = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+
+    def read(self, size):
+        while True:
+            data = self._f.read(size)
+            if self._inflate is None: return data
+            if not data: return self._inflate.flush()
+            data = self._inflate.decompress(data)
+            if data: return data
+
+    def close(self):
+        self._f.close()
+
+
+def _content_hash(zf, info):
+    digest = hashlib.sha256()
+    with zf.open(info) as f:
+        for chunk in iter(lambda: f.read(READ_BUFFER), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class SnapshotStore:
+    """
+    Keeps snapshots of an .xlsm/.xlsx (a zip) as a manifest per snapshot plus
+    one object per distinct member (sheet XML, vbaProject.bin, styles...):
+
+        <root>/objects/ab/<sha256 of the member content>.zip
+        <root>/snapshots/<id>.json
+
+    Each object is a one-member zip holding the member compressed the way the
+    workbook had it, so an unchanged member costs nothing. Members are only
+    copied through ZipFile.open; objects from older versions
+    (<sha256>.<compress type>, the raw stored bytes) are still restored.
+    rotate() keeps the `recent` newest snapshots, plus the newest of each of
+    the last `hourly` hours and `daily` days.
+    """
+
+    def __init__(self, root, recent=10, hourly=24, daily=30):
+        self.root = root
+        self.recent = recent
+        self.hourly = hourly
+        self.daily = daily
+        self._objects = os.path.join(root, "objects")
+        self._snapshots = os.path.join(root, "snapshots")
+        self._lock = threading.Lock()
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._snapshots, exist_ok=True)
+
+    def _object_path(self, sha, ext="zip"):
+        return os.path.join(self._objects, sha[:2], f"{sha}.{ext}")
+
+    def _find_object(self, sha):
+        """Returns the path of the object holding content `sha` (either format), or None."""
+        folder = os.path.join(self._objects, sha[:2])
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if name.startswith(sha + "."): return os.path.join(folder, name)
+        return None
+
+    @contextmanager
+    def _open_object(self, member):
+        """Yields a file reading the member's uncompressed content from its object."""
+        path = self._find_object(member["sha"])
+        if path is None:
+            raise FileNotFoundError(f"Missing snapshot object for {member['name']}")
+        if path.endswith(".zip"):
+            with zipfile.ZipFile(path) as obj, obj.open(obj.infolist()[0]) as src:
+                yield src
+        else:
+            src = _RawObject(path, int(path.rsplit(".", 1)[1]))
+            try:
+                yield src
+            finally:
+                src.close()
+
+    def _manifest_path(self, snapshot_id):
+        return os.path.join(self._snapshots, f"{snapshot_id}.json")
+
+    def _load(self, snapshot_id):
+        with open(self._manifest_path(snapshot_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _ids(self):
+        # Ids are timestamps, so name order is age order
+        return sorted((name[:-5] for name in os.listdir(self._snapshots) if name.endswith(".json")), reverse=True)
+
+    def list(self):
+        """Returns snapshot summaries, newest first."""
+        snapshots = []
+        for snapshot_id in self._ids():
+            try:
+                manifest = self._load(snapshot_id)
+            except (OSError, ValueError) as e:
+                print(f"Snapshot Read Error ({snapshot_id}): {e}")
+                continue
+            snapshots.append({k: manifest[k] for k in ("id", "created", "source", "size", "new_bytes")})
+        return snapshots
+
+    def latest(self):
+        ids = self._ids()
+        return self._load(ids[0]) if ids else None
+
+    def snapshot(self, path, now=None):
+        """
+        Snapshots the workbook at `path`. Only members not already in the store
+        are written. Returns the new manifest, or None if nothing changed since
+        the latest snapshot.
+        """
+        with self._lock, phase("workbook.snapshot"):
+            st = os.stat(path)
+            latest = self.latest()
+            if latest and latest["signature"] == [st.st_size, st.st_mtime_ns]:
+                return None
+
+            members, new_bytes = [], 0
+            with open(path, "rb") as fp, zipfile.ZipFile(fp) as zf:
+                for info in zf.infolist():
+                    member = {
+                        "name": info.filename, "sha": _content_hash(zf, info), "method": info.compress_type,
+                        "crc": info.CRC, "size": info.file_size, "date_time": list(info.date_time),
+                        "external_attr": info.external_attr,
+                    }
+                    # Same content stored before: reuse it
+                    if self._find_object(member["sha"]) is None:
+                        target = self._object_path(member["sha"])
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        with zipfile.ZipFile(target + ".tmp", "w") as obj, zf.open(info) as src:
+                            _copy_member(src, obj, member)
+                        os.replace(target + ".tmp", target)
+                        new_bytes += os.path.getsize(target)
+                    members.append(member)
+
+            if latest and latest["members"] == members:
+                return None
+
+            created = now or time.time()
+            snapshot_id = datetime.fromtimestamp(created).strftime(ID_FORMAT)
+            suffix = 1
+            while os.path.exists(self._manifest_path(snapshot_id)):
+                suffix += 1
+                snapshot_id = f"{datetime.fromtimestamp(created).strftime(ID_FORMAT)}-{suffix}"
+            manifest = {
+                "id": snapshot_id, "created": created, "source": os.path.abspath(path),
+                "size": st.st_size, "signature": [st.st_size, st.st_mtime_ns],
+                "new_bytes": new_bytes, "members": members,
+            }
+            _write_atomic(self._manifest_path(snapshot_id), json.dumps(manifest).encode("utf-8"))
+            return manifest
+
+    def restore(self, snapshot_id, out_path):
+        """Rebuilds snapshot `snapshot_id` as `out_path` (written to a temp file, then swapped in)."""
+        manifest = self._load(snapshot_id)
+        tmp_path = out_path + ".tmp"
+        with zipfile.ZipFile(tmp_path, "w") as zf:
+            for member in manifest["members"]:
+                with self._open_object(member) as src:
+                    _copy_member(src, zf, member)
+        os.replace(tmp_path, out_path)
+        return out_path
+
+    def rotate(self):
+        """Drops snapshots outside the hourly/daily retention and unreferenced objects. Returns the dropped ids."""
+        with self._lock:
+            snapshots = self.list()
+            # Always at least the latest, so a bad session never replaces the last good one
+            keep = {snap["id"] for snap in snapshots[:max(1, self.recent)]}
+            hours, days = set(), set()
+            for snap in snapshots:
+                when = datetime.fromtimestamp(snap["created"])
+                hour, day = when.strftime("%Y%m%d%H"), when.strftime("%Y%m%d")
+                if hour not in hours and len(hours) < self.hourly:
+                    hours.add(hour)
+                    keep.add(snap["id"])
+                if day not in days and len(days) < self.daily:
+                    days.add(day)
+                    keep.add(snap["id"])
+
+            dropped = [snap["id"] for snap in snapshots if snap["id"] not in keep]
+            for snapshot_id in dropped:
+                os.remove(self._manifest_path(snapshot_id))
+            if dropped:
+                referenced = set()
+                for snapshot_id in keep:
+                    for m in self._load(snapshot_id)["members"]:
+                        # Current objects, and raw ones written by older versions
+                        referenced.update((f"{m['sha']}.zip", f"{m['sha']}.{m['method']}"))
+                self._collect_garbage(referenced)
+            return dropped
+
+    def _collect_garbage(self, referenced):
+        for prefix in os.listdir(self._objects):
+            folder = os.path.join(self._objects, prefix)
+            for name in os.listdir(folder):
+                if name not in referenced:
+                    os.remove(os.path.join(folder, name))
+
+
+class SnapshotWorker:
+    """
+    Takes a snapshot (then rotates) right away and every `interval` seconds on
+    a background thread. `lock`, if given, is held while the workbook is read
+    so a snapshot never overlaps our own workbook writes.
+    """
+
+    def __init__(self, store, path, interval=3600.0, lock=None, on_done=None):
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.lock = lock or threading.Lock()
+        self.on_done = on_done
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="workbook-snapshots", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, final=True):
+        """Stops the worker; with `final` takes one last snapshot (e.g. after the shutdown flush)."""
+        self._stop.set()
+        if self._thread: self._thread.join()
+        if final: self.run_once()
+
+    def run_once(self):
+        if not os.path.exists(self.path): return None
+        try:
+            with self.lock:
+                manifest = self.store.snapshot(self.path)
+            if manifest:
+                print(f"Snapshot {manifest['id']} created ({manifest['new_bytes']} new bytes)")
+            self.store.rotate()
+            return manifest
+        except Exception as e:
+            print(f"Snapshot Error: {e}")
+            return None
+
+    def _run(self):
+        self.run_once()
+        if self.on_done: self.on_done()
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+
+if __name__ == '__main__':
+    # Usage: python workbook_snapshots.py list|snapshot|restore [id] [out] (store in ./Backups)
+    store = SnapshotStore(os.path.abspath("Backups"))
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "list":
+        for snap in store.list():
+            created = datetime.fromtimestamp(snap["created"]).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{snap['id']}  {created}  {snap['size']} bytes  (+{snap['new_bytes']} stored)")
+    elif command == "snapshot":
+        manifest = store.snapshot(os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else "Patients.xlsm"))
+        print(f"Created {manifest['id']}" if manifest else "Workbook unchanged since the latest snapshot")
+    elif command == "restore" and len(sys.argv) > 2:
+        out_path = os.path.abspath(sys.argv[3] if len(sys.argv) > 3 else f"Patients_{sys.argv[2]}.xlsm")
+        print(f"Restored {sys.argv[2]} to {store.restore(sys.argv[2], out_path)}")
+    else:
+        print("Usage: python workbook_snapshots.py list | snapshot [workbook] | restore <id> [out]")
+        sys.exit(1)
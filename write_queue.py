@@ -0,0 +1,197 @@
+# SAFI LAB - Write-behind queue for workbook updates
+import threading
+import time
+
+from patients import normalize_id
+
+
+class WriteBehindQueue:
+    """
+    Collects pending workbook updates and flushes them in one save.
+
+    Updates are keyed by (patient id, column); repeated writes to the same cell
+    are merged so only the latest value is written. A background thread flushes
+    `delay` seconds after the first pending update, when flush() is called, or
+    on close(). Every enqueue returns a ticket; wait_for(ticket) / is_durable(ticket)
+    tell when that update is on disk.
+
+    `writer(entries)` receives {normalized id: {"pid", "delete", "cells": {col: value}}}
+    and must apply all of it in a single save, raising on failure. Failures are
+    retried with backoff; an exception in `refusals` (one that will fail again
+    until something outside the queue changes) also ends every wait_for()
+    and flush() whose updates that attempt covered, with False.
+    """
+
+    def __init__(self, writer, delay=2.0, max_retry_delay=60.0, refusals=()):
+        self._writer = writer
+        self._refusal_types = tuple(refusals)
+        self._delay = delay
+        self._max_retry_delay = max_retry_delay
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._writing = {}    # entries handed to the writer, until it returns
+        self._seq = 0
+        self._durable_seq = 0
+        self._due = None
+        self._flush_requested = False
+        self._closed = False
+        self._failures = 0
+        self._refusals = 0       # writes that failed with one of `refusals`...
+        self._refused_seq = 0    # ...the last of which covered tickets up to this one
+        self.last_flush = None
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="workbook-writer", daemon=True)
+        self._thread.start()
+
+    # --- Enqueue ---
+    def _entry(self, pid):
+        key = normalize_id(pid)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = {"pid": str(pid).strip(), "delete": False, "cells": {}}
+            self._pending[key] = entry
+        return entry
+
+    def _enqueued(self):
+        self._seq += 1
+        if self._due is None:
+            self._due = time.monotonic() + self._delay
+        self._cond.notify_all()
+        return self._seq
+
+    def set_cell(self, pid, col, value):
+        """Queues one cell (0-based column). Returns a ticket."""
+        return self.set_row(pid, {col: value})
+
+    def set_row(self, pid, cells):
+        """Queues several cells of one row ({0-based column: value}). Returns a ticket."""
+        with self._cond:
+            if self._closed: raise RuntimeError("Write queue is closed")
+            self._entry(pid)["cells"].update(cells)
+            return self._enqueued()
+
+    def delete_row(self, pid):
+        """Queues a row delete; drops any cell writes queued before it. Returns a ticket."""
+        with self._cond:
+            if self._closed: raise RuntimeError("Write queue is closed")
+            entry = self._entry(pid)
+            entry["delete"] = True
+            entry["cells"] = {}
+            return self._enqueued()
+
+    # --- Durability ---
+    def is_durable(self, ticket):
+        with self._cond:
+            return self._durable_seq >= ticket
+
+    def wait_for(self, ticket, timeout=None):
+        """
+        Blocks until the update behind `ticket` is on disk. Returns False on
+        timeout, or as soon as a write covering it is refused (see `refusals`).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            refusals = self._refusals
+            while self._durable_seq < ticket:
+                if self._refusals != refusals and self._refused_seq >= ticket: return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: return False
+                self._cond.wait(remaining)
+            return True
+
+    def flush(self, wait=True, timeout=None):
+        """Flushes now. With wait=True, blocks until everything queued so far is on disk."""
+        with self._cond:
+            ticket = self._seq
+            if ticket == self._durable_seq: return True
+            self._flush_requested = True
+            self._cond.notify_all()
+        if not wait: return True
+        return self.wait_for(ticket, timeout)
+
+    def pending_entries(self):
+        """Copy of every update not yet on disk (including one being written), newest values winning."""
+        with self._cond:
+            entries = {key: {"pid": e["pid"], "delete": e["delete"], "cells": dict(e["cells"])}
+                       for key, e in self._writing.items()}
+            for key, new in self._pending.items():
+                old = entries.get(key)
+                if old is None or new["delete"] or old["delete"]:
+                    entries[key] = {"pid": new["pid"], "delete": new["delete"], "cells": dict(new["cells"])}
+                else:
+                    old["cells"].update(new["cells"])
+            return entries
+
+    def status(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "durable": self._durable_seq == self._seq,
+                "last_flush": self.last_flush,
+                "last_error": self.last_error,
+            }
+
+    def close(self, timeout=30):
+        """Flushes what is pending and stops the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # --- Writer thread ---
+    def _merge_back(self, failed):
+        # Newer updates queued during the failed write win over the failed ones
+        for key, old in failed.items():
+            new = self._pending.get(key)
+            if new is None:
+                self._pending[key] = old
+            elif not new["delete"]:
+                new["delete"] = old["delete"]
+                new["cells"] = {**old["cells"], **new["cells"]}
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                while not (self._closed or self._flush_requested):
+                    remaining = self._due - time.monotonic()
+                    if remaining <= 0: break
+                    self._cond.wait(remaining)
+
+                entries, self._pending = self._pending, {}
+                self._writing = entries
+                seq = self._seq
+                self._flush_requested = False
+                self._due = None
+
+                self._cond.release()
+                error = None
+                try:
+                    self._writer(entries)
+                except Exception as e:
+                    error = e
+                finally:
+                    self._cond.acquire()
+                    self._writing = {}
+
+                if error is None:
+                    self._failures = 0
+                    self._durable_seq = seq
+                    self.last_flush = time.strftime('%Y-%m-%d %H:%M:%S')
+                    self.last_error = None
+                else:
+                    print(f"Workbook Flush Error: {error}")
+                    self.last_error = str(error)
+                    if isinstance(error, self._refusal_types):
+                        self._refusals += 1
+                        self._refused_seq = seq
+                    self._merge_back(entries)
+                    self._failures += 1
+                    if self._closed and self._failures >= 3:
+                        return
+                    backoff = min(self._delay * (2 ** self._failures), self._max_retry_delay)
+                    self._due = time.monotonic() + backoff
+                self._cond.notify_all()